@@ -0,0 +1,389 @@
+"""Asyncio client for driving many marketplace sessions from one event loop.
+
+AsyncClient offers the same operations as Client as coroutines. The protocol has
+no request IDs, so concurrency comes from a pool of connections attached to one
+login with a session token: each request borrows a connection for its whole
+exchange, and up to pool_size requests are in flight at once.
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+
+from client import BUSY_RETRIES, HEARTBEAT_INTERVAL, POOL_SIZE, REQUEST_TIMEOUT, UPLOAD_RETRIES
+
+async def read_reply(reader):
+    """Read one reply: a JSON value, possibly split over several segments, or a text message"""
+    data = b""
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        data += chunk
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        if not text.lstrip().startswith(("{", "[")):
+            return text
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            continue
+
+async def read_values(reader):
+    """Yield JSON values from a connection the server pushes to, however they are split or joined"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pending = b""
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        pending += chunk
+        try:
+            buffer += pending.decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        pending = b""
+        while True:
+            buffer = buffer.lstrip()
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except ValueError:
+                break
+            buffer = buffer[end:]
+            yield value
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_chunk(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+class AsyncClient:
+    """Coroutine version of Client over asyncio streams.
+
+    The login connection is kept for what the server pushes to it (relayed
+    messages and notifications), and presence changes arrive on a subscribed
+    connection; both are delivered through events(). No P2P listener is run, so
+    peers reach an AsyncClient through server-relayed messages.
+    """
+    def __init__(self, server_port, host="localhost", pool_size=POOL_SIZE):
+        self.host = host
+        self.server_port = server_port
+        self.pool_size = pool_size
+        self.id = None
+        self.username = None
+        self.budget = float('inf')
+        self.token = None
+        self.primary = None
+        self.presence = None
+        self.catalog = None
+        # Catalog feed position: last sequence number seen and the server run it belongs to
+        self.catalog_seq = None
+        self.catalog_epoch = None
+        self.pool = asyncio.Queue()
+        self.event_queue = asyncio.Queue()
+        self.tasks = []
+
+    async def open_connection(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.server_port), REQUEST_TIMEOUT)
+
+    async def connect(self):
+        """Open the connection used to register and log in"""
+        self.primary = await self.open_connection()
+
+    async def exchange(self, conn, message):
+        """Send one command on a connection and return its reply, retrying busy replies"""
+        reader, writer = conn
+        for _ in range(BUSY_RETRIES + 1):
+            writer.write(json.dumps(message).encode('utf-8'))
+            await writer.drain()
+            reply = await asyncio.wait_for(read_reply(reader), REQUEST_TIMEOUT)
+            if not (isinstance(reply, dict) and reply.get("status") == "busy"):
+                break
+            await asyncio.sleep(reply.get("retry_after_ms", 250) / 1000)
+        return reply
+
+    async def attach(self):
+        """Open one more connection attached to this login"""
+        conn = await self.open_connection()
+        reply = await self.exchange(conn, {"command": "resume_session", "token": self.token})
+        if not isinstance(reply, dict) or reply.get("status") != "ok":
+            conn[1].close()
+            raise ConnectionError(reply.get("message", reply.get("error", "Could not attach connection")) if isinstance(reply, dict) else reply)
+        return conn
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """Borrow a pooled connection; one that fails is replaced instead of returned"""
+        conn = await self.pool.get()
+        try:
+            yield conn
+        except (ConnectionError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            conn[1].close()
+            conn = None
+            raise
+        finally:
+            if conn is None:
+                self.tasks.append(asyncio.create_task(self.replace_connection()))
+            else:
+                self.pool.put_nowait(conn)
+
+    async def replace_connection(self):
+        try:
+            self.pool.put_nowait(await self.attach())
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            print(f"Could not replace pooled connection: {e}")
+
+    async def request(self, message):
+        async with self.connection() as conn:
+            return await self.exchange(conn, message)
+
+    async def register(self, username, email, password, name):
+        """Register new user account"""
+        return await self.exchange(self.primary, {"command": "Register", "username": username, "email": email,
+                                                  "password": password, "name": name})
+
+    async def login(self, username, password):
+        """Log in, then open the request pool and start receiving pushes"""
+        reader, writer = self.primary
+        welcome = f"Login successful.\nWelcome {username}"
+        response = await self.exchange(self.primary, {"command": "login", "username": username, "password": password,
+                                                      "ip": None, "port": None})
+        if not isinstance(response, str) or not response.startswith(welcome):
+            return response
+        # The user ID is sent right after the welcome and may share its segment
+        self.id = response[len(welcome):] or (await reader.read(1024)).decode('utf-8')
+        self.username = username
+        reply = await self.exchange(self.primary, {"command": "issue_token"})
+        if reply.get("status") != "ok":
+            return reply.get("message")
+        self.token = reply["token"]
+        # One at a time: attaching counts against the same per-user auth rate limit as login
+        for _ in range(self.pool_size):
+            self.pool.put_nowait(await self.attach())
+        self.presence = await self.attach()
+        self.tasks += [
+            asyncio.create_task(self.forward_pushes(self.primary)),
+            asyncio.create_task(self.forward_pushes(self.presence, {"command": "subscribe_presence"})),
+            asyncio.create_task(self.heartbeat()),
+        ]
+        return welcome
+
+    async def forward_pushes(self, conn, subscribe=None):
+        """Move everything the server pushes on a connection into the event queue"""
+        reader, writer = conn
+        subscribe_message = json.dumps(subscribe).encode('utf-8')
+        if subscribe:
+            writer.write(subscribe_message)
+        epoch = None
+        try:
+            async for value in read_values(reader):
+                if isinstance(value, dict) and value.get("status") == "subscribed" and "epoch" in value:
+                    epoch = value["epoch"]
+                    if self.catalog_seq is None:
+                        self.catalog_seq, self.catalog_epoch = value["seq"], epoch
+                    continue
+                if isinstance(value, dict) and value.get("status") in ("pong", "subscribed"):
+                    continue
+                if isinstance(value, dict) and value.get("type") == "catalog":
+                    self.catalog_seq, self.catalog_epoch = value["seq"], epoch
+                if subscribe and isinstance(value, dict) and value.get("status") == "busy":
+                    await asyncio.sleep(value.get("retry_after_ms", 250) / 1000)
+                    writer.write(subscribe_message)
+                    continue
+                await self.event_queue.put(value)
+        except (ConnectionError, OSError) as e:
+            print(f"Push connection closed: {e}")
+
+    async def subscribe_catalog(self):
+        """Receive catalog changes through events(), resuming from the last change seen.
+
+        Call again after the feed drops; a "reset" change means some changes were
+        missed and the catalog should be reloaded with get_items().
+        """
+        if self.catalog:
+            self.catalog[1].close()
+        self.catalog = await self.attach()
+        self.tasks.append(asyncio.create_task(self.forward_pushes(
+            self.catalog, {"command": "subscribe_catalog", "since": self.catalog_seq, "epoch": self.catalog_epoch})))
+
+    async def heartbeat(self, interval=HEARTBEAT_INTERVAL):
+        """Keep the login, presence and idle pooled connections open"""
+        ping = json.dumps({"command": "ping"}).encode('utf-8')
+        while True:
+            await asyncio.sleep(interval)
+            # Replies on the push connections are filtered out by forward_pushes
+            for conn in (self.primary, self.presence, self.catalog):
+                if conn:
+                    conn[1].write(ping)
+            for _ in range(self.pool.qsize()):
+                async with self.connection() as conn:
+                    await self.exchange(conn, {"command": "ping"})
+
+    async def events(self):
+        """Iterate over server pushes: relayed messages, notifications, presence and catalog changes"""
+        while True:
+            event = await self.event_queue.get()
+            if event is None:
+                return
+            yield event
+
+    async def get_items(self, currency="USD"):
+        """Get list of available items"""
+        items = await self.request({"command": "display", "self_id": self.id, "currency": currency})
+        if isinstance(items, dict):
+            return items.get("error", "Error retrieving items.")
+        return items
+
+    async def search_product(self, search, currency=None):
+        """Search products by name or description, priced in currency if given; images are fetched with get_image"""
+        items = await self.request({"command": "search", "item": search, "self_id": self.id, "with_images": False,
+                                    "currency": currency})
+        if not isinstance(items, list):
+            return items.get("error", "Error retrieving items.") if isinstance(items, dict) else items
+        return items
+
+    async def get_image(self, product_id, save_path):
+        """Download one product image"""
+        async with self.connection() as (reader, writer):
+            writer.write(json.dumps({"command": "get_image", "product_id": product_id}).encode('utf-8'))
+            size_data = (await asyncio.wait_for(reader.read(1024), REQUEST_TIMEOUT)).decode('utf-8')
+            if size_data.startswith("ERROR"):
+                print(f"Server error: {size_data}")
+                return False
+            image_size = int(size_data)
+            writer.write(b"READY")
+            received = bytearray()
+            while len(received) < image_size:
+                chunk = await asyncio.wait_for(reader.readexactly(min(8192, image_size - len(received))), REQUEST_TIMEOUT)
+                received += chunk
+                # The server waits for one ack per 8192-byte chunk it sends
+                writer.write(f"PROGRESS:{len(received) / image_size * 100:.2f}".encode('utf-8'))
+            writer.write(b"SUCCESS: Image received")
+            await writer.drain()
+        await asyncio.to_thread(write_file, save_path, bytes(received))
+        return True
+
+    async def send_image(self, image_path):
+        """Upload an image through a resumable upload session; returns its upload ID or None"""
+        if not os.path.exists(image_path):
+            print("Error: Image file not found")
+            return None
+        image_size = os.path.getsize(image_path)
+        sha256 = await asyncio.to_thread(file_sha256, image_path)
+        response = await self.request({"command": "begin_upload", "size": image_size, "sha256": sha256, "self_id": self.id})
+        if response.get("status") != "ok":
+            print(f"Upload failed: {response.get('message')}")
+            return None
+        upload_id = response["upload_id"]
+        for _ in range(UPLOAD_RETRIES):
+            try:
+                async with self.connection() as conn:
+                    if await self.upload_from_offset(conn, upload_id, image_path, image_size, response["chunk_size"]):
+                        return upload_id
+                    return None
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                print(f"Upload interrupted ({e}), resuming...")
+        print("Upload failed: too many connection errors")
+        return None
+
+    async def upload_from_offset(self, conn, upload_id, image_path, image_size, chunk_size):
+        """Send the rest of an upload starting at the offset the server has persisted"""
+        reader, writer = conn
+        status = await self.exchange(conn, {"command": "query_upload", "upload_id": upload_id})
+        if status.get("status") != "ok":
+            print(f"Upload failed: {status.get('message')}")
+            return False
+        offset = status["offset"]
+        while not status["complete"] and offset < image_size:
+            chunk = await asyncio.to_thread(read_chunk, image_path, offset, chunk_size)
+            response = await self.exchange(conn, {"command": "upload_chunk", "upload_id": upload_id,
+                                                  "offset": offset, "length": len(chunk)})
+            if response.get("status") != "ready":
+                print(f"Upload failed: {response.get('message')}")
+                return False
+            writer.write(chunk)
+            ack = await asyncio.wait_for(read_reply(reader), REQUEST_TIMEOUT)
+            if ack.get("status") != "ok":
+                print(f"Upload failed: {ack.get('message')}")
+                return False
+            offset = ack["offset"]
+        if not status["complete"]:
+            response = await self.exchange(conn, {"command": "finish_upload", "upload_id": upload_id})
+            if response.get("status") != "ok":
+                print(f"Upload failed: {response.get('message')}")
+                return False
+        return True
+
+    async def sell_item(self, product_name, price, description, image_path, amount):
+        """List new item for sale"""
+        upload_id = await self.send_image(image_path)
+        if not upload_id:
+            return "Failed to upload product image"
+        return await self.request({"command": "sell", "product_name": product_name, "price": price, "self_id": self.id,
+                                   "image_path": image_path, "description": description, "amount": amount,
+                                   "upload_id": upload_id})
+
+    async def purchase_product(self, product_name):
+        """Purchase a product"""
+        if not self.id:
+            return "Please log in first."
+        response = await self.request({"command": "get_price", "product_name": product_name})
+        if response.get("status") != "success":
+            return response.get("message", "Item not found")
+        price = response["price"]
+        if price > self.budget:
+            return "Purchase cannot be completed. Not enough budget."
+        response = await self.request({"command": "Purchase", "product_name": product_name, "self_id": self.id})
+        if response.get("status") != "success":
+            return response.get("message", response.get("status"))
+        self.budget -= price
+        return response["message"]
+
+    async def rate(self, rating, product_id):
+        """Submit a rating for a product"""
+        if not (1 <= rating <= 5):
+            return "Rating must be between 1 and 5."
+        response = await self.request({"command": "rate", "rating": rating, "product_id": product_id, "self_id": self.id})
+        return response.get("message", "Unknown response from server")
+
+    async def send_message(self, recipient_username, message):
+        """Relay a message through the server; replies arrive through events()"""
+        _, writer = self.primary
+        writer.write(json.dumps({"command": "send_message", "self_id": self.username,
+                                 "recipient_username": recipient_username, "message": message}).encode('utf-8'))
+        await writer.drain()
+
+    async def close(self):
+        """Log out and close every connection"""
+        for task in self.tasks:
+            task.cancel()
+        if self.primary:
+            _, writer = self.primary
+            if self.id:
+                writer.write(json.dumps({"command": "logout"}).encode('utf-8'))
+                with contextlib.suppress(ConnectionError, OSError):
+                    await writer.drain()
+            writer.close()
+        for conn in (self.presence, self.catalog):
+            if conn:
+                conn[1].close()
+        while not self.pool.empty():
+            self.pool.get_nowait()[1].close()
+        self.id = None
+        await self.event_queue.put(None)
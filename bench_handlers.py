@@ -0,0 +1,553 @@
+"""Microbenchmarks for individual server handlers.
+
+Usage:
+    python bench_handlers.py run [--sizes 1000,10000,100000] [--only search,rate] [--output results.json]
+    python bench_handlers.py compare base.json new.json [--threshold 0.05]
+
+Each handler is called in this process the way handle_client calls it, on
+one end of a socket.socketpair() wrapped in ClientConnection. A peer thread
+on the other end reads the replies and answers the image handshakes. For
+every catalog size a temp directory gets a fresh database from
+server.create_Tables, filled by a deterministic generator: the same seed
+and size give the same rows on every commit. Writes run on the handler's
+own connection, the path run_write takes before start_writers, so purchase
+and rate time the write itself without the group-commit window.
+
+After a warmup, each sample times enough back-to-back calls to last at
+least --min-time seconds, with the garbage collector off as timeit does.
+A result is the median and median absolute deviation of the per-call time
+over --samples samples. Peak memory is measured in a separate pass under
+tracemalloc, because tracing slows every allocation down.
+
+To compare two commits, benchmark a worktree of the older one with
+--server-dir, then the current tree, and compare the result files:
+
+    git worktree add /tmp/base <commit>
+    python bench_handlers.py run --server-dir /tmp/base --output base.json
+    python bench_handlers.py run --output new.json
+    python bench_handlers.py compare base.json new.json
+
+Handlers are called with the signature the imported checkout has, so any
+commit whose server.py can be imported without starting the server (one
+with an `if __name__ == "__main__"` guard, which arrived with catalog_tool.py)
+can be benchmarked; run refuses older ones. A benchmark needing something
+the checkout lacks (the columnar catalog) is skipped, and compare lists it
+as only in the other file.
+
+compare flags a benchmark whose median got slower by more than --threshold
+when a Mann-Whitney U test on the two sets of samples also says the change
+is unlikely to be noise, and exits with status 1 if any did.
+"""
+import argparse
+import gc
+import importlib
+import inspect
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import bcrypt
+
+# Seed of the synthetic catalog; change it and results are no longer comparable
+SEED = 42
+# Catalog sizes benchmarked when --sizes is not given
+DEFAULT_SIZES = (1000, 10000, 100000)
+# Products per seller in the synthetic catalog
+PRODUCTS_PER_OWNER = 20
+# Words product names and descriptions are made of; one name in len(ADJECTIVES) * len(NOUNS) matches SEARCH_TERM
+ADJECTIVES = ("red", "vintage", "handmade", "wooden", "silver", "linen", "ceramic", "leather", "woven", "antique")
+NOUNS = ("lamp", "scarf", "bowl", "chair", "ring", "jacket", "vase", "table", "bag", "print")
+# User ID 1 buys, searches and rates; the sellers come after it
+BUYER_ID = 1
+BUYER_NAME = "bench"
+BENCH_PASSWORD = "bench-password"
+# The first products get stock that never runs out, so purchase_product always takes the success path
+STOCKED_PRODUCTS = 100
+UNLIMITED_STOCK = 10 ** 9
+# Products that get an image, and the size of each, in bytes
+IMAGE_PRODUCTS = 16
+IMAGE_SIZE = 64 * 1024
+# Bytes send_image sends between acknowledgements
+SEND_IMAGE_CHUNK = 8192
+SEARCH_TERM = "vintage lamp"
+BUDGET = 50.0
+# Calls measured under tracemalloc; the largest peak is reported
+MEMORY_CALLS = 3
+# compare only reports a change whose Mann-Whitney p-value is below this
+SIGNIFICANCE = 0.01
+
+# The modules under test, imported by load_server so they can come from another checkout
+server = None
+diagnostics = None
+columnar_catalog = None
+
+def load_server(directory):
+    """Import server and the modules it is benchmarked with from directory; modules it lacks stay None"""
+    global server, diagnostics, columnar_catalog
+    directory = os.path.abspath(directory)
+    with open(os.path.join(directory, "server.py"), encoding='utf-8') as f:
+        if 'if __name__ == "__main__":' not in f.read():
+            raise SystemExit(f"{directory}/server.py starts the server when imported; benchmark a newer commit")
+    sys.path.insert(0, directory)
+    server = importlib.import_module("server")
+    # Only the checkout's own copies count, not the ones next to this file
+    if os.path.exists(os.path.join(directory, "diagnostics.py")):
+        diagnostics = importlib.import_module("diagnostics")
+    if os.path.exists(os.path.join(directory, "columnar_catalog.py")):
+        columnar_catalog = importlib.import_module("columnar_catalog")
+
+def takes(function, parameter):
+    """True if the checkout's version of a handler has the named parameter"""
+    return parameter in inspect.signature(function).parameters
+
+def image_dir():
+    # The baseline hard-codes the directory
+    return getattr(server, "IMAGE_DIR", "product_images")
+
+def generate_catalog(db, size, seed=SEED):
+    """Fill an empty database with users, size products and IMAGE_PRODUCTS images.
+
+    Returns the IDs of the products that have an image.
+    """
+    rng = random.Random(seed)
+    num_owners = max(1, size // PRODUCTS_PER_OWNER)
+    # One hash for everyone: bcrypt is slow by design, and authenticate_user only ever checks one
+    password = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt())
+    db.executemany("INSERT INTO users (id, username, email, password, name) VALUES (?, ?, ?, ?, ?)", (
+        (user_id, BUYER_NAME if user_id == BUYER_ID else f"seller{user_id}", f"user{user_id}@example.com", password, f"User {user_id}")
+        for user_id in range(1, num_owners + 2)))
+
+    def products():
+        for product_id in range(1, size + 1):
+            adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+            owner_id = rng.randrange(2, num_owners + 2)
+            amount = UNLIMITED_STOCK if product_id <= STOCKED_PRODUCTS else rng.randrange(6)
+            image = f"{product_id}.jpg" if product_id <= IMAGE_PRODUCTS else None
+            yield (product_id, owner_id, f"{adjective} {noun} {product_id}", round(rng.uniform(1, 1000), 2),
+                   f"A {adjective} {noun} from seller {owner_id}", image, amount,
+                   round(rng.uniform(0, 5), 2), rng.randrange(50), 'available' if amount else 'sold')
+    db.executemany("""INSERT INTO products (id, owner_id, name, price, description, image, amount, rating, num_raters, status)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", products())
+
+    os.makedirs(image_dir(), exist_ok=True)
+    image_ids = list(range(1, min(size, IMAGE_PRODUCTS) + 1))
+    for product_id in image_ids:
+        fd, temp_path = tempfile.mkstemp(dir=image_dir(), suffix=".part")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(rng.randbytes(IMAGE_SIZE))
+        if hasattr(server, "image_store"):
+            server.image_store.store(db, temp_path, product_id)
+        else:
+            os.replace(temp_path, os.path.join(image_dir(), f"{product_id}.jpg"))
+    db.commit()
+    return image_ids
+
+def database_path():
+    # Checkouts from before sharding name the file only inside handle_server
+    return getattr(server, "DB_PATH", "botique.db")
+
+class Catalog:
+    """A seeded database in its own temp directory, which is the working directory while it is open"""
+    def __init__(self, size, seed, keep=False):
+        self.size = size
+        self.keep = keep
+        self.previous_cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix=f"bench-handlers-{size}-")
+        os.chdir(self.directory)
+        try:
+            server.create_Tables(database_path())
+            seed_db = sqlite3.connect(database_path())
+            try:
+                self.image_ids = generate_catalog(seed_db, size, seed)
+            finally:
+                seed_db.close()
+        except BaseException:
+            os.chdir(self.previous_cwd)
+            shutil.rmtree(self.directory, ignore_errors=True)
+            raise
+        # Handlers get the same kind of connection handle_client opens
+        if diagnostics is not None:
+            self.db = diagnostics.connect(database_path())
+        else:
+            self.db = sqlite3.connect(database_path(), check_same_thread=False)
+        if hasattr(server, "NameIndex"):
+            server.name_index = server.NameIndex()
+            server.name_index.load(self.db.execute("SELECT id, name FROM products WHERE amount > 0 AND status = 'available'"))
+        self.columnar = None
+        if columnar_catalog is not None and columnar_catalog.available():
+            self.columnar = columnar_catalog.ColumnarCatalog.from_db(self.db)
+
+    def close(self):
+        self.db.close()
+        os.chdir(self.previous_cwd)
+        if self.keep:
+            print(f"Kept the size {self.size} database in {self.directory}")
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("handler closed the connection")
+        data += chunk
+    return data
+
+def drain(sock):
+    """Peer loop: read and drop everything the handler sends"""
+    buffer = bytearray(1 << 20)
+    try:
+        while sock.recv_into(buffer):
+            pass
+    except OSError:
+        pass
+
+def download_images(sock):
+    """Peer loop: the client side of send_image, for any number of images"""
+    try:
+        while True:
+            header = sock.recv(64)
+            if not header:
+                return
+            size = int(header)
+            sock.sendall(b"READY")
+            received = 0
+            while received < size:
+                received += len(receive_exactly(sock, min(SEND_IMAGE_CHUNK, size - received)))
+                sock.sendall(f"PROGRESS:{received / size * 100:.2f}".encode('utf-8'))
+            sock.sendall(b"SUCCESS: Image received")
+    except (OSError, ValueError):
+        pass
+
+def upload_images(sock):
+    """Peer loop: the client side of receive_image, sending IMAGE_SIZE bytes each time"""
+    payload = random.Random(SEED).randbytes(IMAGE_SIZE)
+    chunk_size = getattr(server, "UPLOAD_CHUNK_SIZE", SEND_IMAGE_CHUNK)
+    try:
+        while True:
+            sock.sendall(str(IMAGE_SIZE).encode('utf-8'))
+            if sock.recv(64) != b"READY":
+                return
+            for offset in range(0, IMAGE_SIZE, chunk_size):
+                sock.sendall(payload[offset:offset + chunk_size])
+                if offset + chunk_size < IMAGE_SIZE and not sock.recv(64).startswith(b"PROGRESS:"):
+                    return
+            # The last PROGRESS and the SUCCESS may arrive together or apart
+            reply = b""
+            while not reply.endswith(b"SUCCESS: Image received"):
+                chunk = sock.recv(64)
+                if not chunk:
+                    return
+                reply += chunk
+    except OSError:
+        pass
+
+class Peer:
+    """The two ends of a socketpair: the handler's, and a client end served by a peer loop thread"""
+    def __init__(self, loop):
+        server_end, self.client_end = socket.socketpair()
+        # Checkouts from before ClientConnection hand handlers the bare socket
+        self.connection = server.ClientConnection(server_end) if hasattr(server, "ClientConnection") else server_end
+        self.thread = threading.Thread(target=loop, args=(self.client_end,), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        getattr(self.connection, "sock", self.connection).close()
+        self.thread.join(5)
+        self.client_end.close()
+
+# name -> (function(catalog, connection) returning the call to time, peer loop, use the columnar catalog)
+BENCHMARKS = {}
+
+def benchmark(name, peer=drain, columnar=False):
+    def register(make_call):
+        BENCHMARKS[name] = (make_call, peer, columnar)
+        return make_call
+    return register
+
+@benchmark("send_items")
+def send_items_call(catalog, connection):
+    return lambda: server.send_items(connection, catalog.db, BUYER_ID)
+
+def without_images(handler):
+    """Keyword arguments that keep a listing handler from sending images, where it can"""
+    return {"with_images": False} if takes(handler, "with_images") else {}
+
+@benchmark("search")
+def search_call(catalog, connection):
+    options = without_images(server.search)
+    return lambda: server.search(SEARCH_TERM, connection, catalog.db, BUYER_ID, **options)
+
+@benchmark("filter_by_budget")
+def filter_by_budget_call(catalog, connection):
+    options = without_images(server.filter_by_budget)
+    return lambda: server.filter_by_budget(connection, BUDGET, catalog.db, BUYER_ID, **options)
+
+@benchmark("filter_by_budget[columnar]", columnar=True)
+def filter_by_budget_columnar_call(catalog, connection):
+    options = without_images(server.filter_by_budget)
+    return lambda: server.filter_by_budget(connection, BUDGET, catalog.db, BUYER_ID, **options)
+
+@benchmark("send_image", peer=download_images)
+def send_image_call(catalog, connection):
+    image_ids = itertools.cycle(catalog.image_ids)
+    # Checkouts from before the image store read the file themselves and take no db
+    extra = (catalog.db,) if takes(server.send_image, "db") else ()
+    def call():
+        if not server.send_image(connection, next(image_ids), *extra):
+            raise RuntimeError("send_image failed")
+    return call
+
+@benchmark("authenticate_user")
+def authenticate_user_call(catalog, connection):
+    def call():
+        if not server.authenticate_user(None, BUYER_NAME, BENCH_PASSWORD, catalog.db):
+            raise RuntimeError("authenticate_user rejected the benchmark user")
+    return call
+
+# The handlers below write, so they run after the ones that only read
+
+@benchmark("purchase_product")
+def purchase_product_call(catalog, connection):
+    names = itertools.cycle([name for (name,) in catalog.db.execute(
+        "SELECT name FROM products WHERE id <= ? ORDER BY id", (STOCKED_PRODUCTS,))])
+    return lambda: server.purchase_product(None, connection, next(names), BUYER_ID, catalog.db)
+
+@benchmark("rate")
+def rate_call(catalog, connection):
+    product_ids = itertools.cycle(range(1, catalog.size + 1))
+    return lambda: server.rate(4, next(product_ids), catalog.db)
+
+@benchmark("receive_image", peer=upload_images)
+def receive_image_call(catalog, connection):
+    if takes(server.receive_image, "image_id"):
+        # Checkouts from before streamed uploads save straight to "<image_id>.jpg", here always the same file
+        def call():
+            if not server.receive_image(connection, 0):
+                raise RuntimeError("receive_image failed")
+        return call
+    def call():
+        result = server.receive_image(connection)
+        if result is None:
+            raise RuntimeError("receive_image failed")
+        server.discard_temp_file(result[0])
+    return call
+
+def time_calls(call, number):
+    """Seconds per call over number back-to-back calls, with the garbage collector off"""
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        return (time.perf_counter() - start) / number
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def peak_memory(call):
+    """Largest amount of memory allocated on top of what was live before a call, in bytes"""
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(MEMORY_CALLS):
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        return max(peaks)
+    finally:
+        tracemalloc.stop()
+
+def measure(call, samples, min_time, warmup):
+    """Time a call; returns the per-call samples and the calls timed in each"""
+    for _ in range(warmup):
+        call()
+    number = max(1, math.ceil(min_time / max(time_calls(call, 1), 1e-9)))
+    return [time_calls(call, number) for _ in range(samples)], number
+
+def run_benchmark(name, catalog, args):
+    make_call, peer_loop, columnar = BENCHMARKS[name]
+    if columnar and catalog.columnar is None:
+        return None
+    server.catalog = catalog.columnar if columnar else None
+    peer = Peer(peer_loop)
+    try:
+        call = make_call(catalog, peer.connection)
+        samples, number = measure(call, args.samples, args.min_time, args.warmup)
+        peak = peak_memory(call)
+    finally:
+        server.catalog = None
+        peer.close()
+    median = statistics.median(samples)
+    return {
+        "benchmark": name, "size": catalog.size, "samples": samples, "calls_per_sample": number,
+        "median": median, "mad": statistics.median(abs(sample - median) for sample in samples),
+        "min": min(samples), "peak_memory": peak,
+    }
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+def format_bytes(size):
+    for unit, scale in (("MiB", 1 << 20), ("KiB", 1 << 10)):
+        if size >= scale:
+            return f"{size / scale:.1f} {unit}"
+    return f"{size} B"
+
+def tree_revision(directory):
+    """git describe of the checkout the server was imported from, or None outside git"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=directory, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    server_dir = os.path.abspath(args.server_dir)
+    load_server(server_dir)
+    names = list(BENCHMARKS)
+    if args.only:
+        names = [name for name in names if name in args.only.split(",")]
+        if not names:
+            raise SystemExit(f"No benchmarks named {args.only}; choose from {', '.join(BENCHMARKS)}")
+    # Purchases and ratings publish catalog changes; something has to take them off the queue
+    if hasattr(server, "broadcast_pushes"):
+        threading.Thread(target=server.broadcast_pushes, daemon=True).start()
+    results = []
+    print(f"{'benchmark':<28} {'size':>7} {'median':>10} {'mad':>10} {'min':>10} {'calls':>6} {'peak mem':>10}")
+    for size in args.sizes:
+        catalog = Catalog(size, args.seed, args.keep)
+        try:
+            for name in names:
+                result = run_benchmark(name, catalog, args)
+                if result is None:
+                    continue
+                results.append(result)
+                print(f"{name:<28} {size:>7} {format_time(result['median']):>10} {format_time(result['mad']):>10} "
+                      f"{format_time(result['min']):>10} {result['calls_per_sample']:>6} {format_bytes(result['peak_memory']):>10}")
+        finally:
+            catalog.close()
+    if args.output:
+        report = {
+            "revision": tree_revision(server_dir), "python": platform.python_version(), "machine": platform.machine(),
+            "started": datetime.now().isoformat(timespec='seconds'), "seed": args.seed, "results": results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+        print(f"\nWrote {len(results)} results to {args.output}")
+
+def mann_whitney_p(a, b):
+    """Two-sided p-value of the Mann-Whitney U test, by the normal approximation with tie correction"""
+    n1, n2 = len(a), len(b)
+    values = sorted([(value, 0) for value in a] + [(value, 1) for value in b])
+    n = n1 + n2
+    rank_sum = 0.0
+    tie_term = 0
+    i = 0
+    while i < n:
+        j = i
+        while j < n and values[j][0] == values[i][0]:
+            j += 1
+        # Tied values share the average of the ranks they span
+        average_rank = (i + j + 1) / 2
+        rank_sum += average_rank * sum(1 for k in range(i, j) if values[k][1] == 0)
+        tie_term += (j - i) ** 3 - (j - i)
+        i = j
+    u = rank_sum - n1 * (n1 + 1) / 2
+    mean = n1 * n2 / 2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = max(abs(u - mean) - 0.5, 0) / math.sqrt(variance)
+    return math.erfc(z / math.sqrt(2))
+
+def compare(args):
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"base {base.get('revision') or args.base}, new {new.get('revision') or args.new}\n")
+    base_results = {(result["benchmark"], result["size"]): result for result in base["results"]}
+    new_results = {(result["benchmark"], result["size"]): result for result in new["results"]}
+    regressions = 0
+    print(f"{'benchmark':<28} {'size':>7} {'base':>10} {'new':>10} {'change':>8} {'p':>8} {'memory':>8}")
+    for key in sorted(base_results.keys() & new_results.keys()):
+        before, after = base_results[key], new_results[key]
+        change = after["median"] / before["median"] - 1
+        p = mann_whitney_p(before["samples"], after["samples"])
+        memory_change = after["peak_memory"] / before["peak_memory"] - 1 if before["peak_memory"] else 0.0
+        verdict = ""
+        if p < SIGNIFICANCE and change > args.threshold:
+            verdict = "REGRESSION"
+            regressions += 1
+        elif p < SIGNIFICANCE and change < -args.threshold:
+            verdict = "faster"
+        if memory_change > args.threshold:
+            verdict = (verdict + " more memory").strip()
+        print(f"{key[0]:<28} {key[1]:>7} {format_time(before['median']):>10} {format_time(after['median']):>10} "
+              f"{change:>+8.1%} {p:>8.4f} {memory_change:>+8.1%}  {verdict}")
+    for label, only in (("base", base_results.keys() - new_results.keys()), ("new", new_results.keys() - base_results.keys())):
+        for name, size in sorted(only):
+            print(f"Only in {label}: {name} at size {size}")
+    print(f"\n{regressions} regression{'s' if regressions != 1 else ''} over {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+def sizes(text):
+    try:
+        values = [int(size) for size in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("sizes must be comma-separated integers")
+    if any(size < 1 for size in values):
+        raise argparse.ArgumentTypeError("sizes must be positive")
+    return values
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark individual server handlers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="benchmark the handlers at several catalog sizes")
+    run_parser.add_argument("--sizes", type=sizes, default=list(DEFAULT_SIZES), help="comma-separated product counts")
+    run_parser.add_argument("--only", help="comma-separated benchmark names to run")
+    run_parser.add_argument("--samples", type=int, default=20, help="timed samples per benchmark; compare needs 6 or more to call a change significant")
+    run_parser.add_argument("--min-time", type=float, default=0.02, help="shortest sample, in seconds")
+    run_parser.add_argument("--warmup", type=int, default=2, help="untimed calls before sampling")
+    run_parser.add_argument("--seed", type=int, default=SEED)
+    run_parser.add_argument("--server-dir", default=os.path.dirname(os.path.abspath(__file__)),
+                            help="checkout to import server.py from")
+    run_parser.add_argument("--output", help="write the results as JSON, for compare")
+    run_parser.add_argument("--keep", action="store_true", help="keep the temp databases")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.05,
+                                help="slowdown of the median that counts as a regression, as a fraction")
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        return compare(args)
+    if args.samples < 2:
+        parser.error("--samples must be at least 2")
+    run(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
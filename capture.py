@@ -0,0 +1,163 @@
+"""Traffic capture for replay.py.
+
+With capture on, every client connection gets a ConnectionCapture that sees
+the bytes handle_client reads from the socket and the bytes the server sends
+back. The file is JSON lines. After a header, there is one record per
+exchange: what arrived and what the server sent before the next arrival.
+
+    {"c": 3, "t": 12.5031, "in": {"d": "{\\"command\\": \\"search\\", ...}"}, "out": {"d": "[...]"}, "ms": 1.83}
+    {"c": 3, "t": 12.6112, "in": {"h": "9f86d081884c7d65", "n": 8192}, "out": {"d": "PROGRESS:50.00"}, "ms": 0.41}
+    {"c": 3, "t": 14.0020, "close": true}
+
+Bytes sent to a connection by other threads (presence and catalog pushes,
+purchase notifications) are not part of any reply; they are only counted in
+the "push" field of the exchange they arrived during.
+
+Text is kept as is, except passwords, which are replaced by a salted digest
+that stays consistent within one capture. Binary payloads (image data) and
+long replies are stored only as a truncated SHA-256 plus their size.
+"""
+import hashlib
+import itertools
+import json
+import secrets
+import threading
+import time
+from datetime import datetime
+
+# Replies up to this many bytes are stored verbatim; longer ones as hash and size
+OUT_TEXT_LIMIT = 512
+# Hex digits of SHA-256 kept for hashed payloads
+HASH_DIGITS = 16
+# Seconds between flushes of the capture file
+FLUSH_INTERVAL = 1.0
+
+def as_text(data):
+    """Return data as a string if it is UTF-8 text, otherwise None"""
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return text if "\x00" not in text else None
+
+class TrafficCapture:
+    """One capture file shared by all connections"""
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8', buffering=1 << 16)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last_flush = self.start
+        self.ids = itertools.count(1)
+        # Passwords are replaced by salted digests; the salt never leaves this process
+        self.salt = secrets.token_bytes(16)
+        self.write({"capture": 1, "started": datetime.now().isoformat(timespec='seconds')})
+
+    def connection(self):
+        """Start recording a new client connection"""
+        return ConnectionCapture(self, next(self.ids))
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def redact(self, text):
+        """Replace the password of a JSON command with a stable salted digest"""
+        try:
+            message, end = json.JSONDecoder().raw_decode(text)
+        except ValueError:
+            return text
+        if not isinstance(message, dict) or not isinstance(message.get("password"), str):
+            return text
+        digest = hashlib.sha256(self.salt + message["password"].encode('utf-8')).hexdigest()[:HASH_DIGITS]
+        message["password"] = f"redacted-{digest}"
+        return json.dumps(message) + text[end:]
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self.lock:
+            self.file.write(line)
+            if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+class ConnectionCapture:
+    """The exchange being recorded on one connection.
+
+    Consecutive reads of the same kind (text or binary) with no reply in
+    between are merged into one record, so a command split across segments,
+    or an image sent in one burst, takes a single line.
+    """
+    def __init__(self, capture, connection_id):
+        self.capture = capture
+        self.id = connection_id
+        # The connection's handler thread; what other threads send is a push
+        self.thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.started = None
+
+    def begin(self, text):
+        self.started = self.capture.now()
+        self.in_text = [] if text else None
+        self.in_hash = hashlib.sha256()
+        self.in_size = 0
+        self.out_hash = hashlib.sha256()
+        self.out_size = 0
+        self.out_head = bytearray()
+        self.last_out = None
+        self.pushed = 0
+
+    def inbound(self, data):
+        """Record bytes read from the client"""
+        text = as_text(data)
+        with self.lock:
+            same_kind = self.started is not None and (text is not None) == (self.in_text is not None)
+            if not (same_kind and self.out_size == 0):
+                self.finish()
+                self.begin(text is not None)
+            if text is not None:
+                self.in_text.append(text)
+            self.in_hash.update(data)
+            self.in_size += len(data)
+
+    def outbound(self, data):
+        """Record bytes sent to the client, including pushes from other threads"""
+        with self.lock:
+            if self.started is None:
+                # The server spoke first (for example a busy reply)
+                self.begin(True)
+            if threading.get_ident() != self.thread:
+                self.pushed += len(data)
+                return
+            self.out_hash.update(data)
+            self.out_size += len(data)
+            if len(self.out_head) <= OUT_TEXT_LIMIT:
+                self.out_head += data[:OUT_TEXT_LIMIT + 1 - len(self.out_head)]
+            self.last_out = self.capture.now()
+
+    def finish(self):
+        """Write the current exchange, if any (caller holds the lock)"""
+        if self.started is None:
+            return
+        record = {"c": self.id, "t": round(self.started, 4)}
+        if self.in_text is not None:
+            record["in"] = {"d": self.capture.redact("".join(self.in_text))}
+        else:
+            record["in"] = {"h": self.in_hash.hexdigest()[:HASH_DIGITS], "n": self.in_size}
+        if self.out_size:
+            text = as_text(bytes(self.out_head)) if self.out_size <= OUT_TEXT_LIMIT else None
+            record["out"] = {"d": text} if text is not None else {"h": self.out_hash.hexdigest()[:HASH_DIGITS], "n": self.out_size}
+            record["ms"] = round((self.last_out - self.started) * 1000, 3)
+        if self.pushed:
+            record["push"] = self.pushed
+        self.capture.write(record)
+        self.started = None
+
+    def close(self):
+        """Write the last exchange and mark the connection closed"""
+        with self.lock:
+            self.finish()
+            self.capture.write({"c": self.id, "t": round(self.capture.now(), 4), "close": True})
+        self.capture.flush()
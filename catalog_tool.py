@@ -0,0 +1,303 @@
+"""Bulk import/export of the botique.db catalog.
+
+Usage:
+    python catalog_tool.py import --users users.jsonl --products products.csv --images-dir images/
+    python catalog_tool.py export --users users.jsonl --products products.csv --images-dir images/
+
+Files are CSV or JSONL, picked by extension. Rows are streamed in batches in
+both directions, so catalogs with millions of products never have to fit in
+memory. Images go through the same store the server uses (--image-storage
+matches its IMAGE_STORAGE), and products with a buyer_id get ledger rows.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+
+import image_storage
+from schema import create_Tables
+
+USER_COLUMNS = ["id", "username", "email", "password", "name"]
+PRODUCT_COLUMNS = ["id", "owner_id", "name", "price", "description", "image", "amount",
+                   "rating", "num_raters", "buyer_id", "status"]
+# Converters applied to text fields (CSV gives everything as strings)
+PRODUCT_TYPES = {"id": int, "owner_id": int, "price": float, "amount": int, "rating": float,
+                 "num_raters": int, "buyer_id": int}
+USER_TYPES = {"id": int}
+
+def file_format(path, forced=None):
+    """Return 'csv' or 'jsonl' for a data file"""
+    if forced:
+        return forced
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+def read_rows(path, fmt):
+    """Yield one dict per row of a CSV or JSONL file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def convert(row, columns, types):
+    """Keep known columns and convert their types; empty fields become NULL"""
+    values = {}
+    for column in columns:
+        value = row.get(column)
+        if value == "" or value is None:
+            values[column] = None
+        elif column in types and not isinstance(value, types[column]):
+            values[column] = types[column](value)
+        else:
+            values[column] = value
+    return values
+
+def batches(rows, size):
+    """Group an iterator into lists of at most size items"""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def tune_for_load(db):
+    """Switch to fast, non-durable settings for the load; returns the old settings"""
+    previous = {
+        "journal_mode": db.execute("PRAGMA journal_mode").fetchone()[0],
+        "synchronous": db.execute("PRAGMA synchronous").fetchone()[0],
+    }
+    db.execute("PRAGMA journal_mode=MEMORY")
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute("PRAGMA cache_size=-200000")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA foreign_keys=OFF")
+    return previous
+
+def restore_settings(db, previous):
+    """Put back the durability settings saved by tune_for_load"""
+    db.execute(f"PRAGMA journal_mode={previous['journal_mode']}")
+    db.execute(f"PRAGMA synchronous={previous['synchronous']}")
+
+def open_image_store(kind, image_dir):
+    """The image store for an IMAGE_STORAGE setting: "fs" files in image_dir, or "sqlite" rows"""
+    if kind == "sqlite":
+        if not image_storage.blob_io_available():
+            raise SystemExit("--image-storage sqlite needs Python 3.11+ for Connection.blobopen")
+        return image_storage.SQLiteImageStore()
+    return image_storage.FileImageStore(image_dir)
+
+def drop_indexes(db, tables):
+    """Drop user-defined indexes on the tables; returns their SQL to rebuild later"""
+    placeholders = ",".join("?" for _ in tables)
+    indexes = db.execute(f"""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})
+    """, tables).fetchall()
+    for name, _ in indexes:
+        db.execute(f'DROP INDEX "{name}"')
+    return [sql for _, sql in indexes]
+
+def next_id(db, table):
+    """Return the next AUTOINCREMENT id for a table"""
+    seq = db.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0)", (table,)).fetchone()[0]
+    max_id = db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    return max(seq, max_id) + 1
+
+def import_users(db, path, fmt, batch_size):
+    """Stream users into the database; passwords must already be bcrypt hashes"""
+    total = 0
+    for batch in batches(read_rows(path, fmt), batch_size):
+        rows = []
+        for row in batch:
+            user = convert(row, USER_COLUMNS, USER_TYPES)
+            if isinstance(user["password"], str):
+                user["password"] = user["password"].encode('utf-8')
+            rows.append(tuple(user[column] for column in USER_COLUMNS))
+        with db:
+            db.executemany(f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES (?, ?, ?, ?, ?)", rows)
+        total += len(rows)
+        print(f"users: {total} imported")
+    return total
+
+def store_image(db, store, image_dir, source, product_id):
+    """Copy an image file into the store as a product's image; returns its name"""
+    fd, temp_path = tempfile.mkstemp(dir=image_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as f, open(source, 'rb') as image:
+            shutil.copyfileobj(image, f, image_storage.CHUNK_SIZE)
+        return store.store(db, temp_path, product_id)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def record_orders(db, products):
+    """Add ledger rows and seller totals for imported products that name a buyer"""
+    created_at = datetime.now().isoformat(timespec='seconds')
+    orders = [(product["id"], product["buyer_id"], product["owner_id"], product["price"], created_at)
+              for product in products if product["buyer_id"] is not None]
+    db.executemany("INSERT INTO orders (product_id, buyer_id, seller_id, price, created_at) VALUES (?, ?, ?, ?, ?)",
+                   orders)
+    db.executemany("""
+        INSERT INTO seller_stats (seller_id, orders, revenue) VALUES (?, 1, ?)
+        ON CONFLICT(seller_id) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue""",
+        [(seller_id, price or 0) for _, _, seller_id, price, _ in orders])
+
+def import_products(db, path, fmt, batch_size, images_dir, store, image_dir):
+    """Stream products into the database, putting their images in the store"""
+    total = 0
+    os.makedirs(image_dir, exist_ok=True)
+    for batch in batches(read_rows(path, fmt), batch_size):
+        with db:
+            product_id = next_id(db, "products")
+            products = []
+            for row in batch:
+                product = convert(row, PRODUCT_COLUMNS, PRODUCT_TYPES)
+                if product["id"] is None:
+                    product["id"] = product_id
+                product_id = max(product_id, product["id"]) + 1
+                product["status"] = product["status"] or "available"
+                product["rating"] = product["rating"] or 0
+                product["num_raters"] = product["num_raters"] or 0
+                source = product["image"]
+                if source and images_dir:
+                    product["image"] = store_image(db, store, image_dir, os.path.join(images_dir, source), product["id"])
+                products.append(product)
+            placeholders = ", ".join("?" for _ in PRODUCT_COLUMNS)
+            db.executemany(f"INSERT INTO products ({', '.join(PRODUCT_COLUMNS)}) VALUES ({placeholders})",
+                           [tuple(product[column] for column in PRODUCT_COLUMNS) for product in products])
+            record_orders(db, products)
+            store.sync()
+        total += len(products)
+        print(f"products: {total} imported")
+    return total
+
+def run_import(args):
+    store = open_image_store(args.image_storage, args.image_dir)
+    create_Tables(args.db)
+    db = sqlite3.connect(args.db)
+    previous = tune_for_load(db)
+    index_sql = drop_indexes(db, ["users", "products", "orders"])
+    db.commit()
+    try:
+        if args.users:
+            import_users(db, args.users, file_format(args.users, args.format), args.batch_size)
+        if args.products:
+            import_products(db, args.products, file_format(args.products, args.format), args.batch_size,
+                            args.images_dir, store, args.image_dir)
+    finally:
+        # Build indexes once over the loaded data instead of row by row
+        for sql in index_sql:
+            db.execute(sql)
+        db.commit()
+        restore_settings(db, previous)
+        db.close()
+
+def write_rows(path, fmt, columns, cursor, batch_size, transform=None):
+    """Stream a query result to a CSV or JSONL file with fetchmany"""
+    total = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = None
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                record = dict(zip(columns, row))
+                if transform:
+                    transform(record)
+                if writer:
+                    writer.writerow([record[column] for column in columns])
+                else:
+                    f.write(json.dumps(record) + "\n")
+            total += len(rows)
+            print(f"{os.path.basename(path)}: {total} exported")
+    return total
+
+def export_password(record):
+    """bcrypt hashes are stored as bytes; write them as text"""
+    if isinstance(record["password"], bytes):
+        record["password"] = record["password"].decode('utf-8')
+
+def copy_image(db, store, images_dir):
+    """Return a row transform that copies each product's image out of the store into images_dir"""
+    def transform(record):
+        image = record["image"]
+        if isinstance(image, bytes):
+            image = record["image"] = image.decode('utf-8')
+        if not image:
+            return
+        opened = store.open(db, record["id"])
+        if opened is None:
+            return
+        _, stream = opened
+        with stream, open(os.path.join(images_dir, image), 'wb') as f:
+            for chunk in iter(lambda: stream.read(image_storage.CHUNK_SIZE), b''):
+                f.write(chunk)
+    return transform
+
+def run_export(args):
+    db = sqlite3.connect(args.db)
+    try:
+        if args.users:
+            cursor = db.execute(f"SELECT {', '.join(USER_COLUMNS)} FROM users ORDER BY id")
+            write_rows(args.users, file_format(args.users, args.format), USER_COLUMNS, cursor, args.batch_size, export_password)
+        if args.products:
+            transform = None
+            if args.images_dir:
+                os.makedirs(args.images_dir, exist_ok=True)
+                transform = copy_image(db, open_image_store(args.image_storage, args.image_dir), args.images_dir)
+            cursor = db.execute(f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products ORDER BY id")
+            write_rows(args.products, file_format(args.products, args.format), PRODUCT_COLUMNS, cursor, args.batch_size, transform)
+    finally:
+        db.close()
+
+def shard_count(path):
+    """How many files the server split a database's catalog into (1 if it never did)"""
+    if not os.path.exists(path):
+        return 1
+    db = sqlite3.connect(path)
+    try:
+        row = db.execute("SELECT shard_count FROM shard_layout").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        db.close()
+    return row[0] if row else 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import/export of the botique.db catalog")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("--db", default="botique.db", help="database file (default: botique.db)")
+    parser.add_argument("--users", help="users file (.csv or .jsonl)")
+    parser.add_argument("--products", help="products file (.csv or .jsonl)")
+    parser.add_argument("--images-dir", help="directory of image files named by the 'image' column")
+    parser.add_argument("--image-storage", choices=["fs", "sqlite"], default="fs",
+                        help="where the server keeps images, as its IMAGE_STORAGE setting (default: fs)")
+    parser.add_argument("--image-dir", default="product_images",
+                        help="the server's IMAGE_DIR, for fs storage and upload temp files (default: product_images)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="override the format picked from the file extension")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per executemany/fetchmany batch")
+    args = parser.parse_args(argv)
+    if not args.users and not args.products:
+        parser.error("give --users and/or --products")
+    if args.products and shard_count(args.db) > 1:
+        parser.error(f"{args.db} keeps its products in {shard_count(args.db)} shard files; only unsharded catalogs are supported")
+    if args.action == "import":
+        run_import(args)
+    else:
+        run_export(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
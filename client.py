@@ -3,6 +3,316 @@ import os
 import threading
 import json
 import random
+import hashlib
+import time
+import queue
+import functools
+import codecs
+import collections
+import selectors
+import struct
+import http.client
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# How many times send_image reconnects and resumes an interrupted upload
+UPLOAD_RETRIES = 5
+# Default number of extra connections opened by Client.open_pool
+POOL_SIZE = 4
+# How many times request() retries a command the server shed as busy
+BUSY_RETRIES = 3
+# Most products sent in one sell_batch command (the server's MAX_BATCH_ITEMS)
+BATCH_SIZE = 200
+# Seconds any single send or receive on the server connection may block
+REQUEST_TIMEOUT = 30
+# Seconds of silence after which the client pings the server to keep its session
+HEARTBEAT_INTERVAL = 60
+# Most peer connections kept open for reuse; the least recently used is closed past this
+MAX_PEER_CONNECTIONS = 32
+# Largest P2P frame accepted from a peer, in bytes
+MAX_PEER_FRAME = 64 * 1024
+# Seconds to wait when opening a connection to a peer
+PEER_CONNECT_TIMEOUT = 5
+# Seconds a cached peer address is trusted; presence pushes drop entries sooner
+PEER_ADDRESS_TTL = 300
+
+def exclusive(method):
+    """Run a Client method while holding the connection lock.
+
+    The heartbeat thread takes the same lock, so a ping never interleaves
+    with a request and its reply.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.io_lock:
+            try:
+                self.finish_stream()
+                return method(self, *args, **kwargs)
+            finally:
+                self.last_activity = time.monotonic()
+    return wrapper
+
+def stream_ended(frame):
+    """True for the last frame of a streamed reply"""
+    return "error" in frame or bool(frame.get("done"))
+
+def format_price(item):
+    """An item's price for display, with the currency code the server priced it in"""
+    if item.get('currency'):
+        return f"{item['price']} {item['currency']}"
+    return f"${item['price']}"
+
+def encode_frame(payload):
+    """Length-prefix a JSON payload for the P2P wire"""
+    data = json.dumps(payload).encode('utf-8')
+    return struct.pack("!I", len(data)) + data
+
+class PeerConnection:
+    """One framed connection to another user, opened by either side"""
+    def __init__(self, sock, username=None):
+        self.sock = sock
+        self.username = username
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.registered = False
+        self.close_when_flushed = False
+
+class PeerHub:
+    """All P2P chat traffic of one client, multiplexed on a single selector thread.
+
+    Messages are length-prefixed JSON frames. Every connection opens with a hello
+    naming its sender, so connections in both directions are cached by peer
+    username in a bounded LRU and reused for later messages either way. Other
+    threads only queue output and wake the selector; all socket I/O happens on
+    the hub thread.
+    """
+    def __init__(self, ip, port, username, resolve, on_message, max_peers=MAX_PEER_CONNECTIONS):
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.resolve = resolve
+        self.on_message = on_message
+        self.max_peers = max_peers
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.peers = OrderedDict()
+        self.pending = set()
+        self.closing = []
+        self.running = False
+        self.listener = None
+        self.waker_r, self.waker_w = socket.socketpair()
+
+    def start(self):
+        """Open the P2P listening socket and start the hub thread"""
+        try:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((self.ip, self.port))
+            self.listener.listen(100)
+        except socket.error as e:
+            print(f"Error setting up P2P server: {e}")
+            return False
+        self.listener.setblocking(False)
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.selector.register(self.waker_r, selectors.EVENT_READ, self)
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+        print(f"P2P server listening on port {self.port}...")
+        return True
+
+    def stop(self):
+        """Close every peer connection and stop the hub thread"""
+        self.running = False
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def send(self, username, text):
+        """Queue a chat message to a user, connecting to them first if needed"""
+        with self.lock:
+            conn = self.peers.get(username)
+            if conn:
+                self.peers.move_to_end(username)
+        if conn is None:
+            conn = self.connect(username)
+            if conn is None:
+                return False
+        with self.lock:
+            conn.outbox += encode_frame({"type": "message", "from": self.username, "message": text})
+            self.pending.add(conn)
+        self.wake()
+        return True
+
+    def close_peer(self, username):
+        """Close the cached connection to a user, if any"""
+        with self.lock:
+            conn = self.peers.pop(username, None)
+            if conn:
+                self.closing.append(conn)
+        self.wake()
+
+    def connect(self, username):
+        """Open a connection to a user, looking up their address on the server"""
+        ip, port = self.resolve(username)
+        if not ip or not port:
+            print("Could not retrieve peer's IP and port.")
+            return None
+        try:
+            sock = socket.create_connection((ip, port), timeout=PEER_CONNECT_TIMEOUT)
+        except socket.error as e:
+            print(f"Error connecting to peer: {e}")
+            return None
+        sock.setblocking(False)
+        conn = PeerConnection(sock, username)
+        conn.outbox += encode_frame({"type": "hello", "from": self.username})
+        with self.lock:
+            existing = self.peers.get(username)
+            if existing:
+                # Another thread connected to the same peer first
+                sock.close()
+                return existing
+            self.remember(conn)
+            self.pending.add(conn)
+        return conn
+
+    def remember(self, conn):
+        """Cache a connection under its peer's name, evicting the least recently used.
+
+        Must be called with the lock held.
+        """
+        previous = self.peers.pop(conn.username, None)
+        if previous is not None and previous is not conn:
+            self.closing.append(previous)
+        self.peers[conn.username] = conn
+        while len(self.peers) > self.max_peers:
+            _, evicted = self.peers.popitem(last=False)
+            self.closing.append(evicted)
+
+    def run(self):
+        while self.running:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    self.accept()
+                elif key.data is self:
+                    self.drain_waker()
+                else:
+                    self.service(key.data, mask)
+            self.apply_pending()
+        for conn in list(self.peers.values()) + self.closing:
+            self.drop(conn)
+        self.selector.close()
+        self.listener.close()
+
+    def accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except (BlockingIOError, OSError):
+            return
+        sock.setblocking(False)
+        conn = PeerConnection(sock)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        conn.registered = True
+
+    def drain_waker(self):
+        try:
+            while self.waker_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def apply_pending(self):
+        """Register new connections, watch for writability and close evicted ones"""
+        with self.lock:
+            pending, self.pending = self.pending, set()
+            closing, self.closing = self.closing, []
+        for conn in closing:
+            with self.lock:
+                flushing = bool(conn.outbox)
+            if flushing and conn.sock.fileno() != -1:
+                # Let queued messages go out before the connection is closed
+                conn.close_when_flushed = True
+                pending.add(conn)
+            else:
+                self.drop(conn)
+        for conn in pending:
+            if conn.sock.fileno() == -1:
+                continue
+            with self.lock:
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outbox else 0)
+            if conn.registered:
+                self.selector.modify(conn.sock, events, conn)
+            else:
+                self.selector.register(conn.sock, events, conn)
+                conn.registered = True
+
+    def service(self, conn, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(65536)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b""
+            if data == b"" or (data and not self.read_frames(conn, data)):
+                self.drop(conn)
+                return
+        if mask & selectors.EVENT_WRITE:
+            with self.lock:
+                try:
+                    sent = conn.sock.send(conn.outbox)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    sent = None
+                if sent is not None:
+                    del conn.outbox[:sent]
+                    flushed = not conn.outbox
+            if sent is None or (flushed and conn.close_when_flushed):
+                self.drop(conn)
+            elif flushed:
+                self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def read_frames(self, conn, data):
+        """Handle every complete frame received; returns False if the peer sent garbage"""
+        conn.inbox += data
+        while len(conn.inbox) >= 4:
+            (length,) = struct.unpack("!I", conn.inbox[:4])
+            if length > MAX_PEER_FRAME:
+                return False
+            if len(conn.inbox) < 4 + length:
+                break
+            try:
+                payload = json.loads(conn.inbox[4:4 + length])
+            except ValueError:
+                return False
+            del conn.inbox[:4 + length]
+            if payload.get("type") == "hello" and payload.get("from"):
+                conn.username = payload["from"]
+                with self.lock:
+                    self.remember(conn)
+            elif payload.get("type") == "message":
+                with self.lock:
+                    if self.peers.get(conn.username) is conn:
+                        self.peers.move_to_end(conn.username)
+                self.on_message(conn.username or payload.get("from"), payload.get("message"))
+        return True
+
+    def drop(self, conn):
+        if conn.sock.fileno() == -1:
+            return
+        with self.lock:
+            if self.peers.get(conn.username) is conn:
+                del self.peers[conn.username]
+        if conn.registered:
+            self.selector.unregister(conn.sock)
+            conn.registered = False
+        conn.sock.close()
 
 class Client:
     """Client class for handling socket communication with server"""
@@ -14,9 +324,50 @@ class Client:
         #self.peer_socket=None
         self.p2p_server_socket =None
         self.p2p_server_port= self.random_port()
+        self.hub = None
+        # username -> (ip, port, expiry) for peers we have looked up
+        self.peer_addresses = {}
+        self.peer_addresses_lock = threading.Lock()
+        self.presence_socket = None
+        # Catalog feed position: last sequence number seen and the server run it belongs to
+        self.catalog_socket = None
+        self.catalog_seq = None
+        self.catalog_epoch = None
+        self.catalog_following = False
+        self.catalog_handler = self.on_catalog_change
+        self.next_orders_page = None
+        # Server's HTTP image endpoint, if it has one: port, session token and a kept-alive connection
+        self.image_port = None
+        self.image_token = None
+        self.image_http = None
+        self.image_etags = {}
+        self.image_lock = threading.Lock()
         self.id = None
+        self.username = None
+        # Session token from login, for attaching a new connection after the old one dropped
+        self.session_token = None
         self.server_port = server_port
-        self.budget = float('inf')
+        # Pooled connections share their parent's budget
+        self.parent = None
+        self._budget = float('inf')
+        self.budget_lock = threading.Lock()
+        self.pool = None
+        self.executor = None
+        self.io_lock = threading.RLock()
+        self.last_activity = time.monotonic()
+        # (frames, frames read ahead) of a stream_query whose reader is between frames
+        self.open_stream = None
+
+    @property
+    def budget(self):
+        return self.parent.budget if self.parent else self._budget
+
+    @budget.setter
+    def budget(self, value):
+        if self.parent:
+            self.parent.budget = value
+        else:
+            self._budget = value
 
 
     def random_port(self):
@@ -34,10 +385,28 @@ class Client:
         """Establish socket connection to server"""
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.client_socket.settimeout(REQUEST_TIMEOUT)
             self.client_socket.connect(("localhost", self.server_port))
         except socket.error as e:
             print(f"Error connecting to server: {e}")
 
+    def reconnect(self):
+        """Replace a dropped server connection with a new one attached to the same login.
+
+        The main connection also takes back notifications and chat, as after
+        login; a pooled one only attaches.
+        """
+        self.start_connection()
+        if not self.session_token:
+            return
+        message = {"command": "resume_session", "token": self.session_token}
+        if not self.parent:
+            message.update(ip=self.ip, port=self.p2p_server_port)
+        response = self.request(message)
+        if response.get("status") != "ok":
+            raise ValueError(response.get("message", "Could not resume the session"))
+
+    @exclusive
     def login(self, username, password):
         """Send login request to server"""
         try:
@@ -45,13 +414,232 @@ class Client:
             message_json = json.dumps(message)
             self.client_socket.send(message_json.encode('utf-8'))
             response = self.client_socket.recv(1024).decode('utf-8')
-            self.id = self.client_socket.recv(1024).decode('utf-8')
-            threading.Thread(target=self.p2p_serverside, daemon=True).start() # give self as arg??
-            return response
+            welcome = f"Login successful.\nWelcome {username}"
+            if not response.startswith(welcome):
+                return response
+            # The user ID is sent right after the welcome and may share its segment
+            self.id = response[len(welcome):] or self.client_socket.recv(1024).decode('utf-8')
+            self.username = username
+            token = self.request({"command": "issue_token"})
+            self.session_token = token.get("token") if token.get("status") == "ok" else None
+            self.start_p2p()
+            self.subscribe_presence()
+            self.start_heartbeat()
+            self.open_image_channel()
+            return welcome
         except socket.error as e:
             print(f"Error during login: {e}")
             return "Error during login."
 
+    @exclusive
+    def open_pool(self, size=POOL_SIZE):
+        """Open extra authenticated connections for running operations concurrently.
+
+        The pool connections attach to the current login with a session token, so
+        no password is resent. Use submit() to run Client methods on them.
+        """
+        if self.executor:
+            return True
+        try:
+            response = self.request({"command": "issue_token"})
+            if response.get("status") != "ok":
+                print(f"Could not open connection pool: {response.get('message')}")
+                return False
+            token = response["token"]
+            self.pool = queue.Queue()
+            for _ in range(size):
+                self.pool.put(self.spawn_connection(token))
+        except (socket.error, ValueError) as e:
+            print(f"Could not open connection pool: {e}")
+            self.close_pool()
+            return False
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        return True
+
+    def spawn_connection(self, token):
+        """Open one more server connection attached to this login"""
+        conn = Client(self.server_port, None)
+        conn.parent = self
+        conn.id = self.id
+        conn.username = self.username
+        conn.session_token = token
+        conn.start_connection()
+        response = conn.request({"command": "resume_session", "token": token})
+        if response.get("status") != "ok":
+            conn.client_socket.close()
+            raise ValueError(response.get("message", "Could not attach connection"))
+        return conn
+
+    def close_pool(self):
+        """Wait for pooled operations to finish and close the pool connections"""
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        while self.pool and not self.pool.empty():
+            conn = self.pool.get()
+            try:
+                conn.client_socket.close()
+            except socket.error:
+                pass
+        self.pool = None
+
+    def submit(self, method_name, *args, callback=None, **kwargs):
+        """Run a Client method on a pooled connection and return a Future.
+
+        If callback is given it is called with the method's result on completion.
+        Requires open_pool() to have been called.
+        """
+        if not self.executor:
+            raise RuntimeError("Connection pool is not open. Call open_pool() first.")
+        future = self.executor.submit(self.run_pooled, method_name, args, kwargs)
+        if callback:
+            future.add_done_callback(lambda f: f.exception() is None and callback(f.result()))
+        return future
+
+    def run_pooled(self, method_name, args, kwargs):
+        """Check a connection out of the pool, run one method on it and return it"""
+        conn = self.pool.get()
+        try:
+            return getattr(conn, method_name)(*args, **kwargs)
+        finally:
+            self.pool.put(conn)
+
+    @exclusive
+    def get_image(self, product_id, save_path):
+        """Download one product image"""
+        try:
+            message = {"command": "get_image", "product_id": product_id}
+            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            return self.receive_image(save_path)
+        except socket.error as e:
+            print(f"Error downloading image: {e}")
+            return False
+
+    def open_image_channel(self):
+        """Fetch images over the server's HTTP image endpoint from now on, if it has one"""
+        try:
+            response = self.request({"command": "image_endpoint"})
+            if response.get("status") != "ok":
+                return False
+            token = self.request({"command": "issue_token"})
+            if token.get("status") != "ok":
+                return False
+        except (socket.error, ValueError) as e:
+            print(f"Image endpoint unavailable: {e}")
+            return False
+        self.image_port = response["port"]
+        self.image_token = token["token"]
+        return True
+
+    def close_image_channel(self):
+        """Stop using the HTTP image endpoint"""
+        with self.image_lock:
+            if self.image_http:
+                self.image_http.close()
+            self.image_http = None
+            self.image_port = None
+            self.image_token = None
+
+    def images_out_of_band(self):
+        """True if listings should leave images out and let download_images fetch them"""
+        return bool(self.image_port or self.executor)
+
+    def fetch_image(self, product_id, save_path):
+        """Download one image over the HTTP image endpoint.
+
+        A copy saved earlier is revalidated with its ETag instead of downloaded
+        again, and a partial ".part" file left by an interrupted download is
+        resumed with a Range request. Returns True once save_path holds the image.
+        """
+        with self.image_lock:
+            for attempt in range(2):
+                if self.image_http is None:
+                    self.image_http = http.client.HTTPConnection("localhost", self.image_port, timeout=REQUEST_TIMEOUT)
+                try:
+                    return self.get_image_http(product_id, save_path)
+                except (http.client.HTTPException, OSError) as e:
+                    # The kept-alive connection may have been closed by the server; retry once on a new one
+                    self.image_http.close()
+                    self.image_http = None
+                    if attempt:
+                        print(f"Error downloading image: {e}")
+            return False
+
+    def get_image_http(self, product_id, save_path):
+        """One GET on the kept-alive image connection; see fetch_image"""
+        part_path = save_path + ".part"
+        headers = {"Authorization": f"Bearer {self.image_token}"}
+        etag = self.image_etags.get(product_id)
+        if etag and os.path.exists(save_path):
+            headers["If-None-Match"] = etag
+        elif etag and os.path.exists(part_path):
+            headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+            headers["If-Range"] = etag
+        self.image_http.request("GET", f"/images/{product_id}", headers=headers)
+        response = self.image_http.getresponse()
+        if response.status == 304:
+            response.read()
+            return True
+        if response.status not in (200, 206):
+            print(f"Server error: {response.status} {response.read().decode('utf-8', errors='replace')}")
+            return False
+        self.image_etags[product_id] = response.getheader("ETag")
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        with open(part_path, 'ab' if response.status == 206 else 'wb') as f:
+            for chunk in iter(lambda: response.read(65536), b''):
+                f.write(chunk)
+        if response.length:
+            # The server closed the connection mid-image; what arrived stays in the .part file
+            raise http.client.IncompleteRead(b'', response.length)
+        os.replace(part_path, save_path)
+        return True
+
+    def download_images(self, product_ids, directory="received_images"):
+        """Download several product images, over the HTTP image endpoint or in parallel over the pool.
+
+        Returns a list of saved paths (None where a download failed), in order.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, f"{product_id}.jpg") for product_id in product_ids]
+        if self.image_port:
+            return [path if self.fetch_image(product_id, path) else None for product_id, path in zip(product_ids, paths)]
+        futures = [self.submit("get_image", product_id, path) for product_id, path in zip(product_ids, paths)]
+        return [path if future.result() else None for path, future in zip(paths, futures)]
+
+    @exclusive
+    def ping(self):
+        """Send an application-level heartbeat; returns True if the server answered"""
+        try:
+            return self.request({"command": "ping"}).get("status") == "pong"
+        except (socket.error, ValueError) as e:
+            print(f"Heartbeat failed: {e}")
+            return False
+
+    def start_heartbeat(self, interval=HEARTBEAT_INTERVAL):
+        """Keep this login (and any pooled connections) alive while idle"""
+        threading.Thread(target=self.heartbeat_loop, args=(interval,), daemon=True).start()
+
+    def heartbeat_loop(self, interval):
+        while self.client_socket:
+            time.sleep(interval / 2)
+            if not self.client_socket:
+                break
+            if time.monotonic() - self.last_activity >= interval:
+                self.ping()
+            # Ping pooled connections that are idle right now; busy ones are in use anyway
+            pool = self.pool
+            for _ in range(pool.qsize() if pool else 0):
+                try:
+                    conn = pool.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if time.monotonic() - conn.last_activity >= interval:
+                        conn.ping()
+                finally:
+                    pool.put(conn)
+
+    @exclusive
     def register(self, username, email, password, name):
         """Register new user account"""
         try:
@@ -64,40 +652,242 @@ class Client:
             print(f"Error during registration: {e}")
             return "Error during registration."
 
+    @exclusive
+    def request(self, message, bufsize=1024):
+        """Send a JSON command and return the server's decoded JSON reply.
+
+        Commands the server sheds as busy are retried after the suggested delay.
+        """
+        for _ in range(BUSY_RETRIES + 1):
+            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            response = self.client_socket.recv(bufsize).decode('utf-8')
+            if not response:
+                raise ConnectionError("Server closed the connection")
+            response_json = json.loads(response)
+            if not (isinstance(response_json, dict) and response_json.get("status") == "busy"):
+                break
+            time.sleep(response_json.get("retry_after_ms", 250) / 1000)
+        return response_json
+
+    def recv_json(self, bufsize=65536):
+        """Read one JSON reply that may arrive in several segments"""
+        data = b""
+        while True:
+            chunk = self.client_socket.recv(bufsize)
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            data += chunk
+            try:
+                return json.loads(data.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                continue
+
+    def read_frames(self):
+        """Yield the JSON frames of a streamed reply as they arrive, one per line"""
+        buffer = b""
+        while True:
+            chunk = self.client_socket.recv(65536)
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            # A busy reply is a single JSON object with no newline after it
+            try:
+                frame = json.loads(buffer)
+            except ValueError:
+                continue
+            buffer = b""
+            yield frame
+
+    def stream_query(self, message):
+        """Send a query command in streaming mode and yield its rows as each batch arrives.
+
+        For example stream_query({"command": "filter_by_budget", "budget": 50, "self_id": self.id}).
+        The connection lock is only held while a frame is read. A command sent
+        while the caller is between rows first reads the rest of the stream
+        into memory for it, and stopping early reads and discards the rest,
+        so the next command starts cleanly either way.
+        """
+        message = dict(message, stream=True, with_images=False)
+        with self.io_lock:
+            self.finish_stream()
+            try:
+                for _ in range(BUSY_RETRIES + 1):
+                    self.client_socket.sendall(json.dumps(message).encode('utf-8'))
+                    frames = self.read_frames()
+                    frame = next(frames)
+                    if frame.get("status") != "busy":
+                        break
+                    time.sleep(frame.get("retry_after_ms", 250) / 1000)
+            finally:
+                self.last_activity = time.monotonic()
+            read_ahead = collections.deque()
+            if not stream_ended(frame):
+                self.open_stream = (frames, read_ahead)
+        try:
+            while not stream_ended(frame):
+                yield from frame.get("items", [])
+                frame = self.next_frame(frames, read_ahead)
+        finally:
+            with self.io_lock:
+                if self.open_stream is not None and self.open_stream[0] is frames:
+                    self.open_stream = None
+                    for frame in frames:
+                        if stream_ended(frame):
+                            break
+        if "error" in frame:
+            raise ValueError(frame["error"])
+
+    def next_frame(self, frames, read_ahead):
+        """The next frame of a stream_query, from the socket or from what another command read ahead"""
+        with self.io_lock:
+            if read_ahead:
+                return read_ahead.popleft()
+            try:
+                frame = next(frames, None)
+            finally:
+                self.last_activity = time.monotonic()
+            if frame is None:
+                # Another command's read-ahead failed partway through
+                raise ConnectionError("The stream ended early")
+            if stream_ended(frame):
+                self.open_stream = None
+            return frame
+
+    def finish_stream(self):
+        """Read the rest of an unfinished stream_query into memory for its reader; call with io_lock held"""
+        if self.open_stream is None:
+            return
+        frames, read_ahead = self.open_stream
+        self.open_stream = None
+        for frame in frames:
+            read_ahead.append(frame)
+            if stream_ended(frame):
+                break
+
+    @exclusive
+    def sell_batch(self, items):
+        """List many items at once.
+
+        Each item is a dict with product_name, price, description, image_path and
+        amount. Returns one result per item, in order: {"status": "ok",
+        "product_id": ...} or {"status": "error", "message": ...}.
+        """
+        results = []
+        for start in range(0, len(items), BATCH_SIZE):
+            results.extend(self.send_batch(items[start:start + BATCH_SIZE]))
+        return results
+
+    def send_batch(self, batch):
+        """Send one sell_batch manifest and stream its images back to back"""
+        results = [None] * len(batch)
+        manifest = []
+        indexes = []
+        for index, item in enumerate(batch):
+            if not os.path.exists(item["image_path"]):
+                results[index] = {"status": "error", "message": "Image file not found"}
+                continue
+            manifest.append({
+                "product_name": item["product_name"],
+                "price": item["price"],
+                "description": item["description"],
+                "amount": item["amount"],
+                "size": os.path.getsize(item["image_path"]),
+                "sha256": self.file_sha256(item["image_path"]),
+            })
+            indexes.append(index)
+        if not manifest:
+            return results
+        try:
+            response = self.request({"command": "sell_batch", "self_id": self.id, "items": manifest})
+            if response.get("status") != "ready":
+                raise ValueError(response.get("message", "Batch rejected"))
+            for index in indexes:
+                with open(batch[index]["image_path"], 'rb') as f:
+                    self.client_socket.sendfile(f)
+            response = self.recv_json()
+            if response.get("status") != "done":
+                raise ValueError(response.get("message", "Batch failed"))
+            for result in response["results"]:
+                index = indexes[result["index"]]
+                results[index] = {key: value for key, value in result.items() if key != "index"}
+        except (socket.error, ValueError) as e:
+            print(f"Error selling batch: {e}")
+            for index in indexes:
+                if results[index] is None:
+                    results[index] = {"status": "error", "message": str(e)}
+        return results
+
+    @exclusive
     def send_image(self, image_path):
-        """Send image file to server"""
+        """Upload an image file through a resumable upload session.
+
+        Returns the upload ID to pass with the sell command, or None on failure.
+        If the connection drops, the client reconnects, attaches the new
+        connection to its login and resumes from the last offset the server
+        reports as persisted.
+        """
         try:
             if not os.path.exists(image_path):
                 print("Error: Image file not found")
-                return False
+                return None
             image_size = os.path.getsize(image_path)
-            self.client_socket.send(str(image_size).encode('utf-8'))
-            response = self.client_socket.recv(1024).decode('utf-8')
-            if response != "READY":
-                return False
-            bytes_sent = 0
-            with open(image_path, 'rb') as f:
-                while bytes_sent < image_size:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    self.client_socket.sendall(chunk)
-                    bytes_sent += len(chunk)
-                    progress_msg = self.client_socket.recv(1024).decode('utf-8')
-                    if progress_msg.startswith("PROGRESS:"):
-                        progress = float(progress_msg.split(":")[1])
-                    else:
-                        return False
-            final_response = self.client_socket.recv(1024).decode('utf-8')
-            if final_response.startswith("SUCCESS"):
-                return True
-            else:
-                print(f"Upload failed: {final_response}")
-                return False
-        except Exception as e:
+            message = {"command": "begin_upload", "size": image_size, "sha256": self.file_sha256(image_path), "self_id": self.id}
+            response = self.request(message)
+            if response.get("status") != "ok":
+                print(f"Upload failed: {response.get('message')}")
+                return None
+        except (socket.error, ValueError) as e:
             print(f"Error sending image: {e}")
+            return None
+        upload_id = response["upload_id"]
+        chunk_size = response["chunk_size"]
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                if attempt:
+                    time.sleep(1)
+                    self.reconnect()
+                if self.upload_from_offset(upload_id, image_path, image_size, chunk_size):
+                    return upload_id
+                return None
+            except (socket.error, ValueError) as e:
+                print(f"Upload interrupted ({e}), resuming...")
+        print("Upload failed: too many connection errors")
+        return None
+
+    def upload_from_offset(self, upload_id, image_path, image_size, chunk_size):
+        """Send the rest of an upload starting at the offset the server has persisted"""
+        status = self.request({"command": "query_upload", "upload_id": upload_id})
+        if status.get("status") != "ok":
+            print(f"Upload failed: {status.get('message')}")
             return False
+        if status["complete"]:
+            return True
+        offset = status["offset"]
+        with open(image_path, 'rb') as f:
+            f.seek(offset)
+            while offset < image_size:
+                chunk = f.read(chunk_size)
+                response = self.request({"command": "upload_chunk", "upload_id": upload_id, "offset": offset, "length": len(chunk)})
+                if response.get("status") != "ready":
+                    print(f"Upload failed: {response.get('message')}")
+                    return False
+                self.client_socket.sendall(chunk)
+                ack = json.loads(self.client_socket.recv(1024).decode('utf-8'))
+                if ack.get("status") != "ok":
+                    print(f"Upload failed: {ack.get('message')}")
+                    return False
+                offset = ack["offset"]
+        response = self.request({"command": "finish_upload", "upload_id": upload_id})
+        if response.get("status") != "ok":
+            print(f"Upload failed: {response.get('message')}")
+            return False
+        return True
 
+    @exclusive
     def receive_image(self, save_path):
         """Receive image file from server"""
         try:
@@ -116,8 +906,10 @@ class Client:
                     break
                 received_data.extend(chunk)
                 received_size += len(chunk)
-                progress = (received_size / image_size) * 100
-                self.client_socket.send(f"PROGRESS:{progress:.2f}".encode('utf-8'))
+                # The server waits for one ack per 8192-byte chunk it sends
+                if received_size % 8192 == 0 or received_size == image_size:
+                    progress = (received_size / image_size) * 100
+                    self.client_socket.send(f"PROGRESS:{progress:.2f}".encode('utf-8'))
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
             with open(save_path, 'wb') as f:
                 f.write(received_data)
@@ -127,6 +919,15 @@ class Client:
             print(f"Error receiving image: {e}")
             return False
     
+    def file_sha256(self, path):
+        """Compute the SHA-256 of a file without loading it into memory"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @exclusive
     def get_items(self, currency="USD"):
         """Get list of available items with currency conversion."""
         try:
@@ -159,21 +960,23 @@ class Client:
             print(f"Unexpected error: {e}")
             return "Error retrieving items."
                 
+    @exclusive
     def sell_item(self, product_name, price, description, image_path, amount):
         """List new item for sale"""
         try:
-            message = {"command": "sell","product_name": product_name,"price": price,"self_id": self.id,"image_path": image_path,"description": description, "amount": amount}
+            upload_id = self.send_image(image_path)
+            if not upload_id:
+                return "Failed to upload product image"
+            message = {"command": "sell","product_name": product_name,"price": price,"self_id": self.id,"image_path": image_path,"description": description, "amount": amount, "upload_id": upload_id}
             message_json = json.dumps(message)
             self.client_socket.send(message_json.encode('utf-8'))
-            if self.send_image(image_path):
-                response = self.client_socket.recv(1024).decode('utf-8')
-                return response
-            else:
-                return "Failed to upload product image"
+            response = self.client_socket.recv(1024).decode('utf-8')
+            return response
         except socket.error as e:
             print(f"Error selling item: {e}")
             return "Error selling item."
     
+    @exclusive
     def check_if_owner_online(self, owner_username):
         try:
             message = {
@@ -197,10 +1000,13 @@ class Client:
                 message_json = json.loads(message)
                 if message_json:
                     print(message_json["message"])
+            except socket.timeout:
+                continue
             except Exception as e:
                 print(f"Error receiving message: {e}")
                 break
 
+    @exclusive
     def send_message(self, recipient_username, message):
         try:
             full_message = {
@@ -223,6 +1029,7 @@ class Client:
     def communicate(self):
         threading.Thread(target=self.listen_for_messages, daemon=True).start()
 
+    @exclusive
     def get_ip_and_port(self,username):
         try:
             message= { 
@@ -233,99 +1040,210 @@ class Client:
             self.client_socket.send(message_json.encode('utf-8'))
             response = self.client_socket.recv(1024).decode('utf-8')                ##maek json??
             response_json=json.loads(response)
-            return response_json["ip"],response_json["port"]
-        except socket.error as e:
+            return response_json.get("ip"), response_json.get("port")
+        except (socket.error, ValueError) as e:
             print(f"Error fetching IP and port: {e}")
             return None, None
         
-    def send_message_p2p_loop( self, peer_socket):
-        try:
+    def start_p2p(self):
+        """Start the hub that carries direct chats with other users"""
+        self.hub = PeerHub(self.ip, self.p2p_server_port, self.username, self.resolve_peer, self.on_peer_message)
+        return self.hub.start()
+
+    def resolve_peer(self, username):
+        """Return a peer's (ip, port), asking the server only on a cache miss"""
+        with self.peer_addresses_lock:
+            entry = self.peer_addresses.get(username)
+        if entry and entry[2] > time.monotonic():
+            return entry[0], entry[1]
+        ip, port = self.get_ip_and_port(username)
+        if ip and port:
+            with self.peer_addresses_lock:
+                self.peer_addresses[username] = (ip, port, time.monotonic() + PEER_ADDRESS_TTL)
+        return ip, port
+
+    @exclusive
+    def attach_connection(self):
+        """Open one more server connection attached to this login and return its socket"""
+        token = self.session_token
+        if not token:
+            response = self.request({"command": "issue_token"})
+            if response.get("status") != "ok":
+                raise ValueError(response.get("message"))
+            token = response["token"]
+        sock = self.spawn_connection(token).client_socket
+        sock.settimeout(HEARTBEAT_INTERVAL)
+        return sock
+
+    def push_values(self, sock, subscribe):
+        """Subscribe on a connection and yield what the server pushes on it until it closes.
+
+        A keepalive goes out whenever the connection has been quiet for HEARTBEAT_INTERVAL.
+        """
+        subscribe = json.dumps(subscribe).encode('utf-8')
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')()
+        buffer = ""
+        sock.sendall(subscribe)
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                sock.sendall(json.dumps({"command": "ping"}).encode('utf-8'))
+                continue
+            if not chunk:
+                return
+            buffer += text.decode(chunk)
             while True:
-                message = input("Enter your message (type 'stop' to end): ")
-                if message.strip().lower() == "stop":
-                    # Send a stop message to inform the peer
-                    peer_socket.send("stop".encode('utf-8'))
-                    peer_socket.close()
-                    print("Communication closed.")
+                buffer = buffer.lstrip()
+                try:
+                    value, end = decoder.raw_decode(buffer)
+                except ValueError:
                     break
-                elif message.strip():
-                    # Send message
-                    #message_json = json.dumps({"message": message})  make json??
-                    peer_socket.send(message.encode('utf-8'))
+                buffer = buffer[end:]
+                if value.get("status") == "busy":
+                    time.sleep(value.get("retry_after_ms", 250) / 1000)
+                    sock.sendall(subscribe)
+                elif value.get("status") == "error":
+                    raise ValueError(value.get("message"))
                 else:
-                    print("Message cannot be empty.")
-        except socket.error as e:
-            print(f"Error during P2P message sending: {e}")
-        except Exception as e:
-            print(f"Unexpected error: {e}")
+                    yield value
 
-    def send_message_p2p(self,recipient_username):
-        recipient_ip,recipient_port=self.get_ip_and_port(recipient_username)
-        if not recipient_ip or not recipient_port:
-            print("Could not retrieve peer's IP and port.")
-            return
+    def subscribe_presence(self):
+        """Open a connection on which the server pushes users coming online and going offline"""
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((recipient_ip, recipient_port))
-            print(f"Connected to {recipient_ip}:{recipient_port}")
-            #threading.Thread(target=self.send_message_p2p_loop, args=(peer_socket,), daemon=True).start()    ##do we need a thread here??
-            #self.listen_for_messages_p2p(peer_socket)   # hay idk sho wad3a mafrood shila??
-            self.send_message_p2p_loop(peer_socket)
-        except socket.error as e:
-            print(f"Error connecting to peer: {e}")
+            sock = self.attach_connection()
+        except (socket.error, ValueError) as e:
+            print(f"Could not subscribe to presence: {e}")
+            return False
+        self.presence_socket = sock
+        threading.Thread(target=self.presence_loop, args=(sock,), daemon=True).start()
+        return True
 
-    def p2p_serverside(self):
-        p2p_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        p2p_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-        # Bind to a fixed P2P port and listen for incoming connections
-            p2p_server_socket.bind((self.ip, self.p2p_server_port))
-            p2p_server_socket.listen(100)
-            print(f"P2P server listening on port {self.p2p_server_port}...")
-            
-            while True:
-                try:
-                    conn, addr = p2p_server_socket.accept()
-                    print(f"Accepted connection from {addr}")
-                    threading.Thread(target=self.listen_for_messages_p2p, args=(conn, addr), daemon=True).start()
-                except socket.error as e:
-                    print(f"Error accepting connection: {e}")
-        except socket.error as e:
-            print(f"Error setting up P2P server: {e}")
+    def unsubscribe_presence(self):
+        sock, self.presence_socket = self.presence_socket, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
-    def listen_for_messages_p2p(self, conn,addr):
+    def presence_loop(self, sock):
+        """Apply presence pushes until the subscription ends"""
         try:
-            while True:
-                message = conn.recv(1024).decode('utf-8')  #check if tehre is message first??
-                if not message:
-                    print(f"Peer {addr} disconnected.")
-                    break
-                if message.lower() == "stop":
-                    conn.close()
-                    print("Peer closed the communication.")
-                    break
-                else:
-                    #message_json = json.loads(message)
-                    #if "message" in message_json:
-                    print(f"Received message: {message}")
-                    #else:
-                        #print("Invalid message format received.")
-        except socket.error as e:
-            print(f"Error receiving message from peer: {e} addr {addr}")
+            for event in self.push_values(sock, {"command": "subscribe_presence"}):
+                self.on_presence(event)
+        except (socket.error, ValueError) as e:
+            if self.presence_socket is sock:
+                print(f"Presence subscription ended: {e}")
+        finally:
+            # Without the feed, cached addresses could go stale unnoticed
+            with self.peer_addresses_lock:
+                self.peer_addresses.clear()
+            if self.presence_socket is sock:
+                self.presence_socket = None
+            sock.close()
+
+    def on_presence(self, event):
+        """Drop cached addresses of peers that went offline or came back on a new address"""
+        if event.get("type") != "presence":
+            return
+        username = event.get("username")
+        with self.peer_addresses_lock:
+            entry = self.peer_addresses.get(username)
+            if entry and (event.get("event") == "offline" or (entry[0], entry[1]) != (event.get("ip"), event.get("port"))):
+                del self.peer_addresses[username]
+        if event.get("event") == "offline" and self.hub:
+            self.hub.close_peer(username)
+
+    def subscribe_catalog(self, on_change=None):
+        """Follow catalog changes in the background instead of polling display.
+
+        on_change is called with each change: "listed" (with the product),
+        "amount", "sold" or "rating". After a dropped connection the feed resumes
+        from the last sequence number seen; a "reset" change means some changes
+        could not be replayed and the catalog should be reloaded with get_items().
+        """
+        if on_change:
+            self.catalog_handler = on_change
+        if self.catalog_following:
+            return
+        self.catalog_following = True
+        threading.Thread(target=self.catalog_loop, daemon=True).start()
 
+    def unsubscribe_catalog(self):
+        self.catalog_following = False
+        sock, self.catalog_socket = self.catalog_socket, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def catalog_loop(self):
+        while self.catalog_following and self.id:
+            sock = None
+            try:
+                sock = self.attach_connection()
+                self.catalog_socket = sock
+                subscribe = {"command": "subscribe_catalog", "since": self.catalog_seq, "epoch": self.catalog_epoch}
+                for change in self.push_values(sock, subscribe):
+                    if change.get("status") == "subscribed":
+                        epoch = change["epoch"]
+                        if self.catalog_seq is None:
+                            self.catalog_seq, self.catalog_epoch = change["seq"], epoch
+                    elif change.get("type") == "catalog":
+                        # Sequence numbers only count once a change from this epoch arrives
+                        self.catalog_seq, self.catalog_epoch = change["seq"], epoch
+                        self.catalog_handler(change)
+            except (socket.error, ValueError) as e:
+                if self.catalog_following:
+                    print(f"Catalog feed interrupted: {e}")
+            finally:
+                if sock:
+                    sock.close()
+            if self.catalog_following:
+                time.sleep(1)
 
-    def communicate_p2p(self):
-        """Start the P2P communication by ensuring the peer socket is initialized."""
-        if self.peer_socket:
-            # Start listening for messages from the peer
-            threading.Thread(target=self.listen_for_messages_p2p, args=(self.peer_socket,), daemon=True).start()
+    def on_catalog_change(self, change):
+        if change["event"] == "listed":
+            print(f"New product: {change['product']['name']} at ${change['product']['price']}")
+        elif change["event"] == "reset":
+            print("Catalog changed while disconnected; reload it to see everything.")
         else:
-            print("No peer connection established.")
+            print(f"Product {change['product_id']} {change['event']}: {change.get('amount', change.get('rating', ''))}")
+
+    def on_peer_message(self, username, message):
+        print(f"Message from {username}: {message}")
+
+    def send_p2p(self, recipient_username, message):
+        """Send one direct message to a user, reusing an open connection to them"""
+        if not self.hub:
+            print("Please log in first.")
+            return False
+        return self.hub.send(recipient_username, message)
+
+    def send_message_p2p(self,recipient_username):
+        """Chat with a user interactively until 'stop' is typed"""
+        while True:
+            message = input("Enter your message (type 'stop' to end): ")
+            if message.strip().lower() == "stop":
+                self.hub.close_peer(recipient_username)
+                print("Communication closed.")
+                break
+            elif message.strip():
+                if not self.send_p2p(recipient_username, message):
+                    break
+            else:
+                print("Message cannot be empty.")
 
-    def filter_by_owner(self, owner_username):
-        """Get items filtered by owner"""
+    @exclusive
+    def filter_by_owner(self, owner_username, sort=None, limit=None, currency=None):
+        """Get items filtered by owner, optionally sorted ('price', 'price_desc', 'rating') and cut to limit,
+        priced in currency if given"""
         try:
-            msg = {"command": "filter_by_owner", "owner_username": owner_username}
+            msg = {"command": "filter_by_owner", "owner_username": owner_username, "with_images": not self.images_out_of_band(),
+                   "sort": sort, "limit": limit, "currency": currency}
             msg_json = json.dumps(msg)
             self.client_socket.send(msg_json.encode('utf-8'))
             items_json = self.client_socket.recv(65536).decode('utf-8')
@@ -336,6 +1254,10 @@ class Client:
                     
                 items = data.get("items", [])
                 total_images = data.get("total_images", 0)
+                if self.images_out_of_band():
+                    # Images were not sent inline; fetch them separately
+                    total_images = len(items)
+                    image_paths = self.download_images([item['id'] for item in items])
                 if total_images == 0:
                     return "No items available."
                     
@@ -343,7 +1265,9 @@ class Client:
                 formatted_items = []
                 for i in range(total_images):
                     image_path = os.path.join("received_images", f"{items[i]['id']}.jpg")
-                    if hasattr(self, 'receive_image') and callable(getattr(self, 'receive_image')):
+                    if self.images_out_of_band():
+                        items[i]['image_path'] = image_paths[i]
+                    elif hasattr(self, 'receive_image') and callable(getattr(self, 'receive_image')):
                         if self.receive_image(image_path):
                             items[i]['image_path'] = image_path
                         else:
@@ -353,7 +1277,7 @@ class Client:
 
                     formatted_item = (
                         f"Name: {items[i]['name']}\n"
-                        f"Price: ${items[i]['price']}\n"
+                        f"Price: {format_price(items[i])}\n"
                         f"Description: {items[i]['description']}\n"
                         f"Image: {'Available' if items[i]['image_path'] else 'Not Available'}\n"
                     )
@@ -372,7 +1296,9 @@ class Client:
 
     def update_budget(self, amount):
         """Update the budget after a purchase"""
-        self.budget -= amount
+        # Pooled connections charge the parent's budget from several threads at once
+        with (self.parent or self).budget_lock:
+            self.budget -= amount
         print(f"Your remaining budget is ${self.budget}")
 
     def check_budget(self, price):
@@ -382,29 +1308,25 @@ class Client:
             return False
         return True
         
+    @exclusive
     def purchase_product(self, product_name):
         """Purchase a product"""
         try:
             if not self.id:
                 return "Please log in first."
             message = {"command": "get_price", "product_name":  product_name}
-            message_json = json.dumps(message)
-            self.client_socket.send(message_json.encode('utf-8'))
-            response = self.client_socket.recv(1024).decode('utf-8')
-            response_json = json.loads(response)
+            response_json = self.request(message)
             # Get the product price from the server response
             price = response_json["price"]
             # Check if the user has enough budget
             if not self.check_budget(price):
                 return "Purchase cannot be completed. Not enough budget."          #aw print eror then return??
             message = {"command": "Purchase", "product_name": product_name, "self_id": self.id}
-            message_json = json.dumps(message)
-            self.client_socket.send(message_json.encode('utf-8'))
-            response = self.client_socket.recv(1024).decode('utf-8')
-            response_json = json.loads(response)
-            # Get the product price from the server response
-            price = response_json["price"]
-            # Proceed with the purchase if budget is sufficient
+            # Pooled purchases share one user's write allowance, so some may be shed as busy and retried
+            response_json = self.request(message)
+            if response_json.get("status") != "success":
+                return response_json.get("message", response_json.get("status"))
+            # Charge the price quoted by get_price once the purchase went through
             self.update_budget(price)
             return response_json['message']
         except socket.error as e:
@@ -414,16 +1336,23 @@ class Client:
             print(f"Unexpected error during purchase: {e}")
             return "An unexpected error occurred."
         
-    def view_sold_product_buyers(self):
-        """View buyers of products sold by current user"""
+    @exclusive
+    def view_sold_product_buyers(self, limit=None, before=None):
+        """View buyers of products sold by current user, newest orders first.
+
+        One page of orders is returned; the before value for the next page is
+        left in self.next_orders_page (None on the last page).
+        """
         try:
             if not self.id:
                 return "Please log in first."
-            message = {"command": "view_buyers", "self_id": self.id}
+            message = {"command": "view_buyers", "self_id": self.id, "before": before}
+            if limit:
+                message["limit"] = limit
             message_json = json.dumps(message)
             self.client_socket.send(message_json.encode('utf-8'))
-            buyers_info = self.client_socket.recv(65536).decode('utf-8')
-            buyers_info_json = json.loads(buyers_info)
+            buyers_info_json = self.recv_json()
+            self.next_orders_page = buyers_info_json.get("next_before")
             if "error" in buyers_info_json:
                 return buyers_info_json["error"]
             elif "message" in buyers_info_json:
@@ -432,6 +1361,7 @@ class Client:
                 formatted_buyers = []
                 for product in buyers_info_json.get("products", []):
                     formatted_buyer = (
+                        f"Order ID: {product['order_id']}\n"
                         f"Product ID: {product['product_id']}\n"
                         f"Name: {product['name']}\n"
                         f"Buyer: {product['buyer']}\n"
@@ -449,6 +1379,49 @@ class Client:
             print(f"Unexpected error retrieving buyers: {e}")
             return "An unexpected error occurred."
         
+    @exclusive
+    def seller_stats(self):
+        """Return (number of orders, revenue) for products sold by the current user"""
+        try:
+            response = self.request({"command": "seller_stats", "self_id": self.id})
+            if response.get("status") != "ok":
+                return response.get("message", "Error retrieving sales.")
+            return response["orders"], response["revenue"]
+        except (socket.error, ValueError) as e:
+            print(f"Error retrieving sales: {e}")
+            return "Connection error. Please try again later."
+
+    @exclusive
+    def profile_server(self, seconds=10):
+        """Admin only: profile every command the server runs in the next seconds.
+
+        Returns the server's reply, which names the .prof file and text summary it will write.
+        """
+        try:
+            return self.request({"command": "profile", "seconds": seconds})
+        except (socket.error, ValueError) as e:
+            print(f"Error starting profiler: {e}")
+            return {"status": "error", "message": str(e)}
+
+    @exclusive
+    def heap_snapshot(self, action="snapshot"):
+        """Admin only: 'start' or 'stop' tracemalloc on the server, or write a 'snapshot'"""
+        try:
+            return self.request({"command": "heap", "action": action})
+        except (socket.error, ValueError) as e:
+            print(f"Error taking heap snapshot: {e}")
+            return {"status": "error", "message": str(e)}
+
+    @exclusive
+    def flash_sale(self, action="list", product_name=None):
+        """Admin only: 'start' or 'stop' a flash sale for a product ahead of demand, or 'list' the running ones"""
+        try:
+            return self.request({"command": "flash_sale", "action": action, "product_name": product_name}, 65536)
+        except (socket.error, ValueError) as e:
+            print(f"Error managing flash sale: {e}")
+            return {"status": "error", "message": str(e)}
+
+    @exclusive
     def logout(self):
         """Logout the current user"""
         try:
@@ -466,6 +1439,12 @@ class Client:
             response_json = json.loads(response)
             
             if response_json["message"] == "logout successful":
+                if self.hub:
+                    self.hub.stop()
+                    self.hub = None
+                self.unsubscribe_presence()
+                self.unsubscribe_catalog()
+                self.close_image_channel()
                 self.client_socket.close()
                 self.id = None
                 self.client_socket = None
@@ -480,6 +1459,7 @@ class Client:
             return "An unexpected error occurred during logout."
         
 
+    @exclusive
     def rate(self, rating, product_id):
         """Submit a rating for a product."""
         if not (1 <= rating <= 5):
@@ -514,6 +1494,7 @@ class Client:
             return "An unexpected error occurred during rating."
         
     
+    @exclusive
     def display_rating(self, product_id):
         """Display the rating for a product."""
         if not self.client_socket:
@@ -544,36 +1525,61 @@ class Client:
             print(f"Unexpected error getting rating: {e}")
             return "An unexpected error occurred while getting rating."
 
-    def search_product(self, search):
+    @exclusive
+    def suggest(self, prefix, limit=10):
+        """Return product names starting with prefix, for typeahead"""
+        try:
+            response = self.request({"command": "suggest", "prefix": prefix, "limit": limit}, 65536)
+            if response.get("status") != "ok":
+                print(response.get("error", "Error retrieving suggestions."))
+                return []
+            return response["suggestions"]
+        except (socket.error, ValueError) as e:
+            print(f"Error retrieving suggestions: {e}")
+            return []
+
+    @exclusive
+    def search_product(self, search, currency=None):
         try:
             msg = json.dumps({
                 "command":"search",
                 "item": search,
-                "self_id" : self.id
+                "self_id" : self.id,
+                "with_images": not self.images_out_of_band(),
+                "currency": currency
             })
             self.client_socket.send(msg.encode('utf-8'))
             items_json = self.client_socket.recv(8192).decode('utf-8')
             items = json.loads(items_json)
+            if isinstance(items, dict):
+                return items.get("error", "Error retrieving items.")
             if not items:
                 return "No items available."
             os.makedirs("received_images", exist_ok=True)
-            self.client_socket.send("READY_FOR_IMAGES".encode('utf-8'))
+            if self.images_out_of_band():
+                # Images were not sent inline; fetch them separately
+                image_paths = self.download_images([item['id'] for item in items])
+            else:
+                self.client_socket.send("READY_FOR_IMAGES".encode('utf-8'))
             formatted_items = []
-            for item in items:
-                image_path = os.path.join("received_images", f"{item['id']}.jpg")
-                if self.receive_image(image_path):
-                    item['image_path'] = image_path
+            for i, item in enumerate(items):
+                if self.images_out_of_band():
+                    item['image_path'] = image_paths[i]
                 else:
-                    item['image_path'] = None
+                    image_path = os.path.join("received_images", f"{item['id']}.jpg")
+                    if self.receive_image(image_path):
+                        item['image_path'] = image_path
+                    else:
+                        item['image_path'] = None
+                    self.client_socket.send("NEXT_IMAGE".encode('utf-8'))
                 formatted_item = (
                     f"Name: {item['name']}\n"
-                    f"Price: ${item['price']}\n"
+                    f"Price: {format_price(item)}\n"
                     f"Description: {item['description']}\n"
                     f"Image: {'Available' if item['image_path'] else 'Not Available'}\n"
                 )
                 formatted_items.append(formatted_item)
-                self.client_socket.send("NEXT_IMAGE".encode('utf-8'))
-                return "\n".join(formatted_items)
+            return "\n".join(formatted_items)
         except socket.error as e:
             print(f"Error retrieving items: {e}")
             return "Error retrieving items."
@@ -585,10 +1591,12 @@ class Client:
             return "An unexpected error occurred."
         
 
-    def filter_by_budget(self):
-        """Get items filtered by owner"""
+    @exclusive
+    def filter_by_budget(self, sort=None, limit=None, currency=None):
+        """Get items within budget; with currency, the budget is in that currency and so are the prices"""
         try:
-            msg = {"command": "filter_by_owner", "budget": self.budget, "self_id" : self.id}
+            msg = {"command": "filter_by_budget", "budget": self.budget, "self_id" : self.id, "with_images": not self.images_out_of_band(),
+                   "sort": sort, "limit": limit, "currency": currency}
             msg_json = json.dumps(msg)
             self.client_socket.send(msg_json.encode('utf-8'))
             items_json = self.client_socket.recv(65536).decode('utf-8')
@@ -599,6 +1607,10 @@ class Client:
                     
                 items = data.get("items", [])
                 total_images = data.get("total_images", 0)
+                if self.images_out_of_band():
+                    # Images were not sent inline; fetch them separately
+                    total_images = len(items)
+                    image_paths = self.download_images([item['id'] for item in items])
                 if total_images == 0:
                     return "No items available."
                     
@@ -606,7 +1618,9 @@ class Client:
                 formatted_items = []
                 for i in range(total_images):
                     image_path = os.path.join("received_images", f"{items[i]['id']}.jpg")
-                    if hasattr(self, 'receive_image') and callable(getattr(self, 'receive_image')):
+                    if self.images_out_of_band():
+                        items[i]['image_path'] = image_paths[i]
+                    elif hasattr(self, 'receive_image') and callable(getattr(self, 'receive_image')):
                         if self.receive_image(image_path):
                             items[i]['image_path'] = image_path
                         else:
@@ -616,7 +1630,7 @@ class Client:
 
                     formatted_item = (
                         f"Name: {items[i]['name']}\n"
-                        f"Price: ${items[i]['price']}\n"
+                        f"Price: {format_price(items[i])}\n"
                         f"Description: {items[i]['description']}\n"
                         f"Image: {'Available' if items[i]['image_path'] else 'Not Available'}\n"
                     )
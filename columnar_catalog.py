@@ -0,0 +1,254 @@
+"""In-memory NumPy snapshot of the catalog for the budget and owner filters; run directly to benchmark it against SQLite"""
+import threading
+
+from currency import PRICE_DECIMALS
+
+try:
+    import numpy as np
+except ImportError:  # The catalog is optional; the server falls back to SQL
+    np = None
+
+# Sort orders accepted by the filters: column and direction
+SORT_KEYS = {
+    "price": ("price", False),
+    "price_desc": ("price", True),
+    "rating": ("rating", True),
+}
+
+def available():
+    """True if NumPy is installed and the columnar catalog can be used"""
+    return np is not None
+
+def to_int(value):
+    """Client IDs arrive as strings or ints; anything else matches no owner"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+class ColumnarCatalog:
+    """Columns of id, owner, price, amount, rating and status for every product, read and written under one lock"""
+    def __init__(self, capacity=1024):
+        self.lock = threading.Lock()
+        self.size = 0
+        self.positions = {}
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.owner_ids = np.zeros(capacity, dtype=np.int64)
+        self.prices = np.zeros(capacity, dtype=np.float64)
+        self.amounts = np.zeros(capacity, dtype=np.int64)
+        self.ratings = np.zeros(capacity, dtype=np.float64)
+        self.available = np.zeros(capacity, dtype=bool)
+        self.names = np.empty(capacity, dtype=object)
+        self.descriptions = np.empty(capacity, dtype=object)
+        # Converted price columns by currency code: [rate, column, rows converted]
+        self.converted = {}
+
+    @classmethod
+    def from_db(cls, db, batch_size=10000):
+        """Build a snapshot of the products table"""
+        catalog = cls()
+        catalog.load(db, batch_size)
+        return catalog
+
+    def load(self, db, batch_size=10000):
+        """Add the products table of one database, such as one shard of a split catalog"""
+        cursor = db.cursor()
+        cursor.execute("SELECT id, owner_id, name, price, description, amount, rating, status FROM products ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            with self.lock:
+                for row in rows:
+                    self._append(*row)
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for column in ("ids", "owner_ids", "prices", "amounts", "ratings", "available", "names", "descriptions"):
+            old = getattr(self, column)
+            new = np.zeros(capacity, dtype=old.dtype) if old.dtype != object else np.empty(capacity, dtype=object)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def _append(self, product_id, owner_id, name, price, description, amount, rating=0.0, status='available'):
+        position = self.positions.get(product_id)
+        if position is None:
+            self._grow(self.size + 1)
+            position = self.size
+            self.size += 1
+            self.positions[product_id] = position
+        elif self.converted:
+            # A relisted product may have a new price
+            self.converted.clear()
+        self.ids[position] = product_id
+        self.owner_ids[position] = to_int(owner_id)
+        self.prices[position] = price or 0.0
+        self.amounts[position] = amount or 0
+        self.ratings[position] = rating or 0.0
+        self.available[position] = status == 'available'
+        self.names[position] = name
+        self.descriptions[position] = description
+
+    def add(self, product_id, owner_id, name, price, description, amount, rating=0.0, status='available'):
+        """Record a newly listed product"""
+        with self.lock:
+            self._append(product_id, owner_id, name, price, description, amount, rating, status)
+
+    def update(self, product_id, amount=None, status=None, rating=None):
+        """Apply a purchase or rating to a product already in the catalog"""
+        with self.lock:
+            position = self.positions.get(product_id)
+            if position is None:
+                return
+            if amount is not None:
+                self.amounts[position] = amount
+            if status is not None:
+                self.available[position] = status == 'available'
+            if rating is not None:
+                self.ratings[position] = rating
+
+    def _prices_in(self, currency):
+        """The price column in a (code, rate) currency, converting only rows listed since the last call"""
+        if currency is None:
+            return self.prices
+        code, rate = currency
+        entry = self.converted.get(code)
+        if entry is None or entry[0] != rate:
+            entry = self.converted[code] = [rate, np.zeros(len(self.prices), dtype=np.float64), 0]
+        if len(entry[1]) < len(self.prices):
+            column = np.zeros(len(self.prices), dtype=np.float64)
+            column[:entry[2]] = entry[1][:entry[2]]
+            entry[1] = column
+        if entry[2] < self.size:
+            entry[1][entry[2]:self.size] = np.round(self.prices[entry[2]:self.size] * rate, PRICE_DECIMALS)
+            entry[2] = self.size
+        return entry[1]
+
+    def prices_in(self, product_ids, currency):
+        """Prices of the given products in a (code, rate) currency, read from the cached column; None for unknown IDs"""
+        with self.lock:
+            positions = np.fromiter((self.positions.get(product_id, -1) for product_id in product_ids),
+                                    dtype=np.int64, count=len(product_ids))
+            prices = self._prices_in(currency)[np.maximum(positions, 0)]
+        return [price if position >= 0 else None for price, position in zip(prices.tolist(), positions.tolist())]
+
+    def _gather(self, mask, sort=None, limit=None, currency=None):
+        """Copy out the id, name, price and description columns of the matching rows, sorted and cut to limit"""
+        positions = np.flatnonzero(mask)
+        if limit == 0:
+            positions = positions[:0]
+        elif sort in SORT_KEYS:
+            column, descending = SORT_KEYS[sort]
+            keys = (self.prices if column == "price" else self.ratings)[positions]
+            if descending:
+                keys = -keys
+            if limit is not None and 0 < limit < len(positions):
+                # Only the top `limit` rows need a full sort
+                top = np.argpartition(keys, limit - 1)[:limit]
+                positions = positions[top[np.argsort(keys[top], kind='stable')]]
+            else:
+                positions = positions[np.argsort(keys, kind='stable')]
+        elif limit is not None and limit >= 0:
+            positions = positions[:limit]
+        return self.ids[positions], self.names[positions], self._prices_in(currency)[positions], self.descriptions[positions]
+
+    def _budget_mask(self, budget, exclude_owner_id):
+        n = self.size
+        return (self.prices[:n] <= budget) & (self.amounts[:n] > 0) & (self.owner_ids[:n] != to_int(exclude_owner_id))
+
+    def _owner_mask(self, owner_id):
+        n = self.size
+        return (self.owner_ids[:n] == to_int(owner_id)) & (self.amounts[:n] > 0)
+
+    def filter_by_budget(self, budget, exclude_owner_id, sort=None, limit=None, currency=None):
+        """Products in stock priced at or under budget (in the base currency), not owned by the caller"""
+        with self.lock:
+            columns = self._gather(self._budget_mask(budget, exclude_owner_id), sort, limit, currency)
+        return to_items(*columns, code=currency and currency[0])
+
+    def filter_by_owner(self, owner_id, sort=None, limit=None, currency=None):
+        """Products in stock listed by one owner"""
+        with self.lock:
+            columns = self._gather(self._owner_mask(owner_id), sort, limit, currency)
+        return to_items(*columns, code=currency and currency[0])
+
+    def stream_by_budget(self, budget, exclude_owner_id, sort=None, limit=None, batch_size=500, currency=None):
+        """Like filter_by_budget, but yields the items in lists of batch_size"""
+        with self.lock:
+            columns = self._gather(self._budget_mask(budget, exclude_owner_id), sort, limit, currency)
+        return item_batches(columns, batch_size, currency and currency[0])
+
+    def stream_by_owner(self, owner_id, sort=None, limit=None, batch_size=500, currency=None):
+        """Like filter_by_owner, but yields the items in lists of batch_size"""
+        with self.lock:
+            columns = self._gather(self._owner_mask(owner_id), sort, limit, currency)
+        return item_batches(columns, batch_size, currency and currency[0])
+
+def to_items(ids, names, prices, descriptions, code=None):
+    """Build the item dicts the server sends from gathered columns, tagged with a currency code if given"""
+    items = [
+        {'id': product_id, 'name': name, 'price': price, 'description': description}
+        for product_id, name, price, description in zip(
+            ids.tolist(), names.tolist(), prices.tolist(), descriptions.tolist())
+    ]
+    if code:
+        for item in items:
+            item['currency'] = code
+    return items
+
+def item_batches(columns, batch_size, code=None):
+    """Yield item dicts batch_size at a time, so only one batch is ever built"""
+    for start in range(0, len(columns[0]), batch_size):
+        yield to_items(*(column[start:start + batch_size] for column in columns), code=code)
+
+def benchmark(num_products=1000000, num_owners=10000, repeats=20):
+    """Compare the budget filter against SQLite on a synthetic in-memory catalog"""
+    import random
+    import sqlite3
+    import time
+
+    rng = random.Random(42)
+    db = sqlite3.connect(":memory:")
+    db.execute("""CREATE TABLE products (id INTEGER PRIMARY KEY, owner_id INTEGER, name TEXT, price REAL,
+                  description TEXT, amount INTEGER, rating REAL, status TEXT)""")
+    db.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?, 'available')", (
+        (i, rng.randrange(num_owners), f"product {i}", rng.uniform(1, 1000), "", rng.randrange(3), rng.uniform(0, 5))
+        for i in range(1, num_products + 1)))
+    catalog = ColumnarCatalog.from_db(db)
+    budget = 50.0
+
+    def sql_query():
+        return db.execute("SELECT id, name, price, description FROM products WHERE price <= ? AND amount > 0 AND owner_id != ?",
+                          (budget, 7)).fetchall()
+
+    def sql_top_k():
+        return db.execute("""SELECT id, name, price, description FROM products WHERE price <= ? AND amount > 0
+                             AND owner_id != ? ORDER BY price LIMIT 20""", (budget, 7)).fetchall()
+
+    def sql_converted():
+        return db.execute("""SELECT id, name, ROUND(price * ?, 2), description FROM products WHERE price <= ? AND amount > 0
+                             AND owner_id != ?""", (0.92, budget, 7)).fetchall()
+
+    cases = [
+        ("budget filter", sql_query, lambda: catalog.filter_by_budget(budget, 7)),
+        ("budget filter, top 20 by price", sql_top_k, lambda: catalog.filter_by_budget(budget, 7, sort="price", limit=20)),
+        ("budget filter, prices in EUR", sql_converted, lambda: catalog.filter_by_budget(budget, 7, currency=("EUR", 0.92))),
+    ]
+    for label, sql_fn, columnar_fn in cases:
+        assert len(sql_fn()) == len(columnar_fn())
+        timings = []
+        for fn in (sql_fn, columnar_fn):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn()
+            timings.append((time.perf_counter() - start) / repeats * 1000)
+        print(f"{label}: sqlite {timings[0]:.2f} ms, columnar {timings[1]:.2f} ms")
+
+if __name__ == "__main__":
+    if not available():
+        raise SystemExit("NumPy is not installed")
+    benchmark()
@@ -0,0 +1,82 @@
+"""Exchange rates for showing prices in the buyer's currency.
+
+Prices are stored in one base currency. The rate table comes from a JSON
+file of the form
+
+    {"base": "USD", "rates": {"EUR": 0.92, "GBP": 0.79, "LBP": 89500}}
+
+where each rate is how many units of that currency one base unit buys. The
+file is checked for changes at most every CHECK_INTERVAL seconds and
+reloaded when its modification time moves, so rates can be updated without
+a restart. A file that fails to parse leaves the previous rates in place.
+"""
+import json
+import os
+import threading
+import time
+
+# Seconds between checks of the rates file for changes
+CHECK_INTERVAL = 5.0
+# Decimal places converted prices are rounded to
+PRICE_DECIMALS = 2
+
+class RateTable:
+    """The rates from one file, reloaded when the file changes"""
+    def __init__(self, path, base="USD"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.base = base
+        self.rates = {base: 1.0}
+        self.mtime = None
+        self.next_check = 0.0
+
+    def refresh(self):
+        """Reload the file if it changed since the last load"""
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        with self.lock:
+            if now < self.next_check:
+                return
+            self.next_check = now + CHECK_INTERVAL
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                return
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    table = json.load(f)
+                base = str(table.get("base", self.base)).upper()
+                rates = {str(code).upper(): float(rate) for code, rate in table["rates"].items()}
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                print(f"Error loading currency rates from {self.path}: {e}")
+                return
+            invalid = [code for code, rate in rates.items() if not rate > 0]
+            if invalid:
+                print(f"Error loading currency rates from {self.path}: non-positive rate for {', '.join(invalid)}")
+                return
+            rates[base] = 1.0
+            self.base, self.rates = base, rates
+            print(f"Loaded {len(rates)} currency rates (base {base})")
+
+    def lookup(self, currency):
+        """Return (code, rate) for a currency code, or None if it is unknown"""
+        self.refresh()
+        code = currency.upper() if isinstance(currency, str) else None
+        rate = self.rates.get(code)
+        return (code, rate) if rate is not None else None
+
+def convert(price, rate):
+    """A base-currency price in another currency"""
+    return round(price * rate, PRICE_DECIMALS)
+
+def to_base(amount, rate):
+    """An amount in another currency expressed in the base currency.
+
+    Nudged up by a relative 1e-9 so that a budget equal to a converted price
+    still covers it despite floating-point error.
+    """
+    return amount / rate * (1 + 1e-9)
@@ -0,0 +1,245 @@
+"""Slow-query log and on-demand profiling for the running server.
+
+Connections opened with connect() time every statement, COMMIT and ROLLBACK.
+Anything slower than SLOW_QUERY_MS is appended to SLOW_QUERY_LOG as one JSON
+line: the SQL as written, the types of its parameters (never their values),
+the time taken, the command that ran it and, from the connection's trace
+callback, which statements SQLite actually ran, such as an implicit BEGIN.
+
+start_profile profiles every command that runs in the next few seconds with
+cProfile, and heap_snapshot drives tracemalloc. Both write their results
+under PROFILE_DIR.
+"""
+import cProfile
+import json
+import os
+import pstats
+import sqlite3
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+# Statements slower than this are written to the slow-query log, in milliseconds; None turns the log off
+SLOW_QUERY_MS = 50
+SLOW_QUERY_LOG = "slow_queries.log"
+# Where profiles and heap snapshots are written
+PROFILE_DIR = "profiles"
+# Longest profiling window a client may ask for, in seconds
+MAX_PROFILE_SECONDS = 300
+# Stack frames tracemalloc keeps per allocation
+TRACEMALLOC_FRAMES = 10
+# Lines in the text summaries written next to profiles and snapshots
+SUMMARY_LINES = 40
+
+# Command the current thread is running, for attributing slow queries
+context = threading.local()
+slow_log_lock = threading.Lock()
+
+# The open profiling window, or None
+profile_window = None
+profile_lock = threading.Lock()
+# Last tracemalloc snapshot, so the next one can report what grew
+last_snapshot = None
+snapshot_lock = threading.Lock()
+
+def set_command(command):
+    """Record the command the current thread is running"""
+    context.command = command
+
+def current_command():
+    return getattr(context, "command", None)
+
+def parameters_shape(parameters):
+    """Describe query parameters by type only, so no user data reaches the log"""
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+def log_slow_query(sql, shape, elapsed_ms, ran):
+    """Append one entry to the slow-query log"""
+    entry = {
+        "time": datetime.now().isoformat(timespec='milliseconds'),
+        "command": current_command(),
+        "thread": threading.current_thread().name,
+        "ms": round(elapsed_ms, 2),
+        "sql": " ".join(sql.split())[:500],
+        "params": shape,
+    }
+    if ran and ran != [word.upper() for word in sql.split(None, 1)[:1]]:
+        entry["ran"] = ran
+    try:
+        with slow_log_lock, open(SLOW_QUERY_LOG, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"Error writing slow-query log: {e}")
+
+def timed(connection, sql, shape, call, *args):
+    """Run call(*args) and log it if it took longer than SLOW_QUERY_MS"""
+    connection.ran.clear()
+    start = time.perf_counter()
+    try:
+        return call(*args)
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms >= SLOW_QUERY_MS:
+            log_slow_query(sql, shape, elapsed_ms, list(connection.ran))
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor whose execute and executemany calls are timed"""
+    def execute(self, sql, parameters=()):
+        return timed(self.connection, sql, parameters_shape(parameters), super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if isinstance(seq_of_parameters, list):
+            shape = {"rows": len(seq_of_parameters),
+                     "row": parameters_shape(seq_of_parameters[0]) if seq_of_parameters else []}
+        else:
+            shape = {"rows": None}
+        return timed(self.connection, sql, shape, super().executemany, sql, seq_of_parameters)
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection that times statements, COMMIT and ROLLBACK for the slow-query log.
+
+    The trace callback records the first keyword of every statement SQLite
+    runs, so a slow entry shows work the caller did not write itself, such as
+    the BEGIN sqlite3 issues before a write or a COMMIT waiting on fsync.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ran = []
+        self.set_trace_callback(self.trace)
+
+    def trace(self, statement):
+        # Expanded statements carry bound values; keep only the keyword
+        self.ran.append(statement.split(None, 1)[0].upper() if statement.strip() else "")
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        timed(self, "COMMIT", [], super().commit)
+
+    def rollback(self):
+        timed(self, "ROLLBACK", [], super().rollback)
+
+def connect(path, **kwargs):
+    """sqlite3.connect, with slow-query logging unless SLOW_QUERY_MS is None"""
+    if SLOW_QUERY_MS is not None:
+        kwargs.setdefault("factory", ProfiledConnection)
+    return sqlite3.connect(path, **kwargs)
+
+def summary_path(path):
+    return os.path.splitext(path)[0] + ".txt"
+
+def output_path(kind, extension):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.{extension}")
+
+class ProfileWindow:
+    """The cProfile results of every command run while profiling is on"""
+    def __init__(self, seconds):
+        self.path = output_path("profile", "prof")
+        self.seconds = seconds
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def add(self, profiler):
+        with self.lock:
+            self.profiles.append(profiler)
+
+def start_profile(seconds):
+    """Profile all commands for the next seconds; returns the .prof path, or None if already profiling"""
+    global profile_window
+    with profile_lock:
+        if profile_window is not None:
+            return None
+        profile_window = window = ProfileWindow(seconds)
+    timer = threading.Timer(seconds, finish_profile, args=(window,))
+    timer.daemon = True
+    timer.start()
+    return window.path
+
+def profile_call(function, *args):
+    """Run function(*args), under cProfile if a profiling window is open"""
+    window = profile_window
+    if window is None:
+        return function(*args)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active on this thread
+        return function(*args)
+    try:
+        return function(*args)
+    finally:
+        profiler.disable()
+        window.add(profiler)
+
+def finish_profile(window):
+    """Close a profiling window and write its merged stats and a text summary"""
+    global profile_window
+    with profile_lock:
+        if profile_window is window:
+            profile_window = None
+    with window.lock:
+        profiles = list(window.profiles)
+    try:
+        with open(summary_path(window.path), 'w') as f:
+            if not profiles:
+                f.write(f"No commands ran in the {window.seconds}s window.\n")
+                return
+            stats = pstats.Stats(profiles[0], stream=f)
+            for profiler in profiles[1:]:
+                stats.add(profiler)
+            stats.dump_stats(window.path)
+            f.write(f"{len(profiles)} commands profiled over {window.seconds}s\n")
+            stats.sort_stats("cumulative").print_stats(SUMMARY_LINES)
+    except OSError as e:
+        print(f"Error writing profile: {e}")
+
+def heap_snapshot(action):
+    """Start or stop tracemalloc, or write a snapshot; returns the reply to send"""
+    global last_snapshot
+    if action == "start":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        return {"status": "ok", "tracing": True}
+    if action == "stop":
+        tracemalloc.stop()
+        with snapshot_lock:
+            last_snapshot = None
+        return {"status": "ok", "tracing": False}
+    if action != "snapshot":
+        return {"status": "error", "message": "Action must be start, snapshot or stop"}
+    if not tracemalloc.is_tracing():
+        return {"status": "error", "message": "tracemalloc is not running; start it first"}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    path = output_path("heap", "snap")
+    with snapshot_lock:
+        previous, last_snapshot = last_snapshot, snapshot
+    try:
+        snapshot.dump(path)
+        with open(summary_path(path), 'w') as f:
+            current, peak = tracemalloc.get_traced_memory()
+            f.write(f"traced: {current} bytes, peak {peak} bytes\n\nTop allocations by line:\n")
+            for stat in snapshot.statistics("lineno")[:SUMMARY_LINES]:
+                f.write(f"{stat}\n")
+            if previous is not None:
+                f.write("\nGrowth since the previous snapshot:\n")
+                for stat in snapshot.compare_to(previous, "lineno")[:SUMMARY_LINES]:
+                    f.write(f"{stat}\n")
+    except OSError as e:
+        print(f"Error writing heap snapshot: {e}")
+        return {"status": "error", "message": "Could not write the snapshot"}
+    return {"status": "ok", "path": path, "summary": summary_path(path)}
@@ -0,0 +1,111 @@
+"""Passing a running server's sockets and state to a new process over a Unix socket, with SCM_RIGHTS"""
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+
+# Most descriptors accepted in one read
+MAX_FDS = 8
+# Bytes read from the socket at a time
+RECV_SIZE = 64 * 1024
+# Length prefix of every message
+HEADER = struct.Struct("!I")
+
+def listen(path):
+    """Listen on a Unix socket that only this user can connect to, replacing a stale one"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    # Whoever connects gets the server's sockets, so keep other users out
+    os.chmod(path, 0o600)
+    sock.listen(1)
+    return sock
+
+class Channel:
+    """One end of the connection between the old and the new process"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.buffer = b""
+        # One read can carry the descriptors of several messages; each takes its "fds" count in order
+        self.fds = collections.deque()
+
+    @classmethod
+    def connect(cls, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        return cls(sock)
+
+    def send(self, message, fds=()):
+        """Send a message and any descriptors; False if the other process has gone away"""
+        data = json.dumps(dict(message, fds=len(fds))).encode('utf-8')
+        frame = HEADER.pack(len(data)) + data
+        try:
+            with self.lock:
+                # The descriptors go with the first bytes of the message
+                sent = socket.send_fds(self.sock, [frame], list(fds)) if fds else 0
+                self.sock.sendall(frame[sent:])
+            return True
+        except OSError as e:
+            print(f"Error sending to the other server process: {e}")
+            return False
+
+    def receive(self):
+        """Return the next (message, descriptors), or (None, []) once the other process has closed the channel"""
+        while True:
+            if len(self.buffer) >= HEADER.size:
+                (length,) = HEADER.unpack_from(self.buffer)
+                end = HEADER.size + length
+                if len(self.buffer) >= end:
+                    message = json.loads(self.buffer[HEADER.size:end])
+                    self.buffer = self.buffer[end:]
+                    fds = [self.fds.popleft() for _ in range(message.pop("fds", 0))]
+                    return message, fds
+            data, fds, flags, _ = socket.recv_fds(self.sock, RECV_SIZE, MAX_FDS)
+            self.fds.extend(fds)
+            if flags & socket.MSG_CTRUNC:
+                raise OSError("descriptors from the other server process were cut off")
+            if not data:
+                return None, []
+            self.buffer += data
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds.clear()
+        self.sock.close()
+
+class Wakeup:
+    """A flag that select() can wait on next to sockets; it stays readable until clear() is called"""
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.lock = threading.Lock()
+        self.is_set = False
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def set(self):
+        with self.lock:
+            if not self.is_set:
+                self.is_set = True
+                self.writer.send(b"\0")
+
+    def clear(self):
+        with self.lock:
+            if self.is_set:
+                self.is_set = False
+                try:
+                    self.reader.recv(16)
+                except BlockingIOError:
+                    pass
@@ -0,0 +1,148 @@
+"""Where product image bytes live: files in a directory, or rows in SQLite.
+
+Uploads always arrive in a durable temp file first. Inside the write
+transaction that creates the product, the server hands that file to the
+configured store, and it reads images back through the same store when
+sending them. Both backends copy in fixed-size chunks, so no image is ever
+held in memory whole. Running this module directly compares the two on a
+catalog of many small images.
+"""
+import os
+import sqlite3
+
+# Bytes copied per read or write when moving image data
+CHUNK_SIZE = 64 * 1024
+
+def blob_io_available():
+    """True if this sqlite3 module supports incremental BLOB I/O (Python 3.11+)"""
+    return hasattr(sqlite3.Connection, "blobopen")
+
+def fsync_directory(path):
+    """Flush a directory entry to disk so a rename inside it survives a crash"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class FileImageStore:
+    """Images stored as "<product_id>.jpg" files in one directory"""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def store(self, db, temp_path, product_id):
+        """Move a durable temp upload into place as a product's image; returns its name.
+
+        The directory entry is not synced here; call sync before committing.
+        """
+        image_name = f"{product_id}.jpg"
+        os.replace(temp_path, os.path.join(self.directory, image_name))
+        return image_name
+
+    def sync(self):
+        """Make the images stored since the last sync durable"""
+        fsync_directory(self.directory)
+
+    def discard(self, image_name, temp_path):
+        """Move an image whose transaction did not commit back to the temp upload it came from"""
+        try:
+            os.replace(os.path.join(self.directory, image_name), temp_path)
+        except OSError:
+            pass
+
+    def open(self, db, product_id):
+        """Return (size, readable stream) for a product's image, or None if it has none"""
+        try:
+            f = open(os.path.join(self.directory, f"{product_id}.jpg"), 'rb')
+        except FileNotFoundError:
+            return None
+        return os.fstat(f.fileno()).st_size, f
+
+class SQLiteImageStore:
+    """Images stored in the images table, keyed by product ID.
+
+    Data is written into a zeroblob of the right size and read back with
+    Connection.blobopen, CHUNK_SIZE bytes at a time.
+    """
+    def store(self, db, temp_path, product_id):
+        """Copy a durable temp upload into the images table and delete the file; returns its name"""
+        size = os.path.getsize(temp_path)
+        db.execute("INSERT OR REPLACE INTO images (product_id, data) VALUES (?, zeroblob(?))", (product_id, size))
+        with open(temp_path, 'rb') as f, db.blobopen("images", "data", product_id) as blob:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                blob.write(chunk)
+        os.remove(temp_path)
+        return f"{product_id}.jpg"
+
+    def sync(self):
+        """Nothing to do: the image commits with its transaction"""
+
+    def discard(self, image_name, temp_path):
+        """Nothing to do: the rolled-back transaction already removed the row"""
+
+    def open(self, db, product_id):
+        """Return (size, readable blob) for a product's image, or None if it has none"""
+        try:
+            blob = db.blobopen("images", "data", int(product_id), readonly=True)
+        except (sqlite3.OperationalError, TypeError, ValueError):
+            return None
+        return len(blob), blob
+
+IMAGES_TABLE = "CREATE TABLE IF NOT EXISTS images (product_id INTEGER PRIMARY KEY, data BLOB)"
+
+def benchmark(num_images=5000, image_size=4096):
+    """Store and read back num_images small images with each backend"""
+    import shutil
+    import tempfile
+    import time
+
+    root = tempfile.mkdtemp(prefix="image_storage_bench")
+    try:
+        payload = os.urandom(image_size)
+        for label in ("filesystem", "sqlite"):
+            workdir = os.path.join(root, label)
+            os.makedirs(workdir)
+            db = sqlite3.connect(os.path.join(workdir, "images.db"), isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(IMAGES_TABLE)
+            store = FileImageStore(workdir) if label == "filesystem" else SQLiteImageStore()
+            temp_paths = []
+            for product_id in range(1, num_images + 1):
+                temp_path = os.path.join(workdir, f"{product_id}.part")
+                with open(temp_path, 'wb') as f:
+                    f.write(payload)
+                temp_paths.append(temp_path)
+
+            start = time.perf_counter()
+            # Commit in groups of 64, like the server's writer thread
+            for offset in range(0, num_images, 64):
+                db.execute("BEGIN IMMEDIATE")
+                for product_id in range(offset + 1, min(offset + 64, num_images) + 1):
+                    store.store(db, temp_paths[product_id - 1], product_id)
+                store.sync()
+                db.execute("COMMIT")
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            total = 0
+            for product_id in range(1, num_images + 1):
+                size, stream = store.open(db, product_id)
+                with stream:
+                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                        total += len(chunk)
+            read_time = time.perf_counter() - start
+            assert total == num_images * image_size
+            db.close()
+            print(f"{label}: store {num_images / write_time:.0f} images/s, read {num_images / read_time:.0f} images/s")
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    if not blob_io_available():
+        raise SystemExit("This Python's sqlite3 module has no Connection.blobopen")
+    benchmark()
@@ -0,0 +1,247 @@
+"""Replay a traffic capture against a server and compare it with the recording.
+
+Usage:
+    python replay.py capture.jsonl --port 9000 [--speed 1 | 4 | max]
+
+Start the target server on a fresh database so IDs line up with the
+recording. Each recorded connection is replayed on its own socket and
+thread. Exchanges start at their recorded offsets divided by --speed, or
+back to back with --speed max. With max, order is kept within a connection
+but not across connections. Text is sent as recorded. Binary payloads
+are replaced by deterministic bytes of the recorded size, and client-side
+checksums of them are dropped from commands. Session tokens and upload IDs
+handed out by the server are mapped to the ones the new run issues.
+
+The report compares latency per command and lists replies that differ from
+the recording.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import socket
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from capture import HASH_DIGITS, OUT_TEXT_LIMIT, as_text
+
+# Fields the server generates that later commands quote back to it
+SERVER_ISSUED_FIELDS = ("token", "upload_id")
+# Reply fields that differ between runs by design (random IDs, ports, digests of synthetic payloads)
+VOLATILE_FIELDS = ("token", "upload_id", "port", "sha256")
+# Command fields holding client-side checksums of payloads the replay cannot reproduce
+CHECKSUM_FIELDS = re.compile(r',?\s*"(?:sha256|image_sha256)":\s*(?:"[0-9a-f]*"|null)')
+# Mismatched replies printed in the report
+MAX_EXAMPLES = 10
+
+def load_capture(path):
+    """Return the recorded connections: id -> list of records in time order"""
+    connections = defaultdict(list)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if "c" in record:
+                connections[record["c"]].append(record)
+    for records in connections.values():
+        records.sort(key=lambda record: record["t"])
+    return connections
+
+def synthetic_payload(recorded):
+    """Deterministic stand-in bytes for a binary payload known only by hash and size"""
+    return random.Random(recorded["h"]).randbytes(recorded["n"])
+
+def describe(data):
+    """Describe received bytes the way capture.py records replies"""
+    text = as_text(data) if len(data) <= OUT_TEXT_LIMIT else None
+    if text is not None:
+        return {"d": text}
+    return {"h": hashlib.sha256(data).hexdigest()[:HASH_DIGITS], "n": len(data)}
+
+def command_name(text):
+    match = re.search(r'"command":\s*"([^"]*)"', text)
+    return match.group(1) if match else None
+
+def server_issued(text):
+    """Values of SERVER_ISSUED_FIELDS in a JSON reply"""
+    try:
+        reply = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(reply, dict):
+        return {}
+    return {field: reply[field] for field in SERVER_ISSUED_FIELDS if isinstance(reply.get(field), str)}
+
+class Replay:
+    def __init__(self, connections, host, port, speed, idle_timeout, response_timeout):
+        self.connections = connections
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.idle_timeout = idle_timeout
+        self.response_timeout = response_timeout
+        # Recorded server-issued values -> the values the replayed server issued
+        self.aliases = {}
+        self.aliases_lock = threading.Lock()
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.start = None
+
+    def run(self):
+        threads = [threading.Thread(target=self.replay_connection, args=(records,), daemon=True)
+                   for records in self.connections.values()]
+        self.start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - self.start
+
+    def wait_until(self, offset):
+        if self.speed is None:
+            return
+        delay = self.start + offset / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def rewrite(self, text):
+        """Drop payload checksums and swap recorded tokens for replayed ones"""
+        text = CHECKSUM_FIELDS.sub("", text).replace('{,', '{')
+        with self.aliases_lock:
+            for recorded, replayed in self.aliases.items():
+                text = text.replace(recorded, replayed)
+        return text
+
+    def receive(self, sock, expected):
+        """Read a reply of about expected bytes; stops early once the server goes quiet"""
+        data = bytearray()
+        deadline = time.monotonic() + self.response_timeout
+        while len(data) < expected:
+            timeout = self.idle_timeout if data else deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            sock.settimeout(timeout)
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                break
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def replay_connection(self, records):
+        sock = None
+        try:
+            sock = socket.create_connection((self.host, self.port))
+            for record in records:
+                self.wait_until(record["t"])
+                if record.get("close"):
+                    break
+                self.replay_exchange(sock, record)
+        except OSError as e:
+            print(f"Connection {records[0]['c']}: {e}", file=sys.stderr)
+        finally:
+            if sock:
+                sock.close()
+
+    def replay_exchange(self, sock, record):
+        recorded_in = record["in"]
+        command = None
+        if "d" in recorded_in:
+            text = self.rewrite(recorded_in["d"])
+            command = command_name(text)
+            payload = text.encode('utf-8')
+        else:
+            payload = synthetic_payload(recorded_in)
+        recorded_out = record.get("out")
+        expected = 0
+        if recorded_out:
+            expected = len(recorded_out["d"].encode('utf-8')) if "d" in recorded_out else recorded_out["n"]
+        sent_at = time.monotonic()
+        if payload:
+            sock.sendall(payload)
+        reply = self.receive(sock, expected) if expected else b""
+        latency_ms = (time.monotonic() - sent_at) * 1000 if reply else None
+        replayed_out = describe(reply) if reply else None
+        if recorded_out and "d" in recorded_out and replayed_out and "d" in replayed_out:
+            issued = server_issued(replayed_out["d"])
+            with self.aliases_lock:
+                for field, value in server_issued(recorded_out["d"]).items():
+                    if field in issued:
+                        self.aliases[value] = issued[field]
+        with self.results_lock:
+            self.results.append({
+                "connection": record["c"], "command": command or ("payload" if "h" in recorded_in else "handshake"),
+                "recorded_ms": record.get("ms"), "replayed_ms": latency_ms,
+                "recorded": recorded_out, "replayed": replayed_out,
+            })
+
+def comparable(reply):
+    """A reply with VOLATILE_FIELDS removed from JSON text, for comparing runs"""
+    if not reply or "d" not in reply:
+        return reply
+    try:
+        message = json.loads(reply["d"])
+    except ValueError:
+        return reply
+    if isinstance(message, dict):
+        return {key: value for key, value in message.items() if key not in VOLATILE_FIELDS}
+    return message
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def report(results, elapsed, recorded_span):
+    print(f"Replayed {len(results)} exchanges in {elapsed:.2f}s (recorded span {recorded_span:.2f}s)\n")
+    by_command = defaultdict(list)
+    for result in results:
+        by_command[result["command"]].append(result)
+    print(f"{'command':<20} {'count':>6} {'rec p50':>9} {'new p50':>9} {'rec p95':>9} {'new p95':>9}  (ms)")
+    for command, rows in sorted(by_command.items(), key=lambda item: -len(item[1])):
+        recorded = [row["recorded_ms"] for row in rows if row["recorded_ms"] is not None]
+        replayed = [row["replayed_ms"] for row in rows if row["replayed_ms"] is not None]
+        cells = []
+        for values, fraction in ((recorded, 0.5), (replayed, 0.5), (recorded, 0.95), (replayed, 0.95)):
+            cells.append(f"{percentile(values, fraction):9.2f}" if values else f"{'-':>9}")
+        print(f"{command:<20} {len(rows):>6} {' '.join(cells)}")
+    recorded = [row["recorded_ms"] for row in results if row["recorded_ms"] is not None and row["replayed_ms"] is not None]
+    replayed = [row["replayed_ms"] for row in results if row["recorded_ms"] is not None and row["replayed_ms"] is not None]
+    if recorded:
+        print(f"\nMean latency: recorded {statistics.mean(recorded):.2f} ms, replayed {statistics.mean(replayed):.2f} ms")
+
+    mismatches = [row for row in results if comparable(row["recorded"]) != comparable(row["replayed"])]
+    different_size = [row for row in mismatches if not (row["recorded"] and row["replayed"]
+                      and "h" in row["recorded"] and "h" in row["replayed"] and row["recorded"]["n"] == row["replayed"]["n"])]
+    print(f"\nMatching replies: {len(results) - len(mismatches)}/{len(results)}; "
+          f"{len(mismatches) - len(different_size)} differ only in content, {len(different_size)} differ in text or size")
+    for row in different_size[:MAX_EXAMPLES]:
+        print(f"  connection {row['connection']} {row['command']}:\n    recorded {row['recorded']}\n    replayed {row['replayed']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against a server")
+    parser.add_argument("capture", help="capture file written by the server's CAPTURE_FILE option")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, required=True, help="command port of the server to drive")
+    parser.add_argument("--speed", default="1", help="time scale: 1 for real time, N for N times faster, or max")
+    parser.add_argument("--idle-timeout", type=float, default=0.25,
+                        help="seconds of silence that end a reply shorter than recorded")
+    parser.add_argument("--response-timeout", type=float, default=10.0, help="longest wait for a reply to start")
+    args = parser.parse_args(argv)
+    speed = None if args.speed == "max" else float(args.speed)
+    if speed is not None and speed <= 0:
+        parser.error("--speed must be positive or 'max'")
+    connections = load_capture(args.capture)
+    if not connections:
+        parser.error("the capture holds no traffic")
+    recorded_span = max(record["t"] for records in connections.values() for record in records)
+    replay = Replay(connections, args.host, args.port, speed, args.idle_timeout, args.response_timeout)
+    elapsed = replay.run()
+    report(replay.results, elapsed, recorded_span)
+
+if __name__ == "__main__":
+    sys.exit(main())
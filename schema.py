@@ -0,0 +1,57 @@
+"""The marketplace's SQLite schema, shared by the server and the offline tools"""
+import sqlite3
+
+import image_storage
+
+def create_Tables(db_path, shard=0):
+    """Create database tables if they don't exist; shards other than 0 hold no users, so drop the foreign keys to it"""
+    db = sqlite3.connect(db_path)
+    cursor = db.cursor()
+    db.execute("PRAGMA foreign_keys=on")
+    # WAL lets handler threads keep reading while the writer thread commits
+    db.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(image_storage.IMAGES_TABLE)
+    if shard == 0:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT UNIQUE, 
+                        email TEXT, 
+                        password TEXT,
+                        name TEXT)''')
+    def users_key(column):
+        return f", FOREIGN KEY ({column}) REFERENCES users(id)" if shard == 0 else ""
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS products (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                        owner_id INTEGER , 
+                        name TEXT, 
+                        price REAL, 
+                        description TEXT, 
+                        image BLOB,
+                        amount INTEGER,
+                        rating REAL DEFAULT 0,
+                        num_raters INTEGER DEFAULT 0, 
+                        buyer_id INTEGER, 
+                        status TEXT DEFAULT 'available'{users_key("owner_id")}{users_key("buyer_id")})''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS orders (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        product_id INTEGER,
+                        buyer_id INTEGER,
+                        seller_id INTEGER,
+                        price REAL,
+                        created_at TEXT,
+                        FOREIGN KEY (product_id) REFERENCES products(id){users_key("buyer_id")}{users_key("seller_id")})''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS orders_by_seller ON orders (seller_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS orders_by_buyer ON orders (buyer_id, product_id)")
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS seller_stats (
+                        seller_id INTEGER PRIMARY KEY,
+                        orders INTEGER DEFAULT 0,
+                        revenue REAL DEFAULT 0{users_key("seller_id")})''')
+    # Databases from before the ledger only know each product's last buyer
+    if not cursor.execute("SELECT 1 FROM orders LIMIT 1").fetchone():
+        cursor.execute('''INSERT INTO orders (product_id, buyer_id, seller_id, price)
+                          SELECT id, buyer_id, owner_id, price FROM products WHERE buyer_id IS NOT NULL ORDER BY id''')
+        cursor.execute('''INSERT OR REPLACE INTO seller_stats (seller_id, orders, revenue)
+                          SELECT seller_id, COUNT(*), SUM(price) FROM orders GROUP BY seller_id''')
+
+    db.commit()
+    db.close()
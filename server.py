@@ -5,11 +5,343 @@ import bcrypt
 import os
 import json
 import sys
+import hashlib
+import tempfile
+import secrets
+import time
+import re
+import bisect
+import queue
+import select
+import collections
+import concurrent.futures
+import heapq
+import http.server
 from datetime import datetime, timedelta
+import columnar_catalog
+import image_storage
+import diagnostics
+import capture
+import currency
+import handoff
+from schema import create_Tables
 
 # Dictionary to track currently connected users
 online_users = {}
 
+# Authenticated identity of each connection: socket -> (username, user_id)
+connection_users = {}
+# Session tokens that let extra connections attach to a login without bcrypt
+session_tokens = {}
+session_tokens_lock = threading.Lock()
+# How long a session token stays valid, in seconds
+SESSION_TOKEN_TTL = 24 * 60 * 60
+
+# Directory holding product images, named "<product_id>.jpg"
+IMAGE_DIR = "product_images"
+# Image backend: "fs" keeps "<product_id>.jpg" files in IMAGE_DIR, "sqlite" keeps them in the images table
+IMAGE_STORAGE = "fs"
+# The store product images are written to and read from; handle_server picks it from IMAGE_STORAGE
+image_store = image_storage.FileImageStore(IMAGE_DIR)
+# Also serve product images over a local HTTP/1.1 listener, so downloads stay off the command connection
+SERVE_IMAGES_OVER_HTTP = True
+# Port of the image listener; 0 lets the OS pick one, which clients learn with image_endpoint
+IMAGE_HTTP_PORT = 0
+# Port the image listener is bound to, or None while it is not running
+image_http_port = None
+# The running image listener, or None
+image_httpd = None
+# Largest image upload accepted, in bytes
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+# Size of each upload chunk; the server acknowledges every full chunk with PROGRESS
+UPLOAD_CHUNK_SIZE = 8192
+# Largest JSON command frame accepted from a client, in bytes
+MAX_COMMAND_SIZE = 64 * 1024
+# Directory holding resumable upload sessions ("<upload_id>.part" plus "<upload_id>.json")
+UPLOAD_SESSION_DIR = os.path.join(IMAGE_DIR, "uploads")
+# Largest chunk a client may send in one upload_chunk command
+UPLOAD_SESSION_CHUNK_SIZE = 256 * 1024
+# Most products accepted in one sell_batch command
+MAX_BATCH_ITEMS = 200
+# Largest total image payload accepted in one sell_batch command, in bytes
+MAX_BATCH_BYTES = 256 * 1024 * 1024
+
+# Resumable upload sessions by upload ID, mirrored on disk so they survive reconnects
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+
+# Serve the budget and owner filters from an in-memory NumPy snapshot when NumPy is installed
+USE_COLUMNAR_CATALOG = True
+# The live columnar snapshot, or None when the filters query SQLite directly
+catalog = None
+# Exchange rates for the currency field of display, search and the filters; reloaded when the file changes
+CURRENCY_RATES_FILE = "currency_rates.json"
+# The rate table read from CURRENCY_RATES_FILE; prices in the products table are in its base currency
+rates = currency.RateTable(CURRENCY_RATES_FILE)
+# ORDER BY clauses for the sort options the filters accept
+SQL_SORT_ORDERS = {"price": "price ASC", "price_desc": "price DESC", "rating": "rating DESC"}
+
+# Completions returned by suggest when the client does not ask for a number, and the most it may ask for
+SUGGEST_LIMIT = 10
+MAX_SUGGEST_LIMIT = 50
+
+# Rows per NDJSON frame when a query result is streamed
+STREAM_BATCH_SIZE = 500
+
+# Connections subscribed to presence pushes; their handlers only read keepalives
+presence_subscribers = set()
+# Connections subscribed to catalog changes: last sequence number sent, None until the backlog is replayed
+catalog_subscribers = {}
+push_subscribers_lock = threading.Lock()
+# Presence and catalog changes waiting to be pushed by the broadcaster thread
+push_events = queue.Queue()
+# Recent catalog changes kept so subscribers can resume after a reconnect
+CATALOG_FEED_SIZE = 10000
+catalog_feed = collections.deque(maxlen=CATALOG_FEED_SIZE)
+catalog_feed_lock = threading.Lock()
+catalog_seq = 0
+# Identifies this run of the server; sequence numbers restart when it changes
+CATALOG_EPOCH = secrets.token_hex(8)
+
+# Orders returned per page by view_buyers when the client does not ask for a number, and the most it may ask for
+ORDERS_PAGE_SIZE = 50
+MAX_ORDERS_PAGE_SIZE = 500
+
+# The main database file: users, and with SHARD_COUNT 1 everything else too
+DB_PATH = "botique.db"
+# Split products, orders and seller stats by owner across this many "botique.shard<k>.db" files (DB_PATH is shard 0)
+SHARD_COUNT = 1
+# Threads running the per-shard queries of scatter-gather reads
+SHARD_READ_WORKERS = 16
+# Runs scatter-gather reads when SHARD_COUNT > 1; started in handle_server
+shard_pool = None
+# Each thread's read connections to the shard files other than its own main connection
+shard_readers = threading.local()
+
+# Seconds a writer thread waits for more writes to join a group before committing it
+GROUP_COMMIT_WINDOW = 0.002
+# Most writes committed together in one transaction
+GROUP_COMMIT_SIZE = 64
+# Seconds a handler waits for its shard's writer before giving up on the write and reporting an error
+WRITE_TIMEOUT = 30
+# Writes waiting for each shard's writer thread: (operation, args, stores_images, on_commit, on_rollback, command, future)
+write_queues = []
+# Each shard's writer connection; empty until start_writers runs (handlers then write on their own)
+writer_dbs = []
+# Serializes handlers' own commits and on_commit steps until the writer threads start
+direct_write_lock = threading.Lock()
+
+# Purchases of one product name waiting on the writer at once before it turns into a flash sale; None never does
+FLASH_SALE_CONCURRENCY = 8
+# Most purchases a flash sale writes through in one write operation
+FLASH_SALE_BATCH_SIZE = 256
+# Seconds without a purchase after which a flash sale hands its product back to the regular path
+FLASH_SALE_IDLE_TIMEOUT = 60
+# Running flash sales by product name
+flash_sales = {}
+flash_sales_lock = threading.Lock()
+# Regular purchases of each product name waiting on the writer, for spotting hot items
+purchases_in_flight = collections.Counter()
+# No flash sales start while an old and a new process could both be selling from SQLite
+flash_sales_paused = False
+
+# Unix socket a running server listens on for a new process started with --takeover; None turns takeovers off
+RESTART_SOCKET = "botique.restart.sock"
+# Seconds a server that handed over waits for its in-flight commands before exiting and dropping what is left
+DRAIN_TIMEOUT = 30
+# Channel to the process this one is handing over to, once it holds the listening socket
+successor = None
+# Channel to the process this one took over from, until that process has drained
+predecessor = None
+# Set to make the accept loop stop, then to send every idle connection to the successor
+stop_accepting = handoff.Wakeup()
+release_connections = handoff.Wakeup()
+accepting_stopped = threading.Event()
+handoff_finished = threading.Event()
+
+# Record every connection's traffic to this file for replay.py; None turns capture off
+CAPTURE_FILE = None
+# The open capture, or None
+traffic_capture = None
+
+# Users allowed to run the profiling commands (profile, heap)
+ADMIN_USERS = {"admin"}
+
+# Pending connections the kernel queues before accept()
+LISTEN_BACKLOG = 100
+# Most client connections served at once; extra connections are told to retry
+MAX_CONNECTIONS = 200
+# Suggested client back-off when a request is shed, in milliseconds
+BUSY_RETRY_MS = 250
+# Rate limit class of each command; unlisted commands use "default"
+COMMAND_CLASSES = {
+    "Register": "auth", "login": "auth", "issue_token": "auth", "resume_session": "auth",
+    "search": "search", "suggest": "suggest", "display": "search", "filter_by_owner": "search", "filter_by_budget": "search",
+    "get_image": "image", "begin_upload": "image", "upload_chunk": "image", "query_upload": "image", "finish_upload": "image",
+    "sell": "write", "sell_batch": "write", "Purchase": "write", "rate": "write",
+    "view_buyers": "search", "seller_stats": "search",
+    "ping": "heartbeat", "subscribe_presence": "heartbeat", "subscribe_catalog": "heartbeat",
+}
+# Token bucket per user (or per connection before login) and class: (tokens per second, burst size)
+RATE_LIMITS = {
+    "auth": (1.0, 5),
+    "search": (5.0, 10),
+    "suggest": (20.0, 40),
+    "image": (50.0, 100),
+    "write": (5.0, 10),
+    "flash_sale": (20.0, 40),
+    "heartbeat": (5.0, 20),
+    "default": (20.0, 40),
+}
+# Token bucket per class shared by all connections that have not logged in, capping pre-login traffic as a whole
+ANONYMOUS_RATE_LIMITS = {
+    "auth": (20.0, 40),
+    "default": (100.0, 200),
+}
+# Most commands of a class running at once across all clients; more are shed. "flash_sale" is uncapped
+MAX_IN_FLIGHT = {"search": 16, "image": 32, "write": 32}
+
+# Seconds a connection may sit between commands before it is closed
+IDLE_TIMEOUT = 300
+# Seconds any single read or write inside a command may block
+OPERATION_TIMEOUT = 30
+# Seconds between passes of the stale-session reaper
+REAPER_INTERVAL = 30
+# Seconds an unfinished upload session is kept before the reaper deletes it
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# Last time each live connection moved bytes either way (time.monotonic())
+connection_activity = {}
+
+active_connections = 0
+active_connections_lock = threading.Lock()
+rate_limit_buckets = {}
+rate_limit_lock = threading.Lock()
+in_flight_slots = {command_class: threading.BoundedSemaphore(limit) for command_class, limit in MAX_IN_FLIGHT.items()}
+
+class TokenBucket:
+    """Token bucket rate limiter refilled continuously at a fixed rate"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token; returns 0 on success or the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class NameIndex:
+    """Sorted index of in-stock product names for prefix lookups.
+
+    Entries are (lowercased name, product id) pairs kept in order, so every name
+    starting with a prefix sits in one contiguous run found with bisect.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = []
+        self.names = {}
+
+    def add(self, product_id, name):
+        """Index a product that is in stock"""
+        with self.lock:
+            if product_id in self.names:
+                return
+            self.names[product_id] = name
+            bisect.insort(self.keys, (name.lower(), product_id))
+
+    def load(self, rows):
+        """Index many (product id, name) rows at once with a single sort"""
+        with self.lock:
+            for product_id, name in rows:
+                if product_id not in self.names:
+                    self.names[product_id] = name
+                    self.keys.append((name.lower(), product_id))
+            self.keys.sort()
+
+    def remove(self, product_id):
+        """Drop a product that sold out"""
+        with self.lock:
+            name = self.names.pop(product_id, None)
+            if name is None:
+                return
+            key = (name.lower(), product_id)
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def suggest(self, prefix, limit):
+        """Up to limit distinct names starting with prefix, in alphabetical order"""
+        prefix = prefix.lower()
+        suggestions = []
+        seen = set()
+        with self.lock:
+            i = bisect.bisect_left(self.keys, (prefix,))
+            while i < len(self.keys) and len(suggestions) < limit:
+                key, product_id = self.keys[i]
+                if not key.startswith(prefix):
+                    break
+                name = self.names[product_id]
+                if name not in seen:
+                    seen.add(name)
+                    suggestions.append(name)
+                i += 1
+        return suggestions
+
+# In-stock product names for the suggest command, filled in handle_server
+name_index = NameIndex()
+
+class ClientConnection:
+    """Client socket that hands back bytes read past a command, and passes traffic to capture when it is on"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = b""
+        self.capture = None
+        # Rate limit buckets by class while the connection has not logged in
+        self.rate_limits = {}
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+    def touch(self):
+        """Record progress, so the reaper leaves a long but moving command alone"""
+        if self in connection_activity:
+            connection_activity[self] = time.monotonic()
+
+    def recv(self, bufsize, flags=0):
+        if self.pending:
+            data = self.pending[:bufsize]
+            self.pending = self.pending[bufsize:]
+            return data
+        data = self.sock.recv(bufsize, flags)
+        if data:
+            self.touch()
+        if self.capture and data:
+            self.capture.inbound(data)
+        return data
+
+    def send(self, data, flags=0):
+        sent = self.sock.send(data, flags)
+        self.touch()
+        if self.capture:
+            self.capture.outbound(data[:sent])
+        return sent
+
+    def sendall(self, data, flags=0):
+        self.sock.sendall(data, flags)
+        self.touch()
+        if self.capture:
+            self.capture.outbound(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
 def authenticate_user(server_socket, username, password, db):
     """Authenticate a user by checking username and password against database"""
     try:
@@ -25,46 +357,461 @@ def authenticate_user(server_socket, username, password, db):
         print(f"Database error during authentication: {e}")
         return False
 
-def handle_client(server_socket, client_socket, addr, db_path):
-    """Handle individual client connections and process their requests"""
+def read_command(client_socket):
+    """Read one JSON command, keeping any trailing bytes for the handler; None once the client has gone"""
+    data = b""
+    decoder = json.JSONDecoder()
+    while True:
+        chunk = client_socket.recv(1024)
+        if not chunk:
+            return None
+        data += chunk
+        # surrogateescape keeps binary payload bytes after the JSON intact
+        text = data.decode('utf-8', errors='surrogateescape').lstrip()
+        if text and not text.startswith('{'):
+            # Stray handshake bytes left over from an aborted exchange; skip to the next command
+            start = text.find('{')
+            print(f"Discarding unexpected data from client: {text[:start if start >= 0 else 40]!r}")
+            text = text[start:] if start >= 0 else ""
+            data = text.encode('utf-8', errors='surrogateescape')
+            if not text:
+                continue
+        try:
+            message, end = decoder.raw_decode(text)
+        except json.JSONDecodeError:
+            if len(data) > MAX_COMMAND_SIZE:
+                raise ValueError("Command too large")
+            continue
+        leftover = text[end:].encode('utf-8', errors='surrogateescape')
+        if leftover:
+            client_socket.unread(leftover)
+        return message
+
+def send_busy(client_socket, retry_after_ms):
+    """Tell the client its request was shed and when to retry"""
+    response = {"status": "busy", "error": f"Server busy, retry after {retry_after_ms} ms", "retry_after_ms": retry_after_ms}
+    client_socket.send(json.dumps(response).encode('utf-8'))
+
+def rate_limited_user(client_socket, message):
+    """The username a request is charged to, or None for a connection that has not logged in.
+
+    resume_session is charged to the user its token belongs to, so attaching
+    pooled and push connections never competes with other users' logins.
+    """
+    identity = get_connection_user(client_socket)
+    if identity:
+        return identity[0]
+    if message["command"] == "resume_session":
+        with session_tokens_lock:
+            session = session_tokens.get(message.get("token"))
+        if session:
+            return session["username"]
+    return None
+
+def take_token(buckets, key, rate, burst):
+    """Take one token from buckets[key], creating the bucket full; returns 0 or the seconds to wait"""
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = TokenBucket(rate, burst)
+    return bucket.take()
+
+def check_rate_limit(client_socket, message, command_class):
+    """Charge one request to the caller's bucket; returns milliseconds to wait, or 0.
+
+    Before login every connection has buckets of its own, and all of them
+    together also draw on ANONYMOUS_RATE_LIMITS. Clients that all connect from
+    localhost can then log in at once, while opening many connections to get
+    around the limit still runs into the shared cap.
+    """
+    username = rate_limited_user(client_socket, message)
+    rate, burst = RATE_LIMITS.get(command_class, RATE_LIMITS["default"])
+    with rate_limit_lock:
+        if username is not None:
+            wait = take_token(rate_limit_buckets, (("user", username), command_class), rate, burst)
+        else:
+            wait = take_token(client_socket.rate_limits, command_class, rate, burst)
+            if not wait:
+                wait = take_token(rate_limit_buckets, (("anonymous",), command_class),
+                                  *ANONYMOUS_RATE_LIMITS.get(command_class, ANONYMOUS_RATE_LIMITS["default"]))
+    return int(wait * 1000) + 1 if wait else 0
+
+def prune_rate_limit_buckets(max_idle=600):
+    """Drop buckets that have been idle long enough to be full again"""
+    cutoff = time.monotonic() - max_idle
+    with rate_limit_lock:
+        for key, bucket in list(rate_limit_buckets.items()):
+            if bucket.updated < cutoff:
+                del rate_limit_buckets[key]
+
+def command_class_of(message):
+    """The rate limit class of a command"""
+    product_name = message.get("product_name")
+    if message["command"] == "Purchase" and isinstance(product_name, str) and product_name in flash_sales:
+        return "flash_sale"
+    return COMMAND_CLASSES.get(message["command"], "default")
+
+def run_command(server_socket, client_socket, message, db):
+    """Apply rate limits and in-flight caps, then dispatch the command"""
+    if not isinstance(message, dict) or "command" not in message:
+        client_socket.send("Invalid command format.".encode('utf-8'))
+        return
+    command_class = command_class_of(message)
+    retry_after_ms = check_rate_limit(client_socket, message, command_class)
+    if retry_after_ms:
+        send_busy(client_socket, retry_after_ms)
+        return
+    slots = in_flight_slots.get(command_class)
+    if slots and not slots.acquire(blocking=False):
+        send_busy(client_socket, BUSY_RETRY_MS)
+        return
+    try:
+        diagnostics.set_command(message["command"])
+        diagnostics.profile_call(handle_commands, server_socket, client_socket, message, db)
+    finally:
+        if slots:
+            slots.release()
+
+def handle_client(server_socket, client_socket, addr, db_path, inherited=None):
+    """Handle individual client connections and process their requests; inherited is a taken-over connection's state"""
+    client_socket = ClientConnection(client_socket)
     try:
-        db = sqlite3.connect(db_path)
+        db = diagnostics.connect(db_path)
     except sqlite3.Error as e:
         print(f"Error connecting to the database: {e}")
         client_socket.send("Server error. Please try again later.".encode('utf-8'))
         client_socket.close()
+        release_connection_slot()
         return
+    if traffic_capture:
+        client_socket.capture = traffic_capture.connection()
+    if inherited is not None:
+        restore_connection(client_socket, inherited)
+    connection_activity[client_socket] = time.monotonic()
+    handed_over = False
     while True:
         try:
-            raw_message = client_socket.recv(1024).decode('utf-8')
-            message = json.loads(raw_message)
+            client_socket.settimeout(IDLE_TIMEOUT)
+            if not wait_for_input(client_socket, IDLE_TIMEOUT):
+                handed_over = hand_over_connection(client_socket, addr)
+                break
+            if client_socket in presence_subscribers or client_socket in catalog_subscribers:
+                # Push-only connection: anything the client sends is a keepalive
+                if not client_socket.recv(1024):
+                    break
+                connection_activity[client_socket] = time.monotonic()
+                continue
+            message = read_command(client_socket)
+            connection_activity[client_socket] = time.monotonic()
+            # Every read or write inside the command gets its own deadline
+            client_socket.settimeout(OPERATION_TIMEOUT)
             if message:
-                handle_commands(server_socket, client_socket, message, db)
+                run_command(server_socket, client_socket, message, db)
             else:
                 break
+        except socket.timeout:
+            print(f"Closing idle connection {addr}")
+            break
         except Exception as e:
             print(f"Error with client {addr}: {e}")
             break
     
-    # Clean up user from online_users if they're still there
-    for username, sock in list(online_users.items()):
-        if sock == client_socket:
-            del online_users[username]
-            break
-            
+    release_client_resources(client_socket, announce=not handed_over)
     db.close()
+    close_shard_readers()
+    if client_socket.capture:
+        client_socket.capture.close()
     client_socket.close()
+    release_connection_slot()
+
+def release_client_resources(client_socket, announce=True):
+    """Forget a connection's presence, identity and activity record, announcing the logout unless told not to"""
+    # Clean up user from online_users if they're still there
+    for username, entry in list(online_users.items()):
+        if entry[0] == client_socket:
+            online_users.pop(username, None)
+            if announce:
+                publish_presence("offline", username)
+            break
+    connection_users.pop(client_socket, None)
+    connection_activity.pop(client_socket, None)
+    with push_subscribers_lock:
+        presence_subscribers.discard(client_socket)
+        catalog_subscribers.pop(client_socket, None)
+
+def wait_for_input(client_socket, timeout):
+    """Wait for the client's next bytes; False instead once idle connections go to the successor"""
+    waiting = 0 if client_socket.pending else timeout
+    readable, _, _ = select.select([client_socket, release_connections], [], [], waiting)
+    if release_connections in readable:
+        return False
+    if not readable and not client_socket.pending:
+        raise socket.timeout("timed out")
+    return True
+
+def hand_over_connection(client_socket, addr):
+    """Send an idle connection to the successor with its login, presence, subscriptions and read-ahead bytes"""
+    with push_subscribers_lock:
+        subscribed = client_socket in presence_subscribers or client_socket in catalog_subscribers
+    if subscribed:
+        # Let the broadcaster finish what it queued for this connection, so no push is cut in half
+        flushed = threading.Event()
+        push_events.put(("flush", flushed))
+        flushed.wait(DRAIN_TIMEOUT)
+    with push_subscribers_lock:
+        presence = client_socket in presence_subscribers
+        catalog_seen = catalog_subscribers.get(client_socket, False)
+        presence_subscribers.discard(client_socket)
+        catalog_subscribers.pop(client_socket, None)
+    online = next(([username, entry[1], entry[2]] for username, entry in list(online_users.items())
+                   if entry[0] == client_socket), None)
+    # The reaper shuts down stale sockets, which would cut the connection off in the successor too
+    connection_activity.pop(client_socket, None)
+    return successor.send({
+        "type": "connection", "addr": list(addr), "pending": client_socket.pending.hex(),
+        "identity": get_connection_user(client_socket), "online": online,
+        "presence": presence, "catalog": catalog_seen,
+    }, [client_socket.fileno()])
+
+def restore_connection(client_socket, state):
+    """Give a connection taken over from the previous process back its login, presence and subscriptions"""
+    client_socket.pending = bytes.fromhex(state["pending"])
+    if state["identity"]:
+        connection_users[client_socket] = tuple(state["identity"])
+    if state["online"]:
+        username, ip, port = state["online"]
+        online_users[username] = (client_socket, ip, port)
+    with push_subscribers_lock:
+        if state["presence"]:
+            presence_subscribers.add(client_socket)
+        if state["catalog"] is not False:
+            catalog_subscribers[client_socket] = None
+    if state["catalog"] is not False:
+        # Replays the changes published since this subscriber's last push, or resets it if its replay never ran
+        since = state["catalog"]
+        push_events.put(("subscribe_catalog", (client_socket, since if since is not None else 0,
+                                               CATALOG_EPOCH if since is not None else None)))
+
+def publish_presence(event, username, ip=None, port=None):
+    """Queue a presence change ("online" or "offline") for every subscriber"""
+    if successor is not None:
+        successor.send({"type": "presence", "event": event, "username": username, "ip": ip, "port": port})
+        return
+    push_events.put(("presence", {"type": "presence", "event": event, "username": username, "ip": ip, "port": port}))
+
+def publish_catalog(event, **fields):
+    """Record a catalog change ("listed", "amount", "sold" or "rating") and queue it for subscribers"""
+    global catalog_seq
+    with catalog_feed_lock:
+        if successor is not None:
+            # The successor numbers and pushes changes from now on
+            successor.send({"type": "catalog", "event": event, "fields": fields})
+            return
+        catalog_seq += 1
+        change = {"type": "catalog", "seq": catalog_seq, "event": event, **fields}
+        catalog_feed.append(change)
+        # Queued under the lock so the broadcaster sees changes in sequence order
+        push_events.put(("catalog", change))
+
+def commit_catalog_change(event, **fields):
+    """on_commit step: apply a committed change to the columnar catalog and name index, then publish it.
+
+    Running in the writer, after the COMMIT and in commit order, it cannot
+    apply an older amount over a newer one the way racing handlers could, and
+    feed sequence numbers follow the order the changes committed in.
+    """
+    apply_catalog_change(dict(fields, event=event))
+    publish_catalog(event, **fields)
+
+def commit_stock_change(product_id, amount, status):
+    """on_commit step for a purchase: a product's new stock, or that it sold out"""
+    if status != 'available' or amount <= 0:
+        commit_catalog_change("sold", product_id=product_id)
+    else:
+        commit_catalog_change("amount", product_id=product_id, amount=amount)
+
+def subscribe_presence(client_socket):
+    """Turn a logged-in connection into a push-only feed of presence changes"""
+    if not get_connection_user(client_socket):
+        client_socket.send(json.dumps({"status": "error", "message": "Please log in first."}).encode('utf-8'))
+        return
+    # Reply before subscribing so the first push cannot overtake the reply
+    client_socket.send((json.dumps({"status": "subscribed"}) + "\n").encode('utf-8'))
+    with push_subscribers_lock:
+        presence_subscribers.add(client_socket)
+
+def subscribe_catalog(client_socket, since=None, epoch=None):
+    """Turn a logged-in connection into a push-only feed of catalog changes.
+
+    With since (and the epoch it came from) the changes after that sequence
+    number are replayed first; if they are no longer buffered, or the server has
+    restarted since, a "reset" change tells the client to reload the catalog.
+    """
+    if not get_connection_user(client_socket):
+        client_socket.send(json.dumps({"status": "error", "message": "Please log in first."}).encode('utf-8'))
+        return
+    if since is None:
+        with catalog_feed_lock:
+            since, epoch = catalog_seq, CATALOG_EPOCH
+    elif not isinstance(since, int):
+        client_socket.send(json.dumps({"status": "error", "message": "Invalid sequence number"}).encode('utf-8'))
+        return
+    client_socket.send((json.dumps({"status": "subscribed", "seq": since, "epoch": CATALOG_EPOCH}) + "\n").encode('utf-8'))
+    with push_subscribers_lock:
+        catalog_subscribers[client_socket] = None
+    push_events.put(("subscribe_catalog", (client_socket, since, epoch)))
+
+def push_to(subscriber, data):
+    """Send one push; a subscriber whose socket cannot take it right now is dropped.
+
+    Dropping a slow subscriber rather than waiting keeps it from stalling the
+    others; the client reconnects and resumes or reloads.
+    """
+    try:
+        _, writable, _ = select.select([], [subscriber], [], 0)
+        if not writable:
+            raise OSError("subscriber is not keeping up")
+        subscriber.sendall(data)
+        return True
+    except (OSError, ValueError) as e:
+        print(f"Dropping push subscriber: {e}")
+        with push_subscribers_lock:
+            presence_subscribers.discard(subscriber)
+            catalog_subscribers.pop(subscriber, None)
+        try:
+            subscriber.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return False
+
+def encode_push(change):
+    return (json.dumps(change) + "\n").encode('utf-8')
+
+def replay_catalog(subscriber, since, epoch):
+    """Send a new catalog subscriber the changes it missed, then start its live feed"""
+    with catalog_feed_lock:
+        backlog = list(catalog_feed)
+        current = catalog_seq
+    oldest = backlog[0]["seq"] if backlog else current + 1
+    if epoch != CATALOG_EPOCH or since > current or since < oldest - 1:
+        if not push_to(subscriber, encode_push({"type": "catalog", "seq": current, "event": "reset", "epoch": CATALOG_EPOCH})):
+            return
+    else:
+        for change in backlog:
+            if change["seq"] > since and not push_to(subscriber, encode_push(change)):
+                return
+    with push_subscribers_lock:
+        if subscriber in catalog_subscribers:
+            catalog_subscribers[subscriber] = current
+
+def broadcast_pushes():
+    """Push queued presence and catalog changes to subscribers as newline-delimited JSON"""
+    while True:
+        kind, item = push_events.get()
+        if kind == "flush":
+            item.set()
+        elif kind == "subscribe_catalog":
+            replay_catalog(*item)
+        elif kind == "presence":
+            with push_subscribers_lock:
+                subscribers = list(presence_subscribers)
+            data = encode_push(item)
+            for subscriber in subscribers:
+                push_to(subscriber, data)
+        elif kind == "catalog":
+            with push_subscribers_lock:
+                # Skip subscribers still waiting for their replay or that already got this change in it
+                subscribers = [subscriber for subscriber, last in catalog_subscribers.items()
+                               if last is not None and last < item["seq"]]
+            data = encode_push(item)
+            for subscriber in subscribers:
+                if push_to(subscriber, data):
+                    with push_subscribers_lock:
+                        if subscriber in catalog_subscribers:
+                            catalog_subscribers[subscriber] = item["seq"]
+
+def reap_stale_sessions():
+    """Periodically close dead connections and expire leftover session state.
+
+    A client that vanishes without a FIN can leave its handler blocked in a write
+    even with socket timeouts, so connections that moved no bytes past their
+    deadlines are shut down here, which wakes the handler thread and lets it clean up.
+    """
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        try:
+            now = time.monotonic()
+            deadline = IDLE_TIMEOUT + OPERATION_TIMEOUT
+            for client_socket, last_seen in list(connection_activity.items()):
+                if now - last_seen > deadline:
+                    print("Reaping stale connection")
+                    try:
+                        client_socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    release_client_resources(client_socket)
+            live = set(connection_activity)
+            for username, entry in list(online_users.items()):
+                if entry[0] not in live:
+                    online_users.pop(username, None)
+                    publish_presence("offline", username)
+            with session_tokens_lock:
+                for token, session in list(session_tokens.items()):
+                    if session["expires"] < time.time():
+                        del session_tokens[token]
+            reap_upload_sessions()
+            reap_flash_sales()
+            prune_rate_limit_buckets()
+        except Exception as e:
+            print(f"Error reaping stale sessions: {e}")
+
+def reap_upload_sessions():
+    """Delete upload sessions untouched for longer than UPLOAD_SESSION_TTL"""
+    try:
+        names = os.listdir(UPLOAD_SESSION_DIR)
+    except OSError:
+        return
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for name in names:
+        path = os.path.join(UPLOAD_SESSION_DIR, name)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+        except OSError:
+            continue
+        upload_id = name.split('.')[0]
+        with upload_sessions_lock:
+            upload_sessions.pop(upload_id, None)
+        discard_temp_file(path)
+
+def acquire_connection_slot():
+    """Reserve room for one more client connection; False when at MAX_CONNECTIONS"""
+    global active_connections
+    with active_connections_lock:
+        if active_connections >= MAX_CONNECTIONS:
+            return False
+        active_connections += 1
+        return True
+
+def release_connection_slot():
+    """Give back the slot taken by acquire_connection_slot"""
+    global active_connections
+    with active_connections_lock:
+        active_connections -= 1
 
 def handle_logout(client_socket):
     """Handle user logout by removing from online users and closing connection"""
     try:
         # Find username by client_socket
         username = None
-        for user, sock in list(online_users.items()):         #check 
-            if sock == client_socket:
+        for user, entry in list(online_users.items()):         #check 
+            if entry[0] == client_socket:
                 username = user
                 del online_users[username]
+                publish_presence("offline", username)
                 break
+        identity = connection_users.pop(client_socket, None)
+        if identity:
+            revoke_session_tokens(identity[0])
                 
         response = {
             "message": "logout successful"
@@ -88,14 +835,16 @@ def handle_logout(client_socket):
         finally:
             client_socket.close()
 
+def insert_user(cursor, username, email, enc_pass, name):
+    """Write operation: add a user row"""
+    cursor.execute("INSERT INTO users (username, email, password, name) VALUES (?, ?, ?, ?)",
+                   (username, email, enc_pass, name))
+
 def register_user(server_socket, client_socket, username, email, password, name, db):     
     """Register a new user in the database"""
-    cursor = db.cursor()
     try:
         enc_pass = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute("INSERT INTO users (username, email, password, name) VALUES (?, ?, ?, ?)",
-                       (username, email, enc_pass, name))
-        db.commit()
+        run_write(db, insert_user, username, email, enc_pass, name)
         client_socket.send("Registration successful.".encode('utf-8'))
         #login_user(server_socket, client_socket, username, password, "", "", db)  # Auto-login
     except sqlite3.IntegrityError:
@@ -109,6 +858,8 @@ def login_user(server_socket, client_socket, username, password, ip, port, db):
     try:
         if authenticate_user(server_socket, username, password, db):
             online_users[username] = (client_socket,ip ,port)                                                  ##
+            publish_presence("online", username, ip, port)
+            connection_users[client_socket] = (username, get_id(db, username))
             client_socket.send(f"Login successful.\nWelcome {username}".encode('utf-8'))
             send_id(client_socket, db, username)
         else:
@@ -117,43 +868,281 @@ def login_user(server_socket, client_socket, username, password, ip, port, db):
         print(f"Error during login: {e}")
         client_socket.send("Server error. Please try again later.".encode('utf-8'))
 
-def receive_image(client_socket, image_id):
-    """Receive and save an image from the client"""
+def get_connection_user(client_socket):
+    """Return (username, user_id) for an authenticated connection, or None"""
+    return connection_users.get(client_socket)
+
+def issue_session_token(client_socket):
+    """Give a logged-in connection a token that other connections can attach with"""
+    identity = get_connection_user(client_socket)
+    if identity is None:
+        client_socket.send(json.dumps({"status": "error", "message": "Please log in first."}).encode('utf-8'))
+        return
+    token = secrets.token_hex(16)
+    with session_tokens_lock:
+        session_tokens[token] = {"username": identity[0], "user_id": identity[1], "expires": time.time() + SESSION_TOKEN_TTL}
+        if successor is not None:
+            successor.send({"type": "session", "token": token, "session": session_tokens[token]})
+    client_socket.send(json.dumps({"status": "ok", "token": token, "user_id": identity[1]}).encode('utf-8'))
+
+def resume_session(client_socket, token, ip=None, port=None):
+    """Authenticate a connection with a session token instead of a password.
+
+    With the P2P address the client logged in with, the connection also
+    becomes the user's main one again, as after login: a client that lost its
+    main connection gets notifications, chat and presence back on the new one.
+    """
+    with session_tokens_lock:
+        session = session_tokens.get(token)
+        if session and session["expires"] < time.time():
+            del session_tokens[token]
+            session = None
+    if session is None:
+        client_socket.send(json.dumps({"status": "error", "message": "Invalid session token"}).encode('utf-8'))
+        return
+    connection_users[client_socket] = (session["username"], session["user_id"])
+    if port is not None:
+        online_users[session["username"]] = (client_socket, ip, port)
+        publish_presence("online", session["username"], ip, port)
+    client_socket.send(json.dumps({"status": "ok", "username": session["username"], "user_id": session["user_id"]}).encode('utf-8'))
+
+def revoke_session_tokens(username):
+    """Invalidate every session token issued to a user"""
+    with session_tokens_lock:
+        for token, session in list(session_tokens.items()):
+            if session["username"] == username:
+                del session_tokens[token]
+        if successor is not None:
+            successor.send({"type": "revoke", "username": username})
+
+def copy_from_socket(client_socket, f, size, digest=None, report_progress=False):
+    """Copy up to size bytes from the socket into an open file, then fsync it.
+
+    Returns the number of bytes written; fewer than size means the peer went away.
+    """
+    received_size = 0
+    try:
+        while received_size < size:
+            remaining = size - received_size
+            chunk = client_socket.recv(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            f.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            received_size += len(chunk)
+            # Acknowledge once per full chunk so each ack matches one client send
+            chunk_done = received_size % UPLOAD_CHUNK_SIZE == 0 or received_size == size
+            if report_progress and chunk_done:
+                progress = (received_size / size) * 100
+                client_socket.send(f"PROGRESS:{progress:.2f}".encode('utf-8'))
+    finally:
+        f.flush()
+        os.fsync(f.fileno())
+    return received_size
+
+def stream_to_temp_file(client_socket, image_size, report_progress=True):
+    """Stream image_size bytes into a fsynced temp file; returns (temp_path, sha256 hex digest) or None"""
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=IMAGE_DIR, suffix=".part")
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            received_size = copy_from_socket(client_socket, f, image_size, digest, report_progress)
+        os.chmod(temp_path, 0o644)
+    except Exception:
+        discard_temp_file(temp_path)
+        raise
+    if received_size != image_size:
+        discard_temp_file(temp_path)
+        return None
+    return temp_path, digest.hexdigest()
+
+def discard_temp_file(temp_path):
+    """Remove a temp upload file, ignoring files that are already gone"""
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+def receive_image(client_socket):
+    """Receive an image into a durable temp file; returns (temp_path, sha256 hex digest) or None"""
     try:
         size_data = client_socket.recv(1024).decode('utf-8')
         if not size_data.isdigit():
             client_socket.send("ERROR: Invalid file size received".encode('utf-8'))
-            return False
+            return None
         image_size = int(size_data)
         if image_size <= 0:
             client_socket.send("ERROR: Invalid file size".encode('utf-8'))
-            return False
+            return None
+        if image_size > MAX_IMAGE_SIZE:
+            client_socket.send(f"ERROR: Image too large (max {MAX_IMAGE_SIZE} bytes)".encode('utf-8'))
+            return None
         client_socket.send("READY".encode('utf-8'))
-        received_data = bytearray()
-        received_size = 0
-        while received_size < image_size:
-            remaining = image_size - received_size
-            chunk_size = min(8192, remaining)
-            chunk = client_socket.recv(chunk_size)
-            if not chunk:
-                break
-            received_data.extend(chunk)
-            received_size += len(chunk)
-            progress = (received_size / image_size) * 100
-            client_socket.send(f"PROGRESS:{progress:.2f}".encode('utf-8'))
-        if received_size != image_size:
+        result = stream_to_temp_file(client_socket, image_size)
+        if result is None:
             client_socket.send("ERROR: Incomplete transfer".encode('utf-8'))
-            return False
-        image_path = os.path.join("product_images", f"{image_id}.jpg")
-        os.makedirs("product_images", exist_ok=True)
-        with open(image_path, 'wb') as f:
-            f.write(received_data)
+            return None
         client_socket.send("SUCCESS: Image received".encode('utf-8'))
-        return True
+        return result
     except Exception as e:
         print(f"Error receiving image: {e}")
         client_socket.send(f"ERROR: {str(e)}".encode('utf-8'))
-        return False
+        return None
+
+def upload_session_paths(upload_id):
+    """Return the (data, metadata) paths of an upload session"""
+    return (os.path.join(UPLOAD_SESSION_DIR, f"{upload_id}.part"),
+            os.path.join(UPLOAD_SESSION_DIR, f"{upload_id}.json"))
+
+def save_upload_session(session):
+    """Persist upload session metadata next to its data file"""
+    _, meta_path = upload_session_paths(session["upload_id"])
+    temp_meta = meta_path + ".tmp"
+    with open(temp_meta, 'w') as f:
+        json.dump(session, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_meta, meta_path)
+
+def get_upload_session(upload_id):
+    """Look up an upload session, reloading it from disk after a restart"""
+    if not isinstance(upload_id, str) or len(upload_id) != 32 or not all(c in "0123456789abcdef" for c in upload_id):
+        return None
+    with upload_sessions_lock:
+        session = upload_sessions.get(upload_id)
+        if session is None:
+            _, meta_path = upload_session_paths(upload_id)
+            try:
+                with open(meta_path) as f:
+                    session = json.load(f)
+            except (OSError, ValueError):
+                return None
+            upload_sessions[upload_id] = session
+        if session.get("lock") is None:
+            session["lock"] = threading.Lock()
+        return session
+
+def persisted_offset(session):
+    """Return how many bytes of an upload session are safely on disk"""
+    data_path, _ = upload_session_paths(session["upload_id"])
+    try:
+        return os.path.getsize(data_path)
+    except OSError:
+        return 0
+
+def session_metadata(session):
+    """Return the JSON-serializable part of an upload session"""
+    return {key: value for key, value in session.items() if key != "lock"}
+
+def begin_upload(client_socket, size, owner_id, sha256=None):
+    """Start a resumable upload session and return its ID to the client"""
+    if not isinstance(size, int) or size <= 0:
+        client_socket.send(json.dumps({"status": "error", "message": "Invalid file size"}).encode('utf-8'))
+        return
+    if size > MAX_IMAGE_SIZE:
+        client_socket.send(json.dumps({"status": "error", "message": f"Image too large (max {MAX_IMAGE_SIZE} bytes)"}).encode('utf-8'))
+        return
+    upload_id = secrets.token_hex(16)
+    session = {"upload_id": upload_id, "size": size, "owner_id": owner_id, "sha256": sha256, "complete": False}
+    try:
+        os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+        data_path, _ = upload_session_paths(upload_id)
+        open(data_path, 'wb').close()
+        save_upload_session(session)
+    except OSError as e:
+        print(f"Error creating upload session: {e}")
+        client_socket.send(json.dumps({"status": "error", "message": "Server error. Please try again later."}).encode('utf-8'))
+        return
+    session["lock"] = threading.Lock()
+    with upload_sessions_lock:
+        upload_sessions[upload_id] = session
+    client_socket.send(json.dumps({"status": "ok", "upload_id": upload_id, "chunk_size": UPLOAD_SESSION_CHUNK_SIZE}).encode('utf-8'))
+
+def upload_chunk(client_socket, upload_id, offset, length):
+    """Write one offset-addressed chunk of an upload session.
+
+    The chunk may start anywhere up to the persisted offset; anything past the
+    chunk start is overwritten so a resumed client can resend a partial chunk.
+    """
+    session = get_upload_session(upload_id)
+    if session is None:
+        client_socket.send(json.dumps({"status": "error", "message": "Unknown upload"}).encode('utf-8'))
+        return
+    with session["lock"]:
+        current = persisted_offset(session)
+        if session["complete"]:
+            client_socket.send(json.dumps({"status": "error", "message": "Upload already finished", "offset": current}).encode('utf-8'))
+            return
+        if not isinstance(offset, int) or not isinstance(length, int) or offset < 0 or length <= 0 or offset > current:
+            client_socket.send(json.dumps({"status": "error", "message": "Invalid offset", "offset": current}).encode('utf-8'))
+            return
+        if length > UPLOAD_SESSION_CHUNK_SIZE or offset + length > session["size"]:
+            client_socket.send(json.dumps({"status": "error", "message": "Chunk out of range", "offset": current}).encode('utf-8'))
+            return
+        client_socket.send(json.dumps({"status": "ready"}).encode('utf-8'))
+        data_path, _ = upload_session_paths(upload_id)
+        with open(data_path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            received = copy_from_socket(client_socket, f, length)
+        if received != length:
+            # Whatever arrived is already fsynced; the client resumes from there
+            return
+        client_socket.send(json.dumps({"status": "ok", "offset": offset + received}).encode('utf-8'))
+
+def query_upload(client_socket, upload_id):
+    """Report how many bytes of an upload session are persisted"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        client_socket.send(json.dumps({"status": "error", "message": "Unknown upload"}).encode('utf-8'))
+        return
+    with session["lock"]:
+        response = {"status": "ok", "offset": persisted_offset(session), "size": session["size"], "complete": session["complete"]}
+    client_socket.send(json.dumps(response).encode('utf-8'))
+
+def finish_upload(client_socket, upload_id):
+    """Verify a fully uploaded session and mark it ready to be attached to a product"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        client_socket.send(json.dumps({"status": "error", "message": "Unknown upload"}).encode('utf-8'))
+        return
+    with session["lock"]:
+        offset = persisted_offset(session)
+        if offset != session["size"]:
+            client_socket.send(json.dumps({"status": "error", "message": "Upload incomplete", "offset": offset}).encode('utf-8'))
+            return
+        data_path, _ = upload_session_paths(upload_id)
+        digest = hashlib.sha256()
+        with open(data_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        image_hash = digest.hexdigest()
+        if session["sha256"] and session["sha256"] != image_hash:
+            # Start over rather than keep corrupt data around
+            open(data_path, 'wb').close()
+            client_socket.send(json.dumps({"status": "error", "message": "Checksum mismatch", "offset": 0}).encode('utf-8'))
+            return
+        session["sha256"] = image_hash
+        session["complete"] = True
+        save_upload_session(session_metadata(session))
+    client_socket.send(json.dumps({"status": "ok", "sha256": image_hash}).encode('utf-8'))
+
+def claim_upload(upload_id, owner_id):
+    """Take a finished upload session for a product; returns (data_path, sha256) or None"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        return None
+    with session["lock"]:
+        if not session["complete"] or session["owner_id"] != owner_id or session.get("claimed"):
+            return None
+        session["claimed"] = True
+    with upload_sessions_lock:
+        upload_sessions.pop(upload_id, None)
+    data_path, meta_path = upload_session_paths(upload_id)
+    discard_temp_file(meta_path)
+    return data_path, session["sha256"]
 
 def receive_ack(client_socket):
     """Receive acknowledgment from client"""
@@ -166,39 +1155,250 @@ def send_data(client_socket, data):
     client_socket.sendall(data.encode('utf-8'))
 
 
-def send_image(client_socket, image_id):
+def receive_handshake(client_socket, pattern):
+    """Read one fixed-format handshake message such as READY or PROGRESS:12.50.
+
+    Clients may send the next message (or command) right behind it, so only the
+    matched prefix is consumed and the rest is kept for the next read. Returns
+    True if the message matched the pattern.
+    """
+    data = client_socket.recv(1024).decode('utf-8', errors='surrogateescape')
+    match = re.match(pattern, data)
+    if not match:
+        return False
+    leftover = data[match.end():]
+    if leftover:
+        client_socket.unread(leftover.encode('utf-8', errors='surrogateescape'))
+    return True
+
+def send_image(client_socket, image_id, db):
     """Send an image to the client"""
     try:
-        image_path = os.path.join("product_images", f"{image_id}.jpg")
-        
-        if not os.path.exists(image_path):
+        image = image_store.open(shard_db(db, image_id), image_id)
+        if image is None:
             client_socket.send("ERROR: Image not found".encode('utf-8'))
             return False
-        image_size = os.path.getsize(image_path)
-        client_socket.send(str(image_size).encode('utf-8'))
-        response = client_socket.recv(1024).decode('utf-8')
-        if response != "READY":
-            return False
-        bytes_sent = 0
-        with open(image_path, 'rb') as f:
+        image_size, f = image
+        with f:
+            client_socket.send(str(image_size).encode('utf-8'))
+            if not receive_handshake(client_socket, "READY"):
+                return False
+            bytes_sent = 0
             while bytes_sent < image_size:
                 chunk = f.read(8192)
                 if not chunk:
                     break
                 client_socket.sendall(chunk)
                 bytes_sent += len(chunk)
-                progress_ack = client_socket.recv(1024).decode('utf-8')
-                if not progress_ack.startswith("PROGRESS:"):
+                if not receive_handshake(client_socket, r"PROGRESS:\d+\.\d{2}"):
                     return False
-        final_response = client_socket.recv(1024).decode('utf-8')
-        return final_response == "SUCCESS: Image received"
+        return receive_handshake(client_socket, "SUCCESS: Image received")
     except Exception as e:
         print(f"Error sending image: {e}")
         return False
 
+def parse_range(header, size):
+    """Parse a single-range Range header against an image of size bytes.
+
+    Returns (start, end) inclusive, None to send the whole image (no header or
+    a form we do not serve), or False if the range cannot be satisfied.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last n bytes
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """GET/HEAD /images/<product_id> for clients holding a session token.
+
+    Images are immutable once listed, so each one gets a strong ETag. Range
+    and If-Range let a client resume a download, If-None-Match lets it skip
+    one it already has, and connections are kept alive between requests.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+    db = None
+
+    def do_GET(self):
+        self.serve_image(send_body=True)
+
+    def do_HEAD(self):
+        self.serve_image(send_body=False)
+
+    def log_request(self, code='-', size='-'):
+        """Only errors are logged"""
+
+    def finish(self):
+        super().finish()
+        if self.db is not None:
+            self.db.close()
+        close_shard_readers()
+
+    def send_status(self, code, message, headers=()):
+        """Send a short text/plain reply"""
+        body = message.encode('utf-8')
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def authorized(self):
+        """True if the request carries a live session token"""
+        scheme, _, token = (self.headers.get("Authorization") or "").partition(" ")
+        if scheme.lower() != "bearer":
+            return False
+        with session_tokens_lock:
+            session = session_tokens.get(token.strip())
+            return session is not None and session["expires"] >= time.time()
+
+    def serve_image(self, send_body):
+        match = re.fullmatch(r"/images/(\d+)(?:\.jpg)?", self.path.split("?", 1)[0])
+        if not match:
+            self.send_status(404, "Not found")
+            return
+        if not self.authorized():
+            self.send_status(401, "Invalid session token", [("WWW-Authenticate", "Bearer")])
+            return
+        if self.db is None:
+            self.db = diagnostics.connect(self.server.db_path)
+        diagnostics.set_command("http image")
+        product_id = int(match.group(1))
+        image = image_store.open(shard_db(self.db, product_id), product_id)
+        if image is None:
+            self.send_status(404, "Image not found")
+            return
+        size, f = image
+        with f:
+            etag = image_etag(product_id, size, f)
+            if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            byte_range = parse_range(self.headers.get("Range"), size)
+            if byte_range is not None and self.headers.get("If-Range", etag) != etag:
+                # The client's partial copy is of a different image; send it all again
+                byte_range = None
+            if byte_range is False:
+                self.send_status(416, "Range not satisfiable", [("Content-Range", f"bytes */{size}")])
+                return
+            start, end = byte_range or (0, size - 1)
+            self.send_response(206 if byte_range else 200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if send_body and size:
+                send_image_range(self.connection, f, start, end - start + 1)
+
+def image_etag(product_id, size, f):
+    """Strong validator for an image: its product, size and, for files, modification time"""
+    try:
+        return f'"{product_id}-{size}-{os.fstat(f.fileno()).st_mtime_ns:x}"'
+    except (AttributeError, OSError):
+        return f'"{product_id}-{size}"'
+
+def send_image_range(sock, f, offset, count):
+    """Send count bytes of an image from offset: sendfile for files, chunked reads for blobs"""
+    if hasattr(f, "fileno"):
+        sock.sendfile(f, offset, count)
+        return
+    f.seek(offset)
+    while count > 0:
+        chunk = f.read(min(image_storage.CHUNK_SIZE, count))
+        if not chunk:
+            break
+        sock.sendall(chunk)
+        count -= len(chunk)
+
+def start_image_http(db_path, sock=None):
+    """Start the image listener on its own threads, on sock if one was inherited from the previous process"""
+    global image_http_port, image_httpd
+    try:
+        if sock is None:
+            httpd = http.server.ThreadingHTTPServer(("localhost", IMAGE_HTTP_PORT), ImageRequestHandler)
+        else:
+            httpd = http.server.ThreadingHTTPServer(sock.getsockname(), ImageRequestHandler, bind_and_activate=False)
+            httpd.socket.close()
+            # Already bound and listening, so clients keep using the port they were told
+            httpd.socket = sock
+            httpd.server_address = sock.getsockname()
+            httpd.server_name, httpd.server_port = "localhost", httpd.server_address[1]
+    except OSError as e:
+        print(f"Error starting image listener: {e}")
+        return
+    httpd.daemon_threads = True
+    httpd.db_path = db_path
+    image_http_port = httpd.server_address[1]
+    image_httpd = httpd
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+def send_image_endpoint(client_socket):
+    """Tell the client where to fetch images over HTTP"""
+    if image_http_port is None:
+        client_socket.send(json.dumps({"status": "error", "message": "Image endpoint is disabled"}).encode('utf-8'))
+        return
+    client_socket.send(json.dumps({"status": "ok", "port": image_http_port, "path": "/images/"}).encode('utf-8'))
+
+def run_admin_command(client_socket, msg, db):
+    """Profile the server, snapshot its heap or run flash sales; results are written under diagnostics.PROFILE_DIR"""
+    identity = get_connection_user(client_socket)
+    if identity is None or identity[0] not in ADMIN_USERS:
+        client_socket.send(json.dumps({"status": "error", "message": "Not allowed"}).encode('utf-8'))
+        return
+    if msg["command"] == "profile":
+        seconds = msg.get("seconds", 10)
+        if not isinstance(seconds, (int, float)) or not 0 < seconds <= diagnostics.MAX_PROFILE_SECONDS:
+            response = {"status": "error", "message": f"seconds must be between 0 and {diagnostics.MAX_PROFILE_SECONDS}"}
+        else:
+            path = diagnostics.start_profile(seconds)
+            if path is None:
+                response = {"status": "error", "message": "Already profiling"}
+            else:
+                response = {"status": "ok", "seconds": seconds, "path": path, "summary": diagnostics.summary_path(path)}
+    elif msg["command"] == "flash_sale":
+        response = flash_sale_command(db, msg.get("action", "list"), msg.get("product_name"))
+    else:
+        response = diagnostics.heap_snapshot(msg.get("action", "snapshot"))
+    client_socket.send(json.dumps(response).encode('utf-8'))
+
+def flash_sale_command(db, action, product_name):
+    """Start or stop a flash sale ahead of demand, or list the running ones; returns the reply to send"""
+    if action == "list":
+        return {"status": "ok", "sales": [{"product_name": name, "product_id": sale.product_id, "remaining": sale.remaining}
+                                          for name, sale in list(flash_sales.items())]}
+    if action not in ("start", "stop") or not isinstance(product_name, str):
+        return {"status": "error", "message": "Action must be list, or start or stop with a product_name"}
+    if action == "stop":
+        if not stop_flash_sale(product_name):
+            return {"status": "error", "message": "No flash sale for that product"}
+        return {"status": "ok"}
+    if flash_sales_paused:
+        return {"status": "error", "message": "Flash sales are paused while the server restarts"}
+    sale = start_flash_sale(db, product_name)
+    if sale is None:
+        return {"status": "error", "message": "Product not found"}
+    return {"status": "ok", "product_id": sale.product_id, "remaining": sale.remaining}
+
 def get_item_id(id, name, price, description, db):
     """Get item ID from database based on attributes"""
-    cursor = db.cursor()
+    cursor = shard_db(db, id).cursor()
     cursor.execute("SELECT id FROM products where (owner_id, name, price, description) = (?,?,?,?) ", (id, name, price, description))
     row = cursor.fetchone()
     if row:
@@ -207,12 +1407,13 @@ def get_item_id(id, name, price, description, db):
 
 def get_item_price(name, db):
     """Get price of the product from the database based on its name"""
-    cursor = db.cursor()
+    sale = flash_sales.get(name)
+    if sale is not None:
+        return sale.price
     try:
-        cursor.execute("SELECT price FROM products WHERE name = ?", (name,))
-        row = cursor.fetchone()
-        if row:
-            price = row[0]
+        rows = gather_rows(db, "SELECT id, price FROM products WHERE name = ? ORDER BY id LIMIT 1", (name,))
+        if rows:
+            price = min(rows)[1]
             return price
         else:
             return None  # Return None if the product name is not found
@@ -220,30 +1421,141 @@ def get_item_price(name, db):
         print(f"Database error when retrieving price for product '{name}': {e}")
         return None
 
-def register_item(server_socket, client_socket, name, price, image, description, amount, id, db):
-    """Register a new item in the database"""
+def insert_product(cursor, owner_id, name, price, description, amount, temp_path, stored):
+    """Write operation: add a product row and move its image into place; returns the product ID"""
+    product_id = next_product_id(cursor, shard_of(owner_id))
+    cursor.execute("""
+        INSERT INTO products (id, owner_id, name, price, description, amount, status) 
+        VALUES (?, ?, ?, ?, ?, ?, 'available')
+    """, (product_id, owner_id, name, price, description, amount))
+    image_name = image_store.store(cursor.connection, temp_path, product_id)
+    stored.append((image_name, temp_path))
+    cursor.execute("UPDATE products SET image = ? WHERE id = ?", (image_name, product_id))
+    return product_id
+
+def discard_images(stored):
+    """on_rollback step for writes that store images: hand each (image_name, temp_path) back to its upload"""
+    for image_name, temp_path in stored:
+        image_store.discard(image_name, temp_path)
+    stored.clear()
+
+def register_item(server_socket, client_socket, name, price, image, description, amount, id, db, image_sha256=None, upload_id=None):
+    """Register a new item, writing its row and image reference in one transaction once the image is durable"""
+    if upload_id:
+        upload = claim_upload(upload_id, id)
+    else:
+        upload = receive_image(client_socket)
+    if upload is None:
+        client_socket.send("Product not registered: image upload failed.".encode('utf-8'))
+        return
+    temp_path, image_hash = upload
+    if image_sha256 and image_sha256 != image_hash:
+        discard_temp_file(temp_path)
+        client_socket.send("Product not registered: image checksum mismatch.".encode('utf-8'))
+        return
+    stored = []
     try:
-        cursor = db.cursor()
-        cursor.execute("""
-            INSERT INTO products (owner_id, name, price, description, amount, status) 
-            VALUES (?, ?, ?, ?, ?, 'available')
-        """, (id, name, price, description, amount))
-        db.commit()
-        product_id = cursor.lastrowid
-        if receive_image(client_socket, product_id):
-            cursor.execute("""
-                UPDATE products 
-                SET image = ? 
-                WHERE id = ?
-            """, (f"{product_id}.jpg", product_id))
-            db.commit()
-            client_socket.send("Product registered successfully with image.".encode('utf-8'))
-        else:
-            client_socket.send("Product registered but image upload failed.".encode('utf-8'))
-    except sqlite3.Error as e:
-        print(f"Database error during product registration: {e}")
+        product_id = run_write(db, insert_product, id, name, price, description, amount, temp_path, stored,
+                               stores_images=True, shard=shard_of(id), on_rollback=lambda: discard_images(stored),
+                               on_commit=lambda product_id: commit_catalog_change("listed", product={
+                                   "id": product_id, "owner_id": id, "name": name, "price": price,
+                                   "description": description, "amount": amount}))
+        client_socket.send("Product registered successfully with image.".encode('utf-8'))
+    except (sqlite3.Error, OSError) as e:
+        discard_temp_file(temp_path)
+        print(f"Error during product registration: {e}")
         client_socket.send("Server error. Please try again later.".encode('utf-8'))
 
+def validate_batch_manifest(items):
+    """Check a sell_batch manifest; returns an error message or None"""
+    if not isinstance(items, list) or not items:
+        return "Batch must contain at least one product"
+    if len(items) > MAX_BATCH_ITEMS:
+        return f"Batch too large (max {MAX_BATCH_ITEMS} products)"
+    total_size = 0
+    for item in items:
+        if not isinstance(item, dict):
+            return "Invalid product entry"
+        for key in ("product_name", "price", "description", "amount", "size"):
+            if key not in item:
+                return f"Product entry missing '{key}'"
+        size = item["size"]
+        if not isinstance(size, int) or size <= 0 or size > MAX_IMAGE_SIZE:
+            return f"Invalid image size for '{item['product_name']}' (max {MAX_IMAGE_SIZE} bytes)"
+        total_size += size
+    if total_size > MAX_BATCH_BYTES:
+        return f"Batch images too large (max {MAX_BATCH_BYTES} bytes)"
+    return None
+
+def insert_products(cursor, owner_id, items, uploads, results, stored):
+    """Write operation: add the rows of a sell_batch with IDs assigned up front; returns the rows"""
+    # Runs inside a write transaction, so the IDs read here stay ours
+    next_id = next_product_id(cursor, shard_of(owner_id))
+    rows = []
+    for index, temp_path in uploads:
+        item = items[index]
+        product_id = next_id
+        next_id += SHARD_COUNT
+        image_name = image_store.store(cursor.connection, temp_path, product_id)
+        stored.append((image_name, temp_path))
+        rows.append((product_id, owner_id, item["product_name"], item["price"], item["description"], image_name, item["amount"]))
+        results[index] = {"index": index, "status": "ok", "product_id": product_id}
+    cursor.executemany("""
+        INSERT INTO products (id, owner_id, name, price, description, image, amount, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'available')
+    """, rows)
+    return rows
+
+def register_batch(client_socket, items, owner_id, db):
+    """Register many products whose images are streamed back to back.
+
+    All images are made durable first. The rows that passed are then inserted
+    with executemany in one transaction, with IDs assigned up front so each row
+    carries its image reference. The reply lists a status per product.
+    """
+    error = validate_batch_manifest(items)
+    if error:
+        client_socket.send(json.dumps({"status": "error", "message": error}).encode('utf-8'))
+        return
+    client_socket.send(json.dumps({"status": "ready"}).encode('utf-8'))
+    results = [None] * len(items)
+    uploads = []
+    try:
+        for index, item in enumerate(items):
+            upload = stream_to_temp_file(client_socket, item["size"], report_progress=False)
+            if upload is None:
+                raise ConnectionError("Incomplete batch transfer")
+            temp_path, image_hash = upload
+            if item.get("sha256") and item["sha256"] != image_hash:
+                discard_temp_file(temp_path)
+                results[index] = {"index": index, "status": "error", "message": "Image checksum mismatch"}
+                continue
+            uploads.append((index, temp_path))
+    except Exception as e:
+        for _, temp_path in uploads:
+            discard_temp_file(temp_path)
+        print(f"Error receiving batch images: {e}")
+        return
+
+    stored = []
+    try:
+        run_write(db, insert_products, owner_id, items, uploads, results, stored, stores_images=True,
+                  shard=shard_of(owner_id), on_rollback=lambda: discard_images(stored), on_commit=commit_listings)
+    except (sqlite3.Error, OSError) as e:
+        for _, temp_path in uploads:
+            discard_temp_file(temp_path)
+        print(f"Database error during batch registration: {e}")
+        client_socket.send(json.dumps({"status": "error", "message": "Server error. Please try again later."}).encode('utf-8'))
+        return
+    registered = sum(1 for result in results if result["status"] == "ok")
+    client_socket.send(json.dumps({"status": "done", "registered": registered, "results": results}).encode('utf-8'))
+
+def commit_listings(rows):
+    """on_commit step for insert_products: add the listed rows to the catalog"""
+    for product_id, owner_id, name, price, description, _, amount in rows:
+        commit_catalog_change("listed", product={"id": product_id, "owner_id": owner_id, "name": name, "price": price,
+                                                 "description": description, "amount": amount})
+
 def send_id(client_socket, db, username):
     """Send user ID to client"""
     cursor = db.cursor()
@@ -268,108 +1580,430 @@ def get_id(db, username):
         return row[0]
     return None
 
-def filter_by_owner(client_socket, owner_id, db):
-    """Filter and return items by owner ID"""
-    cursor = db.cursor()
+def sort_clause(sort, limit):
+    """Build the ORDER BY/LIMIT tail of a filter query and its parameters"""
+    clause = ""
+    params = ()
+    if sort in SQL_SORT_ORDERS:
+        clause += f" ORDER BY {SQL_SORT_ORDERS[sort]}"
+    if isinstance(limit, int) and limit >= 0:
+        clause += " LIMIT ?"
+        params = (limit,)
+    return clause, params
+
+def query_limit(limit):
+    """A client's row limit if it is a usable one; anything else means no limit, as in sort_clause"""
+    return limit if isinstance(limit, int) and limit >= 0 else None
+
+def product_item(row):
+    """Turn an (id, name, price, description) row into the item dict sent to clients"""
+    return {
+        'id': row[0],
+        'name': row[1],
+        'price': row[2],
+        'description': row[3]
+    }
+
+def price_items(items, in_currency):
+    """Reprice a list of items in a (code, rate) currency; None keeps the base.
+
+    Prices come from the columnar catalog's converted column for that
+    currency, which is converted once per rate; without the catalog each
+    price is converted here.
+    """
+    if in_currency is None or not items:
+        return items
+    code, rate = in_currency
+    prices = catalog.prices_in([item['id'] for item in items], in_currency) if catalog is not None else [None] * len(items)
+    for item, price in zip(items, prices):
+        item['price'] = price if price is not None else currency.convert(item['price'], rate)
+        item['currency'] = code
+    return items
+
+def priced_batches(batches, in_currency):
+    """price_items applied to each batch of a stream"""
+    for batch in batches:
+        yield price_items(batch, in_currency)
+
+def resolve_currency(client_socket, code):
+    """Look up a requested currency; returns (code, rate), None for the base, or False after
+    telling the client the code is unknown"""
+    if code is None:
+        return None
+    in_currency = rates.lookup(code)
+    if in_currency is None:
+        client_socket.send(json.dumps({"error": f"Unknown currency: {code}"}).encode('utf-8'))
+        return False
+    return in_currency
+
+def row_batches(cursor, to_item, batch_size=STREAM_BATCH_SIZE):
+    """Yield lists of items from a cursor, one fetchmany at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [to_item(row) for row in rows]
+
+def send_stream(client_socket, batches):
+    """Send a query result as NDJSON frames.
+
+    Each batch goes out as its own {"items": [...]} line as soon as it is read,
+    followed by {"done": true, "count": n}. A failure part way through ends the
+    stream with an {"error": ...} line instead.
+    """
+    count = 0
     try:
-        cursor.execute("SELECT id, name, price, description FROM products WHERE owner_id = ? AND amount > 0", (owner_id,))
-        rows = cursor.fetchall()
-        items_data = []
-        for row in rows:
-            item = {
-                'id': row[0],
-                'name': row[1],
-                'price': row[2],
-                'description': row[3]
-            }
-            items_data.append(item)
+        for batch in batches:
+            client_socket.sendall((json.dumps({"items": batch}) + "\n").encode('utf-8'))
+            count += len(batch)
+    except sqlite3.Error as e:
+        print(f"Database error while streaming results: {e}")
+        client_socket.sendall((json.dumps({"error": "Server error. Please try again later."}) + "\n").encode('utf-8'))
+        return
+    client_socket.sendall((json.dumps({"done": True, "count": count}) + "\n").encode('utf-8'))
+
+def filter_by_owner(client_socket, owner_id, db, with_images=True, sort=None, limit=None, stream=False, in_currency=None):
+    """Filter and return items by owner ID, priced in in_currency if given"""
+    cursor = shard_db(db, owner_id).cursor()
+    limit = query_limit(limit)
+    try:
+        if catalog is not None and stream:
+            send_stream(client_socket, catalog.stream_by_owner(owner_id, sort, limit, STREAM_BATCH_SIZE, in_currency))
+            return
+        if catalog is not None:
+            items_data = catalog.filter_by_owner(owner_id, sort, limit, in_currency)
+        else:
+            clause, params = sort_clause(sort, limit)
+            cursor.execute("SELECT id, name, price, description FROM products WHERE owner_id = ? AND amount > 0" + clause, (owner_id,) + params)
+            if stream:
+                send_stream(client_socket, priced_batches(row_batches(cursor, product_item), in_currency))
+                return
+            items_data = price_items([product_item(row) for row in cursor.fetchall()], in_currency)
 
         if not items_data:
             client_socket.send(json.dumps({"items": [], "total_images": 0}).encode('utf-8'))
             return
-        items_json = json.dumps({"items": items_data, "total_images": len(items_data)})
+        total_images = len(items_data) if with_images else 0
+        items_json = json.dumps({"items": items_data, "total_images": total_images})
         client_socket.send(items_json.encode('utf-8'))
+        if not with_images:
+            return
         for item in items_data:
-            send_image(client_socket, item['id'])
+            send_image(client_socket, item['id'], db)
     except Exception as e:
         print(f"Error in filter_by_owner: {e}")
         client_socket.send(json.dumps({"error": "Server error. Please try again later."}).encode('utf-8'))
 
-def purchase_product(server_socket, client_socket, product_name, buyer_id, db):
-    """Process product purchase based on product name"""
-    cursor = db.cursor()
-    try:
-        cursor.execute("SELECT id, status, owner_id, amount FROM products WHERE name = ?", (product_name,))
-        product = cursor.fetchone()
-        if not product:
-            client_socket.send(json.dumps({"status": "Product_not_found"}).encode('utf-8'))
-            return
+def record_purchase(cursor, product_name, buyer_id):
+    """Write operation: take one unit of a product for a buyer.
 
-        product_id, status, owner_id, amount = product
-        if status != 'available':
-            client_socket.send(json.dumps({"status": "Product_sold"}).encode('utf-8'))
-            return
+    Returns (status, sale); sale is (product_id, owner_id, new_amount, new_status)
+    when status is "success".
+    """
+    cursor.execute("SELECT id, status, owner_id, amount FROM products WHERE name = ?", (product_name,))
+    product = cursor.fetchone()
+    if not product:
+        return "Product_not_found", None
+    product_id, status, owner_id, amount = product
+    if status != 'available':
+        return "Product_sold", None
+    # Clients send their ID as a string
+    if str(owner_id) == str(buyer_id):
+        return "Product_is_yours", None
+
+    cursor.execute("""
+        UPDATE products 
+        SET amount = amount - 1, status = CASE WHEN amount = 1 THEN 'sold' ELSE 'available' END, buyer_id = ?
+        WHERE id = ? AND status = 'available'""",
+        (buyer_id, product_id))
+    if cursor.rowcount == 0:
+        return "Product_is_not_available", None
+
+    cursor.execute("SELECT amount, status, price FROM products WHERE id = ?", (product_id,))
+    new_amount, new_status, price = cursor.fetchone()
+    # The ledger row and the seller's totals commit together with the stock change
+    cursor.execute("INSERT INTO orders (product_id, buyer_id, seller_id, price, created_at) VALUES (?, ?, ?, ?, ?)",
+                   (product_id, buyer_id, owner_id, price, datetime.now().isoformat(timespec='seconds')))
+    cursor.execute("""
+        INSERT INTO seller_stats (seller_id, orders, revenue) VALUES (?, 1, ?)
+        ON CONFLICT(seller_id) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue""",
+        (owner_id, price))
+    return "success", (product_id, owner_id, new_amount, new_status)
 
-        if owner_id == buyer_id:
-            client_socket.send(json.dumps({"status": "Product_is_yours"}).encode('utf-8'))
+def record_flash_sales(cursor, product_id, buyer_ids):
+    """Write operation: record a batch of flash-sale purchases of one product.
+
+    Sells as many units as are left to the first buyers in order; returns
+    (units sold, amount left).
+    """
+    cursor.execute("SELECT amount, status, price, owner_id FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    if not row:
+        return 0, 0
+    amount, status, price, owner_id = row
+    amount = amount or 0
+    sold = min(len(buyer_ids), amount) if status == 'available' else 0
+    if sold <= 0:
+        return 0, amount
+    cursor.execute("""
+        UPDATE products 
+        SET amount = amount - ?, status = CASE WHEN amount <= ? THEN 'sold' ELSE 'available' END, buyer_id = ?
+        WHERE id = ?""",
+        (sold, sold, buyer_ids[sold - 1], product_id))
+    created_at = datetime.now().isoformat(timespec='seconds')
+    cursor.executemany("INSERT INTO orders (product_id, buyer_id, seller_id, price, created_at) VALUES (?, ?, ?, ?, ?)",
+                       [(product_id, buyer_id, owner_id, price, created_at) for buyer_id in buyer_ids[:sold]])
+    cursor.execute("""
+        INSERT INTO seller_stats (seller_id, orders, revenue) VALUES (?, ?, ?)
+        ON CONFLICT(seller_id) DO UPDATE SET orders = orders + excluded.orders, revenue = revenue + excluded.revenue""",
+        (owner_id, sold, price * sold))
+    return sold, amount - sold
+
+class FlashSale:
+    """A hot product sold from an in-memory stock count.
+
+    purchase takes a unit off the count under the sale's lock, so once the
+    count reaches zero every other buyer is told "Product_sold" at once,
+    without touching SQLite. Each unit taken is queued for the sale's single
+    worker thread, which writes up to FLASH_SALE_BATCH_SIZE of them through
+    in one write operation and answers the buyers once that has committed.
+    SQLite stays authoritative: if it holds fewer units than the count (a
+    regular purchase was still committing when the sale started), the buyers
+    past the stored stock are told the product sold out.
+    """
+    def __init__(self, product_name, product_id, owner_id, price, remaining):
+        self.product_name = product_name
+        self.product_id = product_id
+        self.owner_id = owner_id
+        self.price = price
+        self.remaining = remaining
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.closed = False
+        self.last_used = time.monotonic()
+
+    def purchase(self, buyer_id):
+        """Buy one unit; returns (status, sale) like record_purchase, or None once the sale has ended"""
+        with self.lock:
+            if self.closed:
+                return None
+            self.last_used = time.monotonic()
+            if str(self.owner_id) == str(buyer_id):
+                return "Product_is_yours", None
+            if self.remaining <= 0:
+                return "Product_sold", None
+            self.remaining -= 1
+            future = concurrent.futures.Future()
+            self.requests.put((buyer_id, future))
+        return future.result()
+
+    def close(self):
+        """Stop taking purchases; the worker writes the queued ones through and exits"""
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.requests.put(None)
+
+    def run(self):
+        """Worker loop: write queued purchases through in batches until the sale is closed"""
+        db = diagnostics.connect(DB_PATH)
+        diagnostics.set_command("flash sale")
+        try:
+            closed = False
+            while not closed:
+                batch = [self.requests.get()]
+                while len(batch) < FLASH_SALE_BATCH_SIZE:
+                    try:
+                        batch.append(self.requests.get_nowait())
+                    except queue.Empty:
+                        break
+                # close() queues None after the last purchase
+                if batch[-1] is None:
+                    batch.pop()
+                    closed = True
+                if batch:
+                    self.write_through(db, batch)
+        finally:
+            db.close()
+            close_shard_readers()
+
+    def write_through(self, db, batch):
+        """Commit one batch of purchases and answer each buyer"""
+        try:
+            sold, amount = run_write(db, record_flash_sales, self.product_id, [buyer_id for buyer_id, _ in batch],
+                                     shard=shard_of(self.product_id), on_commit=self.commit_sales)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Error writing flash-sale purchases of '{self.product_name}': {e}")
+            with self.lock:
+                self.remaining += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
             return
+        if sold < len(batch):
+            with self.lock:
+                self.remaining = 0
+        for i, (_, future) in enumerate(batch):
+            if i < sold:
+                left = amount + sold - i - 1
+                future.set_result(("success", (self.product_id, self.owner_id, left, 'available' if left > 0 else 'sold')))
+            else:
+                future.set_result(("Product_sold", None))
 
-        cursor.execute("BEGIN TRANSACTION")
-        cursor.execute("""
-            UPDATE products 
-            SET amount = amount - 1, status = CASE WHEN amount = 1 THEN 'sold' ELSE 'available' END, buyer_id = ?
-            WHERE id = ? AND status = 'available'""",
-            (buyer_id, product_id))
-        
-        if cursor.rowcount == 0:
-            cursor.execute("ROLLBACK")
-            client_socket.send(json.dumps({"status": "Product_is_not_available"}).encode('utf-8'))
+    def commit_sales(self, result):
+        """on_commit step for record_flash_sales: the product's stock after the batch"""
+        sold, amount = result
+        if sold > 0:
+            commit_stock_change(self.product_id, amount, 'available' if amount > 0 else 'sold')
+
+def start_flash_sale(db, product_name):
+    """Start a flash sale for a product name, or return the one already running; None if there is no such product"""
+    with flash_sales_lock:
+        sale = flash_sales.get(product_name)
+        if sale is not None:
+            return sale
+        rows = gather_rows(db, "SELECT id, owner_id, price, amount, status FROM products WHERE name = ? ORDER BY id LIMIT 1",
+                           (product_name,))
+        if not rows:
+            return None
+        product_id, owner_id, price, amount, status = min(rows)
+        sale = FlashSale(product_name, product_id, owner_id, price, (amount or 0) if status == 'available' else 0)
+        flash_sales[product_name] = sale
+    threading.Thread(target=sale.run, name=f"flash-sale-{product_id}", daemon=True).start()
+    print(f"Flash sale started for '{product_name}' ({sale.remaining} left)")
+    return sale
+
+def stop_flash_sale(product_name):
+    """Hand a product back to the regular purchase path; False if it had no flash sale"""
+    with flash_sales_lock:
+        sale = flash_sales.pop(product_name, None)
+    if sale is None:
+        return False
+    sale.close()
+    print(f"Flash sale ended for '{product_name}'")
+    return True
+
+def reap_flash_sales():
+    """End flash sales nobody has bought from for FLASH_SALE_IDLE_TIMEOUT"""
+    now = time.monotonic()
+    for product_name, sale in list(flash_sales.items()):
+        if now - sale.last_used > FLASH_SALE_IDLE_TIMEOUT:
+            stop_flash_sale(product_name)
+
+def settle_purchase(db, product_name, buyer_id):
+    """Buy through the product's flash sale if it has one, otherwise through record_purchase.
+
+    A product with FLASH_SALE_CONCURRENCY purchases waiting on the writer at
+    once gets a flash sale, which takes over from the next purchase on.
+    """
+    sale = flash_sales.get(product_name)
+    if sale is not None:
+        result = sale.purchase(buyer_id)
+        if result is not None:
+            return result
+    with flash_sales_lock:
+        purchases_in_flight[product_name] += 1
+        hot = (FLASH_SALE_CONCURRENCY is not None and not flash_sales_paused
+               and purchases_in_flight[product_name] >= FLASH_SALE_CONCURRENCY)
+    try:
+        if hot:
+            sale = start_flash_sale(db, product_name)
+            result = sale.purchase(buyer_id) if sale is not None else None
+            if result is not None:
+                return result
+        return run_write(db, record_purchase, product_name, buyer_id, shard=shard_of_name(db, product_name),
+                         on_commit=commit_purchase)
+    finally:
+        with flash_sales_lock:
+            purchases_in_flight[product_name] -= 1
+            if purchases_in_flight[product_name] <= 0:
+                del purchases_in_flight[product_name]
+
+def commit_purchase(result):
+    """on_commit step for record_purchase"""
+    status, sale = result
+    if status == "success":
+        product_id, _, new_amount, new_status = sale
+        commit_stock_change(product_id, new_amount, new_status)
+
+def purchase_product(server_socket, client_socket, product_name, buyer_id, db):
+    """Process product purchase based on product name"""
+    try:
+        status, sale = settle_purchase(db, product_name, buyer_id)
+        if status != "success":
+            client_socket.send(json.dumps({"status": status}).encode('utf-8'))
             return
 
-        cursor.execute("COMMIT")
+        _, owner_id, _, _ = sale
         pickup_date = (datetime.now() + timedelta(days=5)).strftime('%Y-%m-%d')
         client_socket.send(json.dumps({"status": "success", "message": f"Purchase successful! Please collect your item from the aubpost office on {pickup_date}."}).encode('utf-8'))
 
-        if owner_id in online_users:
-            owner_socket = online_users[owner_id][0]                          ###use id or username
-            owner_socket.send(json.dumps({"status": "notification", "message": f"Your product with name {product_name} has been purchased by user ID {buyer_id}."}).encode('utf-8'))
+        notify_seller(db, owner_id, product_name, buyer_id)
 
     except sqlite3.Error as e:
-        cursor.execute("ROLLBACK")
         print(f"Database error during product purchase: {e}")
         client_socket.send(json.dumps({"status": "error", "message": "Server error. Please try again later."}).encode('utf-8'))
 
-def view_sold_product_buyers(server_socket, client_socket, seller_id, db):
-    """View buyers of sold products for a seller"""
-    cursor = db.cursor()
+def notify_seller(db, owner_id, product_name, buyer_id):
+    """Tell a seller who is online that one of their products was bought"""
+    row = db.execute("SELECT username FROM users WHERE id = ?", (owner_id,)).fetchone()
+    entry = online_users.get(row[0]) if row else None
+    if entry is None:
+        return
     try:
-        cursor.execute("""
+        entry[0].send(json.dumps({"status": "notification", "message": f"Your product with name {product_name} has been purchased by user ID {buyer_id}."}).encode('utf-8'))
+    except OSError as e:
+        print(f"Error notifying seller {row[0]}: {e}")
+
+def buyer_item(row):
+    """Turn a (name, product id, username, email, price, order id, time) order row into the dict sent to sellers"""
+    return {
+        "product_id": row[1],
+        "name": row[0],
+        "buyer": row[2] if row[2] else "Unknown",
+        "email": row[3] if row[3] else "Unknown",
+        "price": f"{row[4]:.2f}",
+        "order_id": row[5],
+        "ordered_at": row[6]
+    }
+
+def view_sold_product_buyers(server_socket, client_socket, seller_id, db, stream=False, limit=ORDERS_PAGE_SIZE, before=None):
+    """View buyers of sold products for a seller, newest orders first.
+
+    Pages are read off the (seller_id, id) index: pass the next_before of one
+    reply as before to get the next page.
+    """
+    cursor = shard_db(db, seller_id).cursor()
+    try:
+        if not isinstance(limit, int) or limit < 1:
+            limit = ORDERS_PAGE_SIZE
+        limit = min(limit, MAX_ORDERS_PAGE_SIZE)
+        query = """
             SELECT 
                 p.name,
-                p.id,
+                o.product_id,
                 u.username,
                 u.email,
-                p.price
-            FROM products p
-            LEFT JOIN users u ON p.buyer_id = u.id
-            WHERE p.owner_id = ? 
-            AND p.buyer_id IS NOT NULL
-            ORDER BY p.id DESC""", (seller_id,))
+                o.price,
+                o.id,
+                o.created_at
+            FROM orders o
+            LEFT JOIN products p ON o.product_id = p.id
+            LEFT JOIN users u ON o.buyer_id = u.id
+            WHERE o.seller_id = ? AND o.id < ?
+            ORDER BY o.id DESC"""
+        params = (seller_id, before if isinstance(before, int) else sys.maxsize)
+        if stream:
+            cursor.execute(query, params)
+            send_stream(client_socket, row_batches(cursor, buyer_item))
+            return
+        cursor.execute(query + " LIMIT ?", params + (limit,))
         rows = cursor.fetchall()
-        if not rows:
+        if not rows and before is None:
             client_socket.send(json.dumps({"message": "No products sold yet."}).encode('utf-8'))
             return
-        products = []
-        for row in rows:
-            product_info = {
-                "product_id": row[1],
-                "name": row[0],
-                "buyer": row[2] if row[2] else "Unknown",
-                "email": row[3] if row[3] else "Unknown",
-                "price": f"{row[4]:.2f}"
-            }
-            products.append(product_info)
-        response = json.dumps({"products": products})
+        products = [buyer_item(row) for row in rows]
+        next_before = rows[-1][5] if len(rows) == limit else None
+        response = json.dumps({"products": products, "next_before": next_before})
         client_socket.send(response.encode('utf-8'))
     except sqlite3.Error as e:
         print(f"Database error retrieving buyer info: {e}")
@@ -380,35 +2014,224 @@ def view_sold_product_buyers(server_socket, client_socket, seller_id, db):
         error_response = json.dumps({"error": "An unexpected error occurred."})
         client_socket.send(error_response.encode('utf-8'))
 
-def create_Tables(db_path):
-        """Create database tables if they don't exist"""
-        db = sqlite3.connect(db_path)
-        cursor = db.cursor()
-        db.execute("PRAGMA foreign_keys=on")
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            username TEXT UNIQUE, 
-                            email TEXT, 
-                            password TEXT,
-                            name TEXT)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS products (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                            owner_id INTEGER , 
-                            name TEXT, 
-                            price REAL, 
-                            description TEXT, 
-                            image BLOB,
-                            amount INTEGER,
-                            rating REAL DEFAULT 0,
-                            num_raters INTEGER DEFAULT 0, 
-                            buyer_id INTEGER, 
-                            status TEXT DEFAULT 'available', 
-                            FOREIGN KEY (owner_id) REFERENCES users(id), 
-                            FOREIGN KEY (buyer_id) REFERENCES users(id))''')
-
-        db.commit()
+def check_shard_layout(db_path):
+    """Record SHARD_COUNT in the main file on first start; False if the files were laid out for another count"""
+    db = sqlite3.connect(db_path)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS shard_layout (shard_count INTEGER)")
+        row = db.execute("SELECT shard_count FROM shard_layout").fetchone()
+        if row is None:
+            # Products from before sharding all sit in the main file
+            has_products = db.execute("SELECT 1 FROM products LIMIT 1").fetchone() is not None
+            row = (1 if has_products else SHARD_COUNT,)
+            db.execute("INSERT INTO shard_layout (shard_count) VALUES (?)", row)
+            db.commit()
+        if row[0] != SHARD_COUNT:
+            print(f"Error starting server: the database is split into {row[0]} shards, but SHARD_COUNT is {SHARD_COUNT}")
+            return False
+        return True
+    finally:
         db.close()
-    
+
+def shard_path(shard):
+    """The database file of one shard"""
+    if shard == 0:
+        return DB_PATH
+    return f"{os.path.splitext(DB_PATH)[0]}.shard{shard}.db"
+
+def shard_of(key):
+    """The shard holding an owner's products, or a product (product IDs are assigned so they route the same way)"""
+    try:
+        return int(key) % SHARD_COUNT
+    except (TypeError, ValueError):
+        return 0
+
+def shard_reader(shard):
+    """The calling thread's read connection to a shard file, opened on first use"""
+    connections = shard_readers.__dict__.setdefault("connections", {})
+    db = connections.get(shard)
+    if db is None:
+        db = connections[shard] = diagnostics.connect(shard_path(shard))
+        if shard != 0:
+            # Unqualified names fall through to attached files, so joins against users still work
+            db.execute("ATTACH DATABASE ? AS accounts", (DB_PATH,))
+    return db
+
+def close_shard_readers():
+    """Close the calling thread's shard connections"""
+    for db in shard_readers.__dict__.pop("connections", {}).values():
+        db.close()
+
+def shard_db(db, key):
+    """The connection for reading the shard of key (an owner or product ID); db itself for the main file"""
+    shard = shard_of(key)
+    return db if shard == 0 else shard_reader(shard)
+
+def shard_rows(shard, command, query, params):
+    diagnostics.set_command(command)
+    return shard_reader(shard).execute(query, params).fetchall()
+
+# Keys that merge rows already sorted per shard by sort_clause: (id, name, price, description, rating) rows
+SHARD_MERGE_KEYS = {
+    "price": lambda row: row[2],
+    "price_desc": lambda row: -row[2],
+    "rating": lambda row: -(row[4] or 0),
+}
+
+def gather_rows(db, query, params=(), sort=None, limit=None):
+    """Run a read query on every shard in parallel and merge the rows in sort order, or in shard order"""
+    if SHARD_COUNT == 1:
+        return db.execute(query, params).fetchall()
+    command = diagnostics.current_command()
+    futures = [shard_pool.submit(shard_rows, shard, command, query, params) for shard in range(SHARD_COUNT)]
+    parts = [future.result() for future in futures]
+    if sort in SHARD_MERGE_KEYS:
+        rows = list(heapq.merge(*parts, key=SHARD_MERGE_KEYS[sort]))
+    else:
+        rows = [row for part in parts for row in part]
+    if isinstance(limit, int) and limit >= 0:
+        rows = rows[:limit]
+    return rows
+
+def query_batches(db, query, params, to_item, sort=None, limit=None):
+    """Batches of items for send_stream, read off one cursor or gathered from every shard"""
+    if SHARD_COUNT == 1:
+        yield from row_batches(db.execute(query, params), to_item)
+        return
+    rows = gather_rows(db, query, params, sort, limit)
+    for start in range(0, len(rows), STREAM_BATCH_SIZE):
+        yield [to_item(row) for row in rows[start:start + STREAM_BATCH_SIZE]]
+
+def shard_of_name(db, product_name):
+    """The shard holding the oldest product with a name, which is the one purchase_product buys"""
+    if SHARD_COUNT == 1:
+        return 0
+    rows = gather_rows(db, "SELECT id FROM products WHERE name = ? ORDER BY id LIMIT 1", (product_name,))
+    return shard_of(min(rows)[0]) if rows else 0
+
+def next_product_id(cursor, shard):
+    """The next unused product ID in a shard's file, congruent to the shard modulo SHARD_COUNT and never reused"""
+    cursor.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'products'), 0)")
+    current = max(cursor.fetchone()[0], cursor.execute("SELECT COALESCE(MAX(id), 0) FROM products").fetchone()[0])
+    return current + ((shard - current) % SHARD_COUNT or SHARD_COUNT)
+
+def run_write(db, operation, *args, stores_images=False, shard=0, on_commit=None, on_rollback=None):
+    """Run operation(cursor, *args) in a write transaction on one shard; on_commit/on_rollback run in commit order"""
+    if not writer_dbs:
+        db = shard_db(db, shard)
+        with direct_write_lock:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                result = operation(db.cursor(), *args)
+                if stores_images:
+                    image_store.sync()
+                db.commit()
+            except BaseException:
+                db.rollback()
+                run_write_hook(on_rollback)
+                raise
+            run_write_hook(on_commit, result)
+        return result
+    future = concurrent.futures.Future()
+    write_queues[shard].put((operation, args, stores_images, on_commit, on_rollback, diagnostics.current_command(), future))
+    try:
+        return future.result(WRITE_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # A write the writer has not started is skipped; one it is running may still commit
+        if not future.cancel() and future.done():
+            return future.result()
+        raise sqlite3.OperationalError(f"the shard {shard} writer did not answer within {WRITE_TIMEOUT}s")
+
+def run_write_hook(hook, *args):
+    """Call an on_commit or on_rollback step; a failing one is reported and does not stop the others"""
+    if hook is None:
+        return
+    try:
+        hook(*args)
+    except Exception as e:
+        print(f"Error updating state after a write: {e}")
+
+def start_writers():
+    """Open one write connection per shard and start the thread that commits through each"""
+    for shard in range(SHARD_COUNT):
+        db = diagnostics.connect(shard_path(shard), isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA foreign_keys=on")
+        writer_dbs.append(db)
+        write_queues.append(queue.Queue())
+        threading.Thread(target=write_loop, args=(db, write_queues[shard]), name=f"writer-{shard}", daemon=True).start()
+
+def write_loop(db, write_queue):
+    """Collect queued writes for up to GROUP_COMMIT_WINDOW and commit each group at once"""
+    while True:
+        group = [write_queue.get()]
+        deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+        while len(group) < GROUP_COMMIT_SIZE:
+            try:
+                group.append(write_queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            diagnostics.profile_call(commit_group, db, group)
+        except Exception as e:
+            # Keep the writer alive: fail this group's writes and carry on with the next
+            print(f"Error in the shard writer: {e}")
+            try:
+                if db.in_transaction:
+                    db.rollback()
+            except sqlite3.Error:
+                pass
+            for *_, future in group:
+                if not future.done():
+                    future.set_exception(e)
+
+def commit_group(db, group):
+    """Run a group of writes in one transaction, each in its own savepoint so a failing one is rolled back alone"""
+    cursor = db.cursor()
+    outcomes = []
+    try:
+        diagnostics.set_command("group commit")
+        cursor.execute("BEGIN IMMEDIATE")
+        sync_images = False
+        for operation, args, stores_images, on_commit, on_rollback, command, future in group:
+            if not future.set_running_or_notify_cancel():
+                # The caller stopped waiting before the write started
+                continue
+            diagnostics.set_command(command)
+            cursor.execute("SAVEPOINT write_op")
+            try:
+                result = operation(cursor, *args)
+                cursor.execute("RELEASE write_op")
+                outcomes.append((future, result, None, on_commit, on_rollback))
+                sync_images = sync_images or stores_images
+            except Exception as e:
+                cursor.execute("ROLLBACK TO write_op")
+                cursor.execute("RELEASE write_op")
+                run_write_hook(on_rollback)
+                outcomes.append((future, None, e, None, None))
+        diagnostics.set_command("group commit")
+        if sync_images:
+            image_store.sync()
+        cursor.execute("COMMIT")
+    except Exception as e:
+        print(f"Error committing a group of {len(group)} writes: {e}")
+        if db.in_transaction:
+            cursor.execute("ROLLBACK")
+        for _, _, error, _, on_rollback in outcomes:
+            if error is None:
+                run_write_hook(on_rollback)
+        for *_, future in group:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for _, result, error, on_commit, _ in outcomes:
+        if error is None:
+            run_write_hook(on_commit, result)
+    for future, result, error, _, _ in outcomes:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
 def handle_commands(server_socket, client_socket, msg, db):
     """Process client commands"""
     command = msg["command"]
@@ -422,10 +2245,30 @@ def handle_commands(server_socket, client_socket, msg, db):
         elif command == "login":  
             username = msg["username"]
             password = msg["password"]
-            login_user(server_socket, client_socket, username, password, db)
+            ip = msg.get("ip")
+            port = msg.get("port")
+            login_user(server_socket, client_socket, username, password, ip, port, db)
+        elif command == "ping":
+            client_socket.send(json.dumps({"status": "pong"}).encode('utf-8'))
+        elif command == "subscribe_presence":
+            subscribe_presence(client_socket)
+        elif command == "subscribe_catalog":
+            subscribe_catalog(client_socket, msg.get("since"), msg.get("epoch"))
+        elif command == "issue_token":
+            issue_session_token(client_socket)
+        elif command == "resume_session":
+            resume_session(client_socket, msg["token"], msg.get("ip"), msg.get("port"))
+        elif command in ("profile", "heap", "flash_sale"):
+            run_admin_command(client_socket, msg, db)
+        elif command == "image_endpoint":
+            send_image_endpoint(client_socket)
+        elif command == "get_image":
+            send_image(client_socket, msg["product_id"], db)
         elif command == "display":
             id = msg["self_id"]
-            send_items(client_socket, db, id)
+            in_currency = resolve_currency(client_socket, msg.get("currency"))
+            if in_currency is not False:
+                send_items(client_socket, db, id, msg.get("stream", False), in_currency)
         elif command == "sell":
             name = msg["product_name"]  
             price = msg["price"]
@@ -433,7 +2276,19 @@ def handle_commands(server_socket, client_socket, msg, db):
             amount = msg["amount"]
             id = msg["self_id"]
             image = msg["image_path"]
-            register_item(server_socket, client_socket, name, price, image, description, amount, id, db)
+            image_sha256 = msg.get("image_sha256")
+            upload_id = msg.get("upload_id")
+            register_item(server_socket, client_socket, name, price, image, description, amount, id, db, image_sha256, upload_id)
+        elif command == "sell_batch":
+            register_batch(client_socket, msg["items"], msg["self_id"], db)
+        elif command == "begin_upload":
+            begin_upload(client_socket, msg["size"], msg["self_id"], msg.get("sha256"))
+        elif command == "upload_chunk":
+            upload_chunk(client_socket, msg["upload_id"], msg["offset"], msg["length"])
+        elif command == "query_upload":
+            query_upload(client_socket, msg["upload_id"])
+        elif command == "finish_upload":
+            finish_upload(client_socket, msg["upload_id"])
         elif command == "check_online":
             username = msg["owner_username"]
             check_online_status(client_socket, username)
@@ -448,20 +2303,31 @@ def handle_commands(server_socket, client_socket, msg, db):
                 if owner_id is None:
                     client_socket.send(json.dumps("User not found.").encode('utf-8'))
                     return
-                filter_by_owner(client_socket, owner_id, db)
+                in_currency = resolve_currency(client_socket, msg.get("currency"))
+                if in_currency is False:
+                    return
+                filter_by_owner(client_socket, owner_id, db, msg.get("with_images", True), msg.get("sort"), msg.get("limit"),
+                                msg.get("stream", False), in_currency)
         elif command == "filter_by_budget":
             budget = msg["budget"]
             self_id = msg["self_id"]
             if budget == float("inf"):
                 client_socket.send(json.dumps("there is no budget").encode('utf-8'))
-            filter_by_budget(client_socket, budget, db, self_id)
+            in_currency = resolve_currency(client_socket, msg.get("currency"))
+            if in_currency is False:
+                return
+            filter_by_budget(client_socket, budget, db, self_id, msg.get("with_images", True), msg.get("sort"), msg.get("limit"),
+                             msg.get("stream", False), in_currency)
         elif command == "Purchase":
             product_name = msg["product_name"]
             buyer_id = msg["self_id"]
             purchase_product(server_socket, client_socket, product_name, buyer_id, db)
         elif command == "view_buyers":
             seller_id = msg["self_id"]
-            view_sold_product_buyers(server_socket, client_socket, seller_id, db)
+            view_sold_product_buyers(server_socket, client_socket, seller_id, db, msg.get("stream", False),
+                                     msg.get("limit", ORDERS_PAGE_SIZE), msg.get("before"))
+        elif command == "seller_stats":
+            seller_stats(client_socket, msg["self_id"], db)
         elif command == "logout":
             handle_logout(client_socket)
         elif command == "rate":
@@ -469,11 +2335,11 @@ def handle_commands(server_socket, client_socket, msg, db):
             product_id = msg["product_id"]
             user_id = msg["self_id"]
             
-            cursor = db.cursor()
+            cursor = shard_db(db, product_id).cursor()
             cursor.execute("""
-                SELECT buyer_id FROM products 
-                WHERE id = ? AND buyer_id = ?
-            """, (product_id, user_id))
+                SELECT 1 FROM orders 
+                WHERE buyer_id = ? AND product_id = ? LIMIT 1
+            """, (user_id, product_id))
             
             if cursor.fetchone():
                 response = rate(rating, product_id, db)
@@ -484,10 +2350,14 @@ def handle_commands(server_socket, client_socket, msg, db):
         elif command == "display_rating":
             product_id = msg["product_id"]
             display_rating(product_id, client_socket, db)
+        elif command == "suggest":
+            suggest(client_socket, msg.get("prefix", ""), msg.get("limit", SUGGEST_LIMIT))
         elif command == "search":
             item = msg["item"]
             self_id = msg["self_id"]
-            search(item,client_socket,db,self_id)
+            in_currency = resolve_currency(client_socket, msg.get("currency"))
+            if in_currency is not False:
+                search(item,client_socket,db,self_id, msg.get("with_images", True), msg.get("stream", False), in_currency)
         elif command == "get_ip_and_port":
             username=msg["username"]
             if username in online_users:
@@ -498,7 +2368,7 @@ def handle_commands(server_socket, client_socket, msg, db):
                 message={ "ip":ip, "port": port}
                 response = json.dumps(message)
             else:
-                response = {"error": "User not online"}
+                response = json.dumps({"error": "User not online"})
             client_socket.send(response.encode('utf-8'))
         elif command == "get_price":
             item_name = msg["product_name"]
@@ -516,18 +2386,29 @@ def handle_commands(server_socket, client_socket, msg, db):
         print(f"Error handling command '{command}': {e}")
         client_socket.send("Server error. Please try again later.".encode('utf-8'))
 
+def record_rating(cursor, rating, product_id):
+    """Write operation: fold a rating into a product's average; returns the new average, or None"""
+    cursor.execute("SELECT rating, num_raters FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    current_rating, num_raters = row
+    new_num_raters = num_raters + 1
+    new_rating = ((current_rating * num_raters) + rating) / new_num_raters
+    cursor.execute("UPDATE products SET rating = ?, num_raters = ? WHERE id = ?", (new_rating, new_num_raters, product_id))
+    return new_rating
+
+def commit_rating(product_id, new_rating):
+    """on_commit step for record_rating"""
+    if new_rating is not None:
+        commit_catalog_change("rating", product_id=product_id, rating=new_rating)
+
 def rate(rating, product_id, db):
     """Calculate the new rating based on the number of raters and the previous rating"""
     try:
-        cursor = db.cursor()
-        cursor.execute("SELECT rating, num_raters FROM products WHERE id = ?", (product_id,))
-        row = cursor.fetchone()
-        if row:
-            current_rating, num_raters = row
-            new_num_raters = num_raters + 1
-            new_rating = ((current_rating * num_raters) + rating) / new_num_raters
-            cursor.execute("UPDATE products SET rating = ?, num_raters = ? WHERE id = ?", (new_rating, new_num_raters, product_id))
-            db.commit()
+        new_rating = run_write(db, record_rating, rating, product_id, shard=shard_of(product_id),
+                               on_commit=lambda new_rating: commit_rating(product_id, new_rating))
+        if new_rating is not None:
             response = {"message": "Rating submitted successfully."}
         else:
             response = {"message": "Product not found."}
@@ -539,26 +2420,28 @@ def rate(rating, product_id, db):
         print(f"Unexpected error during rating: {e}")
         return json.dumps({"message": "An unexpected error occurred."})
 
-def send_items(client_socket, db, id):
-    """Fetch all products from the database and return them to the client"""
-    cursor = db.cursor()
+def listing_item(row):
+    """Turn an (id, name, price, description, image) row into the dict sent by display"""
+    return {
+        'id': row[0],
+        'name': row[1],
+        'price': row[2],
+        'description': row[3],
+        'image': row[4]
+    }
+
+def send_items(client_socket, db, id, stream=False, in_currency=None):
+    """Fetch all products from the database and return them to the client, priced in in_currency if given"""
+    query = "SELECT id, name, price, description, image FROM products WHERE status = 'available' AND amount > 0"
     try:
-        cursor.execute("SELECT id, name, price, description, image FROM products WHERE status = 'available' AND amount > 0")
-        rows = cursor.fetchall()
+        if stream:
+            send_stream(client_socket, priced_batches(query_batches(db, query, (), listing_item), in_currency))
+            return
+        rows = gather_rows(db, query)
         if not rows:
             response = json.dumps({"error": "No products found."})
         else:
-            items_data = []
-            for row in rows:
-                item = {
-                    'id': row[0],
-                    'name': row[1],
-                    'price': row[2],
-                    'description': row[3],
-                    'image': row[4]
-                }
-                items_data.append(item)
-            response = json.dumps(items_data)
+            response = json.dumps(price_items([listing_item(row) for row in rows], in_currency))
         client_socket.send(response.encode('utf-8'))
     except sqlite3.Error as e:
         print(f"Error retrieving products from the database: {e}")
@@ -570,38 +2453,56 @@ def send_items(client_socket, db, id):
         client_socket.send(error_response.encode('utf-8'))
 
 
-def filter_by_budget(client_socket, budget, db, self_id):
-    """Filter and return items by owner ID"""
-    cursor = db.cursor()
+def filter_by_budget(client_socket, budget, db, self_id, with_images=True, sort=None, limit=None, stream=False, in_currency=None):
+    """Filter and return items priced within a budget, read and priced in in_currency when one is given"""
+    if in_currency is not None:
+        budget = currency.to_base(budget, in_currency[1])
+    limit = query_limit(limit)
     try:
-        cursor.execute("""
-            SELECT id, name, price, description 
-            FROM products 
-            WHERE price <= ? AND amount > 0 AND owner_id != ?
-        """, (budget, self_id))
-        rows = cursor.fetchall()
-        items_data = []
-        for row in rows:
-            item = {
-                'id': row[0],
-                'name': row[1],
-                'price': row[2],
-                'description': row[3]
-            }
-            items_data.append(item)
+        if catalog is not None and stream:
+            send_stream(client_socket, catalog.stream_by_budget(budget, self_id, sort, limit, STREAM_BATCH_SIZE, in_currency))
+            return
+        if catalog is not None:
+            items_data = catalog.filter_by_budget(budget, self_id, sort, limit, in_currency)
+        else:
+            clause, params = sort_clause(sort, limit)
+            query = """
+                SELECT id, name, price, description, rating
+                FROM products 
+                WHERE price <= ? AND amount > 0 AND owner_id != ?
+            """ + clause
+            if stream:
+                send_stream(client_socket, priced_batches(query_batches(db, query, (budget, self_id) + params,
+                                                                        product_item, sort, limit), in_currency))
+                return
+            rows = gather_rows(db, query, (budget, self_id) + params, sort, limit)
+            items_data = price_items([product_item(row) for row in rows], in_currency)
 
         if not items_data:
             client_socket.send(json.dumps({"items": [], "total_images": 0}).encode('utf-8'))
             return
-        items_json = json.dumps({"items": items_data, "total_images": len(items_data)})
+        total_images = len(items_data) if with_images else 0
+        items_json = json.dumps({"items": items_data, "total_images": total_images})
         client_socket.send(items_json.encode('utf-8'))
+        if not with_images:
+            return
         for item in items_data:
-            send_image(client_socket, item['id'])
+            send_image(client_socket, item['id'], db)
     except Exception as e:
-        print(f"Error in filter_by_owner: {e}")
+        print(f"Error in filter_by_budget: {e}")
         client_socket.send(json.dumps({"error": "Server error. Please try again later."}).encode('utf-8'))
 
 
+def seller_stats(client_socket, seller_id, db):
+    """Send a seller's order count and revenue, kept up to date by every purchase"""
+    try:
+        row = shard_db(db, seller_id).execute("SELECT orders, revenue FROM seller_stats WHERE seller_id = ?", (seller_id,)).fetchone()
+        orders, revenue = row if row else (0, 0.0)
+        client_socket.send(json.dumps({"status": "ok", "orders": orders, "revenue": revenue}).encode('utf-8'))
+    except sqlite3.Error as e:
+        print(f"Database error retrieving seller stats: {e}")
+        client_socket.send(json.dumps({"status": "error", "message": "Server error. Please try again later."}).encode('utf-8'))
+
 def check_online_status(client_socket, username):
     if username in online_users:
         message = {
@@ -618,7 +2519,7 @@ def check_online_status(client_socket, username):
 
 def display_rating(id, client_socket, db):
     """Display product name and rating for given product ID"""
-    cursor = db.cursor()
+    cursor = shard_db(db, id).cursor()
     try:
         cursor.execute("""
             SELECT p.name, p.rating 
@@ -647,34 +2548,37 @@ def display_rating(id, client_socket, db):
         client_socket.send(json.dumps(error_response).encode('utf-8'))
 
 
-def search(item,client_socket, db, self_id):
-    cursor = db.cursor()
-    try:
-        cursor.execute("""
+def suggest(client_socket, prefix, limit):
+    """Send the product names that complete a partial name"""
+    if not isinstance(prefix, str) or not isinstance(limit, int) or limit < 1:
+        client_socket.send(json.dumps({"status": "error", "error": "Invalid suggest request"}).encode('utf-8'))
+        return
+    suggestions = name_index.suggest(prefix, min(limit, MAX_SUGGEST_LIMIT))
+    client_socket.send(json.dumps({"status": "ok", "suggestions": suggestions}).encode('utf-8'))
+
+def search(item,client_socket, db, self_id, with_images=True, stream=False, in_currency=None):
+    query = """
             SELECT p.id, p.name, p.price, p.description 
             FROM products p 
             WHERE (p.name LIKE ? OR p.description LIKE ?) 
             AND p.owner_id != ? AND p.amount > 0
-        """, ('%' + item + '%', '%' + item + '%', self_id))
-        rows = cursor.fetchall()
-        items_data = []
-        for row in rows:
-            item = {
-                'id': row[0],
-                'name': row[1],
-                'price': row[2],
-                'description': row[3]
-            }
-            items_data.append(item)
+        """
+    params = ('%' + item + '%', '%' + item + '%', self_id)
+    try:
+        if stream:
+            send_stream(client_socket, priced_batches(query_batches(db, query, params, product_item), in_currency))
+            return
+        items_data = price_items([product_item(row) for row in gather_rows(db, query, params)], in_currency)
         items_json = json.dumps(items_data)
         client_socket.send(items_json.encode('utf-8'))
-        ack = client_socket.recv(1024).decode('utf-8')
-        if ack != "READY_FOR_IMAGES":
+        # Clients do not ask for images when there are none, and the next bytes are their next command
+        if not with_images or not items_data:
+            return
+        if not receive_handshake(client_socket, "READY_FOR_IMAGES"):
             return
         for item in items_data:
-            send_image(client_socket, item['id'])
-            ack = client_socket.recv(1024).decode('utf-8')
-            if ack != "NEXT_IMAGE":
+            send_image(client_socket, item['id'], db)
+            if not receive_handshake(client_socket, "NEXT_IMAGE"):
                 break
     except sqlite3.Error as e:
         print(f"Database error when retrieving items: {e}")
@@ -698,21 +2602,266 @@ def send_message(sender_username, recipient_username, message):
         sender_socket.send(message_json.encode('utf-8'))
 
 
-def handle_server():
-    """Main server loop to accept client connections"""
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def load_catalog():
+    """Build the columnar catalog and the name index from every shard"""
+    global catalog, name_index
+    fresh_catalog = columnar_catalog.ColumnarCatalog() if USE_COLUMNAR_CATALOG and columnar_catalog.available() else None
+    fresh_index = NameIndex()
+    for shard in range(SHARD_COUNT):
+        db = sqlite3.connect(shard_path(shard))
+        if fresh_catalog is not None:
+            fresh_catalog.load(db)
+        fresh_index.load(db.execute("SELECT id, name FROM products WHERE amount > 0 AND status = 'available'"))
+        db.close()
+    catalog, name_index = fresh_catalog, fresh_index
+
+def apply_catalog_change(change):
+    """Bring the columnar catalog and name index up to date with a committed change, ours or the previous process's"""
+    event = change["event"]
+    if event == "listed":
+        product = change["product"]
+        if catalog is not None:
+            catalog.add(product["id"], product["owner_id"], product["name"], product["price"], product["description"], product["amount"])
+        if product["amount"] > 0:
+            name_index.add(product["id"], product["name"])
+    elif event == "sold":
+        if catalog is not None:
+            catalog.update(change["product_id"], amount=0, status='sold')
+        name_index.remove(change["product_id"])
+    elif catalog is not None and event == "amount":
+        catalog.update(change["product_id"], amount=change["amount"])
+    elif catalog is not None and event == "rating":
+        catalog.update(change["product_id"], rating=change["rating"])
+
+def start_restart_listener(server_socket):
+    """Listen on RESTART_SOCKET for a new process that wants to take over"""
+    if not RESTART_SOCKET:
+        return
     try:
-        server_socket.bind(("localhost", int(sys.argv[1])))
-        server_socket.  listen(100)
-    except socket.error as e:
-        print(f"Error starting server: {e}")
+        listener = handoff.listen(RESTART_SOCKET)
+    except OSError as e:
+        print(f"Error listening for takeovers on {RESTART_SOCKET}: {e}")
+        return
+    threading.Thread(target=wait_for_successor, args=(listener, server_socket), daemon=True).start()
+
+def wait_for_successor(listener, server_socket):
+    """Hand over to the first new process that connects and asks to take over"""
+    while True:
+        sock, _ = listener.accept()
+        channel = handoff.Channel(sock)
+        with catalog_feed_lock:
+            seq = catalog_seq
+        try:
+            message = channel.receive()[0] if channel.send({"type": "mark", "seq": seq}) else None
+        except (OSError, ValueError) as e:
+            print(f"Error talking to the new server process: {e}")
+            message = None
+        if message is not None and message.get("type") == "take_over":
+            break
+        print("The new server process went away before taking over; still serving")
+        channel.close()
+    listener.close()
+    try:
+        os.unlink(RESTART_SOCKET)
+    except OSError:
+        pass
+    hand_over(channel, server_socket)
+
+def hand_over(channel, server_socket):
+    """Give the listening sockets and shared state to the successor, then drain for up to DRAIN_TIMEOUT and exit"""
+    global successor, flash_sales_paused
+    print("Handing over to a new server process")
+    flash_sales_paused = True
+    # A flash sale's stock lives in this process; write it through before the successor can sell the product
+    for product_name in list(flash_sales):
+        stop_flash_sale(product_name)
+    stop_accepting.set()
+    if not accepting_stopped.wait(5):
+        print("The accept loop did not stop; handing over anyway")
+    fds = [server_socket.fileno()]
+    if image_httpd is not None:
+        fds.append(image_httpd.socket.fileno())
+    with catalog_feed_lock, session_tokens_lock:
+        sent = channel.send({"type": "listener", "epoch": CATALOG_EPOCH, "seq": catalog_seq,
+                             "feed": list(catalog_feed), "sessions": session_tokens}, fds)
+        if sent:
+            successor = channel
+    if not sent:
+        print("Could not hand over; still serving")
+        channel.close()
+        flash_sales_paused = False
+        handoff_finished.set()
+        start_restart_listener(server_socket)
         return
-    db_path = "botique.db"
+    release_connections.set()
+    if image_httpd is not None:
+        image_httpd.shutdown()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while active_connections and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if active_connections:
+        print(f"Dropping {active_connections} connections still busy after {DRAIN_TIMEOUT}s")
+    channel.send({"type": "done"})
+    channel.close()
+    if traffic_capture:
+        traffic_capture.flush()
+    print("Handed over to the new server process")
+    sys.stdout.flush()
+    handoff_finished.set()
+    if not accepting_stopped.is_set():
+        # The accept loop is stuck in accept() on the socket the successor now serves
+        os._exit(0)
+
+def take_over(channel, mark):
+    """Ask the running server to hand over; returns (listening socket, image listener or None), or None"""
+    global CATALOG_EPOCH, catalog_seq, predecessor
+    if not channel.send({"type": "take_over"}):
+        return None
+    try:
+        state, fds = channel.receive()
+    except (OSError, ValueError) as e:
+        print(f"Error taking over: {e}")
+        return None
+    if state is None or state.get("type") != "listener" or not fds:
+        print("Error taking over: the running server did not hand over its listener")
+        return None
+    server_socket = socket.socket(fileno=fds[0])
+    image_socket = socket.socket(fileno=fds[1]) if len(fds) > 1 else None
+    feed = state["feed"]
+    with catalog_feed_lock:
+        CATALOG_EPOCH = state["epoch"]
+        catalog_seq = state["seq"]
+        catalog_feed.clear()
+        catalog_feed.extend(feed)
+    if catalog_seq > mark and (not feed or feed[0]["seq"] > mark + 1):
+        print("More catalog changes than the feed holds were made during startup; reloading the catalog")
+        load_catalog()
+    else:
+        for change in feed:
+            if change["seq"] > mark:
+                apply_catalog_change(change)
+    with session_tokens_lock:
+        session_tokens.update(state["sessions"])
+    predecessor = channel
+    return server_socket, image_socket
+
+def follow_predecessor(channel, server_socket, db_path):
+    """Take the connections, catalog changes and session updates the previous process sends while it drains"""
+    global predecessor, flash_sales_paused
+    while True:
+        try:
+            message, fds = channel.receive()
+        except (OSError, ValueError) as e:
+            print(f"Error receiving from the previous server process: {e}")
+            break
+        if message is None or message["type"] == "done":
+            break
+        kind = message["type"]
+        if kind == "connection":
+            client_socket = socket.socket(fileno=fds[0])
+            if not acquire_connection_slot():
+                client_socket.close()
+                continue
+            client_thread = threading.Thread(target=handle_client, args=(server_socket, client_socket, tuple(message["addr"]), db_path, message))
+            client_thread.daemon = True
+            client_thread.start()
+        elif kind == "catalog":
+            apply_catalog_change(dict(message["fields"], event=message["event"]))
+            publish_catalog(message["event"], **message["fields"])
+        elif kind == "presence":
+            publish_presence(message["event"], message["username"], message["ip"], message["port"])
+        elif kind == "session":
+            with session_tokens_lock:
+                session_tokens[message["token"]] = message["session"]
+        elif kind == "revoke":
+            revoke_session_tokens(message["username"])
+    channel.close()
+    predecessor = None
+    flash_sales_paused = False
+    print("The previous server process has finished")
+    start_restart_listener(server_socket)
+
+def handle_server():
+    """Main server loop to accept client connections; with --takeover, take them over from the running server"""
+    global image_store, traffic_capture, shard_pool, flash_sales_paused
+    takeover = "--takeover" in sys.argv[2:]
+    if takeover:
+        try:
+            channel = handoff.Channel.connect(RESTART_SOCKET)
+            mark, _ = channel.receive()
+        except (OSError, ValueError) as e:
+            print(f"Error taking over: no server to take over from at {RESTART_SOCKET}: {e}")
+            return
+        if mark is None:
+            print("Error taking over: the running server is already handing over")
+            return
+        flash_sales_paused = True
+    else:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server_socket.bind(("localhost", int(sys.argv[1])))
+            server_socket.listen(LISTEN_BACKLOG)
+        except socket.error as e:
+            print(f"Error starting server: {e}")
+            return
+    db_path = DB_PATH
+    if CAPTURE_FILE:
+        traffic_capture = capture.TrafficCapture(CAPTURE_FILE)
+    if IMAGE_STORAGE == "sqlite":
+        if not image_storage.blob_io_available():
+            print("Error starting server: IMAGE_STORAGE 'sqlite' needs Python 3.11+ for Connection.blobopen")
+            return
+        image_store = image_storage.SQLiteImageStore()
     create_Tables(db_path)
+    if not check_shard_layout(db_path):
+        return
+    for shard in range(1, SHARD_COUNT):
+        create_Tables(shard_path(shard), shard)
+    if SHARD_COUNT > 1:
+        shard_pool = concurrent.futures.ThreadPoolExecutor(SHARD_READ_WORKERS, thread_name_prefix="shard-read")
+    start_writers()
+    rates.refresh()
+    load_catalog()
+    image_socket = None
+    if takeover:
+        sockets = take_over(channel, mark["seq"])
+        if sockets is None:
+            return
+        server_socket, image_socket = sockets
+        threading.Thread(target=follow_predecessor, args=(channel, server_socket, db_path), daemon=True).start()
+    else:
+        start_restart_listener(server_socket)
+    if SERVE_IMAGES_OVER_HTTP:
+        start_image_http(db_path, image_socket)
+    elif image_socket is not None:
+        image_socket.close()
+    threading.Thread(target=reap_stale_sessions, daemon=True).start()
+    threading.Thread(target=broadcast_pushes, daemon=True).start()
     while True:
         try:
+            readable, _, _ = select.select([server_socket, stop_accepting], [], [])
+            if stop_accepting in readable:
+                accepting_stopped.set()
+                handoff_finished.wait()
+                if successor is not None:
+                    break
+                # The handoff failed before the successor got the listener; keep serving
+                stop_accepting.clear()
+                accepting_stopped.clear()
+                handoff_finished.clear()
+                continue
             client_socket, addr = server_socket.accept()
+            if not acquire_connection_slot():
+                # Shed the connection right away instead of letting it queue behind the others
+                try:
+                    send_busy(client_socket, BUSY_RETRY_MS)
+                except socket.error:
+                    pass
+                client_socket.close()
+                continue
+            if len(rate_limit_buckets) > 10000:
+                prune_rate_limit_buckets()
             client_thread = threading.Thread(target=handle_client, args=(server_socket, client_socket, addr, db_path))
             client_thread.daemon = True
             client_thread.start()
@@ -721,4 +2870,5 @@ def handle_server():
             server_socket.close()
             break
 
-handle_server()
\ No newline at end of file
+if __name__ == "__main__":
+    handle_server()
@@ -0,0 +1,226 @@
+"""Fixtures that run a real server process in a temp directory and talk to it over its protocol.
+
+start_server creates the database, lets a test seed it, then launches
+server.py with module settings overridden (for example a shorter group-commit
+window or flash sales turned off). Connection speaks the raw command protocol,
+so tests can drive many users at once without the full Client and its
+background threads.
+"""
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import bcrypt
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server
+
+# Password of every seeded user
+PASSWORD = "test-password"
+# bcrypt cost of the seeded hashes; the lowest allowed, so logging in many users stays fast
+BCRYPT_ROUNDS = 4
+# Seconds to wait for the server to start accepting connections
+STARTUP_TIMEOUT = 15
+# Seconds any read from the server may take in a test
+REPLY_TIMEOUT = 15
+
+# Imports the server, applies the settings passed as JSON, and runs it on the given port with any flags after them
+LAUNCHER = """
+import json, sys
+import server
+for name, value in json.loads(sys.argv[2]).items():
+    setattr(server, name, value)
+del sys.argv[2]
+server.handle_server()
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def insert_user(db, username):
+    """Add a user who logs in with PASSWORD; returns the user ID"""
+    password = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+    cursor = db.execute("INSERT INTO users (username, email, password, name) VALUES (?, ?, ?, ?)",
+                        (username, f"{username}@example.com", password, username))
+    db.commit()
+    return cursor.lastrowid
+
+def insert_product(db, owner_id, name, price=10.0, amount=1, description="test product"):
+    """Add an available product without an image; returns the product ID"""
+    cursor = db.execute("INSERT INTO products (owner_id, name, price, description, amount, status) VALUES (?, ?, ?, ?, ?, 'available')",
+                        (owner_id, name, price, description, amount))
+    db.commit()
+    return cursor.lastrowid
+
+class Connection:
+    """One connection to the server, speaking the JSON command protocol"""
+    def __init__(self, port):
+        self.sock = socket.create_connection(("localhost", port), timeout=REPLY_TIMEOUT)
+        self.buffer = b""
+        self.user_id = None
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message).encode('utf-8'))
+
+    def receive(self, size=65536):
+        """Raw bytes: whatever is buffered, or the next read"""
+        if self.buffer:
+            data, self.buffer = self.buffer, b""
+            return data
+        data = self.sock.recv(size)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        return data
+
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            data += self.receive(size - len(data))
+        if len(data) > size:
+            self.buffer = data[size:] + self.buffer
+        return data[:size]
+
+    def reply(self):
+        """The next JSON value the server sends"""
+        decoder = json.JSONDecoder()
+        data = b""
+        while True:
+            data += self.receive()
+            text = data.decode('utf-8', errors='surrogateescape').lstrip()
+            try:
+                value, end = decoder.raw_decode(text)
+            except json.JSONDecodeError:
+                continue
+            self.buffer = text[end:].encode('utf-8', errors='surrogateescape') + self.buffer
+            return value
+
+    def read_until(self, marker):
+        """Text up to and including marker"""
+        data = b""
+        while marker.encode('utf-8') not in data:
+            data += self.receive()
+        end = data.index(marker.encode('utf-8')) + len(marker)
+        self.buffer = data[end:] + self.buffer
+        return data[:end].decode('utf-8')
+
+    def request(self, message):
+        self.send(message)
+        return self.reply()
+
+    def login(self, username, ip=None, port=None):
+        """Log in as a seeded user; returns the user ID"""
+        welcome = f"Login successful.\nWelcome {username}"
+        self.send({"command": "login", "username": username, "password": PASSWORD, "ip": ip, "port": port})
+        text = self.read_until(welcome)
+        assert text == welcome, text
+        # The ID follows the welcome in its own send
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while not self.buffer and time.monotonic() < deadline:
+            self.buffer = self.sock.recv(1024)
+        self.user_id, self.buffer = int(self.buffer.decode('utf-8')), b""
+        return self.user_id
+
+    def close(self):
+        self.sock.close()
+
+class ServerProcess:
+    """server.py running in its own directory on a free port"""
+    def __init__(self, directory, settings):
+        self.directory = str(directory)
+        self.settings = settings
+        self.port = free_port()
+        self.db_path = os.path.join(self.directory, server.DB_PATH)
+        self.image_dir = os.path.join(self.directory, server.IMAGE_DIR)
+        self.log_path = os.path.join(self.directory, "server.log")
+        self.process = None
+        # Processes this one took over from, which may still be draining
+        self.predecessors = []
+        self.connections = []
+        server.create_Tables(self.db_path)
+
+    def db(self):
+        return sqlite3.connect(self.db_path, timeout=REPLY_TIMEOUT)
+
+    def launch(self, *flags):
+        env = dict(os.environ, PYTHONPATH=ROOT, PYTHONUNBUFFERED="1")
+        with open(self.log_path, 'a') as log:
+            return subprocess.Popen([sys.executable, "-c", LAUNCHER, str(self.port), json.dumps(self.settings), *flags],
+                                    cwd=self.directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    def take_over(self):
+        """Start a new server process that takes over from the running one; returns the old process"""
+        old = self.process
+        self.predecessors.append(old)
+        self.process = self.launch("--takeover")
+        return old
+
+    def start(self):
+        self.process = self.launch()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("localhost", self.port), timeout=1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"server did not start:\n{self.log()}")
+                time.sleep(0.05)
+
+    def connect(self):
+        conn = Connection(self.port)
+        self.connections.append(conn)
+        return conn
+
+    def log(self):
+        with open(self.log_path) as f:
+            return f.read()
+
+    def stop(self):
+        for conn in self.connections:
+            conn.close()
+        for process in self.predecessors + [self.process]:
+            if process and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+
+@pytest.fixture
+def start_server(tmp_path):
+    """Start a server: start_server(seed=fn(db), **settings) returns a running ServerProcess.
+
+    seed, if given, fills the fresh database before the server loads it. The
+    settings replace server module globals of the same name. Takeovers are off
+    unless a test turns them back on.
+    """
+    servers = []
+
+    def start(seed=None, **settings):
+        settings.setdefault("RESTART_SOCKET", None)
+        directory = tmp_path / f"server{len(servers)}"
+        directory.mkdir()
+        process = ServerProcess(directory, settings)
+        servers.append(process)
+        if seed:
+            db = process.db()
+            try:
+                seed(db)
+            finally:
+                db.close()
+        process.start()
+        return process
+
+    yield start
+    for process in servers:
+        process.stop()
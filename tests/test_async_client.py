@@ -0,0 +1,61 @@
+import asyncio
+import os
+
+from async_client import AsyncClient
+from conftest import insert_user, insert_product, PASSWORD, REPLY_TIMEOUT
+
+IMAGE = os.urandom(50000)
+STOCK = ["lamp", "vase", "rug", "chair", "mirror", "clock"]
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    for name in STOCK:
+        insert_product(db, seller_id, name, price=10.0)
+
+async def logged_in(port, username):
+    user = AsyncClient(port, pool_size=3)
+    await user.connect()
+    assert (await user.login(username, PASSWORD)).startswith("Login successful.")
+    return user
+
+async def next_event(user, kind):
+    """The next pushed event whose status or type is kind, skipping others"""
+    async def wait():
+        async for event in user.events():
+            if isinstance(event, dict) and kind in (event.get("status"), event.get("type")):
+                return event
+    return await asyncio.wait_for(wait(), REPLY_TIMEOUT)
+
+def test_concurrent_requests_share_one_login(start_server, tmp_path):
+    process = start_server(seed)
+    image_path = tmp_path / "photo.jpg"
+    image_path.write_bytes(IMAGE)
+
+    async def scenario():
+        seller, buyer = await asyncio.gather(logged_in(process.port, "seller"), logged_in(process.port, "buyer"))
+        try:
+            buyer.budget = 35.0
+            listed = await seller.sell_item("desk", 12.5, "a desk", str(image_path), 1)
+            assert listed == "Product registered successfully with image."
+
+            # More purchases than pooled connections, all in flight at once; the budget covers three
+            results = await asyncio.gather(*(buyer.purchase_product(name) for name in STOCK[:3]))
+            assert all(result.startswith("Purchase successful!") for result in results)
+            assert buyer.budget == 5.0
+            assert await buyer.purchase_product(STOCK[3]) == "Purchase cannot be completed. Not enough budget."
+
+            # The seller's login connection is pushed a notification per sale
+            notes = [await next_event(seller, "notification") for _ in range(3)]
+            assert all("has been purchased" in note["message"] for note in notes)
+
+            items, found = await asyncio.gather(buyer.get_items(), buyer.search_product("desk"))
+            assert {item["name"] for item in items} == set(STOCK[3:]) | {"desk"}
+            assert [item["name"] for item in found] == ["desk"]
+            saved = tmp_path / "received" / "desk.jpg"
+            assert await buyer.get_image(found[0]["id"], str(saved))
+            assert saved.read_bytes() == IMAGE
+        finally:
+            await asyncio.gather(seller.close(), buyer.close())
+
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import bench_handlers
+import columnar_catalog
+from conftest import ROOT
+
+def run_bench(*args):
+    return subprocess.run([sys.executable, "bench_handlers.py", "run", "--sizes", "50", "--samples", "2",
+                           "--min-time", "0.0005", "--warmup", "1", *args],
+                          cwd=ROOT, capture_output=True, text=True, timeout=300)
+
+def test_run_times_every_handler_and_compare_flags_only_real_slowdowns(tmp_path, capsys):
+    output = tmp_path / "base.json"
+    finished = run_bench("--output", str(output))
+    assert finished.returncode == 0, finished.stderr
+    report = json.loads(output.read_text())
+    expected = set(bench_handlers.BENCHMARKS)
+    if not columnar_catalog.available():
+        expected.discard("filter_by_budget[columnar]")
+    assert {result["benchmark"] for result in report["results"]} == expected
+
+    # Ten clearly separated samples per side are enough for the U test to call it
+    for result in report["results"]:
+        result["samples"] = [0.001 + i * 1e-6 for i in range(10)]
+        result["median"] = 0.001
+    slower = json.loads(json.dumps(report))
+    for result in slower["results"]:
+        result["samples"] = [sample * 2 for sample in result["samples"]]
+        result["median"] *= 2
+    base, new = tmp_path / "base.json", tmp_path / "new.json"
+    base.write_text(json.dumps(report))
+    new.write_text(json.dumps(slower))
+    assert bench_handlers.main(["compare", str(base), str(base)]) == 0
+    assert bench_handlers.main(["compare", str(base), str(new)]) == 1
+    assert f"{len(expected)} regressions" in capsys.readouterr().out
+
+def test_run_refuses_a_checkout_that_starts_the_server_on_import(tmp_path):
+    (tmp_path / "server.py").write_text("handle_server()\n")
+    finished = run_bench("--server-dir", str(tmp_path))
+    assert finished.returncode != 0 and "starts the server when imported" in finished.stderr
+
+@pytest.mark.parametrize("before, after, significant", [([1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12], True),
+                                                        ([1, 2, 3], [1, 2, 3], False)])
+def test_mann_whitney(before, after, significant):
+    assert (bench_handlers.mann_whitney_p(before, after) < bench_handlers.SIGNIFICANCE) == significant
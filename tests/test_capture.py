@@ -0,0 +1,68 @@
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+
+import capture
+import replay
+from conftest import PASSWORD, insert_user, insert_product
+
+def records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f][1:]
+
+def test_exchanges_are_recorded_without_passwords_or_binary_payloads(tmp_path):
+    path = str(tmp_path / "capture.jsonl")
+    traffic = capture.TrafficCapture(path)
+    conn = traffic.connection()
+    conn.inbound(b'{"command": "login", "username": "alice", ')
+    conn.inbound(b'"password": "hunter2"}')
+    conn.outbound(b"Login successful.")
+    pusher = threading.Thread(target=conn.outbound, args=(b'{"type": "presence"}',))
+    pusher.start()
+    pusher.join()
+    conn.inbound(b"\x00\xff" * 10)
+    conn.outbound(b"x" * (capture.OUT_TEXT_LIMIT + 1))
+    conn.close()
+
+    login, image, closed = records(path)
+    # The command split across two reads is one exchange; the push from another thread is only counted
+    assert json.loads(login["in"]["d"])["password"].startswith("redacted-")
+    assert "hunter2" not in json.dumps(login)
+    assert (login["out"], login["push"]) == ({"d": "Login successful."}, 20)
+    assert image["in"]["n"] == 20 and "d" not in image["in"]
+    assert image["out"]["n"] == capture.OUT_TEXT_LIMIT + 1
+    assert closed == {"c": 1, "t": closed["t"], "close": True}
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_product(db, seller_id, "lamp", price=12.0)
+
+def test_replay_reproduces_a_captured_session(start_server):
+    recorded = start_server(seed, CAPTURE_FILE="capture.jsonl")
+    conn = recorded.connect()
+    conn.send({"command": "Register", "username": "newbie", "email": "newbie@example.com", "password": PASSWORD,
+               "name": "Newbie"})
+    assert conn.read_until("successful.") == "Registration successful."
+    conn.login("newbie")
+    listing = conn.request({"command": "display", "self_id": conn.user_id})
+    assert [item["name"] for item in listing] == ["lamp"]
+    conn.close()
+    path = os.path.join(recorded.directory, "capture.jsonl")
+    deadline = time.monotonic() + 10
+    while not any(record.get("close") for record in records(path)):
+        assert time.monotonic() < deadline, "the connection was never closed in the capture"
+        time.sleep(0.05)
+    assert PASSWORD not in open(path).read()
+
+    # The replay registers the user with the redacted password, so logging in with it works too
+    fresh = start_server(seed)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        replay.main([path, "--port", str(fresh.port), "--speed", "max"])
+
+    report = output.getvalue()
+    assert "Replayed 3 exchanges" in report
+    assert "Matching replies: 3/3" in report, report
@@ -0,0 +1,43 @@
+import pytest
+
+from test_purchases import BUYERS, SETTINGS, buy_at_once, seed
+
+def subscribe(conn, since=None, epoch=None):
+    conn.login("seller")
+    reply = conn.request({"command": "subscribe_catalog", "since": since, "epoch": epoch})
+    assert reply["status"] == "subscribed"
+    return reply["seq"], reply["epoch"]
+
+def changes_until_sold(conn):
+    """Catalog changes up to the sale of the last unit, skipping the seller's purchase notifications"""
+    changes = []
+    while not changes or changes[-1]["event"] != "sold":
+        message = conn.reply()
+        if message.get("type") == "catalog":
+            changes.append(message)
+    return changes
+
+@pytest.mark.parametrize("flash_sale_concurrency", [None, 8], ids=["record-purchase", "flash-sale"])
+def test_feed_follows_commit_order_and_resumes(start_server, flash_sale_concurrency):
+    process = start_server(seed, FLASH_SALE_CONCURRENCY=flash_sale_concurrency, **SETTINGS)
+    live = process.connect()
+    seq, epoch = subscribe(live)
+
+    buy_at_once(process, "lamp")
+
+    changes = changes_until_sold(live)
+    assert [change["seq"] for change in changes] == list(range(seq + 1, seq + 1 + len(changes)))
+    # Stock only goes down in sequence order, ending in the sale of the last unit
+    amounts = [change["amount"] for change in changes[:-1]]
+    assert amounts == sorted(set(amounts), reverse=True) and all(0 < amount < len(BUYERS) for amount in amounts)
+    if flash_sale_concurrency is None:
+        assert amounts == list(range(len(BUYERS) - 1, 0, -1))
+
+    # A subscriber that saw nothing since seq is sent the same changes again
+    resumed = process.connect()
+    assert subscribe(resumed, seq, epoch) == (seq, epoch)
+    assert changes_until_sold(resumed) == changes
+    # One whose epoch is from another run of the server reloads instead
+    stale = process.connect()
+    subscribe(stale, seq, "another-run")
+    assert stale.reply() == {"type": "catalog", "seq": changes[-1]["seq"], "event": "reset", "epoch": epoch}
@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import catalog_tool
+import image_storage
+import server
+from conftest import ROOT
+
+USERS = [{"id": 1, "username": "seller", "email": "s@example.com", "password": "hash", "name": "Seller"},
+         {"id": 2, "username": "buyer", "email": "b@example.com", "password": "hash", "name": "Buyer"}]
+PRODUCTS = [{"id": 10, "owner_id": 1, "name": "lamp", "price": 5.0, "amount": 0, "image": "lamp.jpg",
+             "buyer_id": 2, "status": "sold"},
+            {"id": 11, "owner_id": 1, "name": "vase", "price": 7.5, "amount": 0, "buyer_id": 2, "status": "sold"},
+            {"id": 12, "owner_id": 1, "name": "rug", "price": 20.0, "amount": 3, "image": "rug.jpg"}]
+IMAGES = {"lamp.jpg": b"lamp image", "rug.jpg": b"rug image" * 10000}
+
+def write_jsonl(path, rows):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    return str(path)
+
+@pytest.fixture(params=["fs", "sqlite"])
+def storage(request):
+    if request.param == "sqlite" and not image_storage.blob_io_available():
+        pytest.skip("this sqlite3 module has no Connection.blobopen")
+    return request.param
+
+def test_import_and_export_go_through_the_image_store_and_ledger(tmp_path, storage):
+    images = tmp_path / "images"
+    images.mkdir()
+    for name, data in IMAGES.items():
+        (images / name).write_bytes(data)
+    db_path = str(tmp_path / "botique.db")
+    image_dir = str(tmp_path / "product_images")
+    store_args = ["--db", db_path, "--image-storage", storage, "--image-dir", image_dir]
+
+    catalog_tool.main(["import", "--users", write_jsonl(tmp_path / "users.jsonl", USERS),
+                       "--products", write_jsonl(tmp_path / "products.jsonl", PRODUCTS),
+                       "--images-dir", str(images), "--batch-size", "2"] + store_args)
+
+    db = sqlite3.connect(db_path)
+    assert db.execute("SELECT product_id, buyer_id, seller_id, price FROM orders ORDER BY id").fetchall() == [
+        (10, 2, 1, 5.0), (11, 2, 1, 7.5)]
+    assert db.execute("SELECT seller_id, orders, revenue FROM seller_stats").fetchall() == [(1, 2, 12.5)]
+    # The ledger's indexes were dropped for the load and built again
+    indexes = {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"orders_by_seller", "orders_by_buyer"} <= indexes
+    # The server reads the images back from the store it is configured with
+    store = catalog_tool.open_image_store(storage, image_dir)
+    size, stream = store.open(db, 12)
+    with stream:
+        assert (size, stream.read()) == (len(IMAGES["rug.jpg"]), IMAGES["rug.jpg"])
+    assert store.open(db, 11) is None
+    db.close()
+
+    exported = tmp_path / "exported"
+    catalog_tool.main(["export", "--products", str(tmp_path / "out.jsonl"), "--images-dir", str(exported)] + store_args)
+    assert {path.name: path.read_bytes() for path in exported.iterdir()} == {"10.jpg": IMAGES["lamp.jpg"],
+                                                                          "12.jpg": IMAGES["rug.jpg"]}
+
+def test_catalog_tool_does_not_import_the_server():
+    # Importing server.py sets up all of its module state; the tool only needs the schema
+    loaded = subprocess.run([sys.executable, "-c", "import sys, catalog_tool; print('server' in sys.modules)"],
+                            cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert loaded.strip() == "False"
+    assert catalog_tool.create_Tables is server.create_Tables
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import client
+from conftest import insert_user, insert_product, PASSWORD
+
+NAMES = [f"item{i}" for i in range(12)]
+IMAGE = os.urandom(30000)
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    image_dir = os.path.join(os.path.dirname(db.execute("PRAGMA database_list").fetchone()[2]), "product_images")
+    os.makedirs(image_dir, exist_ok=True)
+    for name in NAMES:
+        product_id = insert_product(db, seller_id, name, price=10.0)
+        with open(os.path.join(image_dir, f"{product_id}.jpg"), 'wb') as f:
+            f.write(IMAGE)
+        db.execute("UPDATE products SET image = ? WHERE id = ?", (f"{product_id}.jpg", product_id))
+    db.commit()
+
+@pytest.fixture
+def buyer(start_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Images inline on the command connection, so downloads go through the pool
+    process = start_server(seed, SERVE_IMAGES_OVER_HTTP=False)
+    buyer = client.Client(process.port, None)
+    buyer.start_connection()
+    assert buyer.login("buyer", PASSWORD).startswith("Login successful.")
+    assert buyer.open_pool(4)
+    yield buyer, process
+    buyer.close_pool()
+    buyer.logout()
+
+def test_pooled_purchases_run_as_the_logged_in_user_and_share_the_budget(buyer):
+    buyer, process = buyer
+    buyer.set_budget(1000)
+
+    futures = [buyer.submit("purchase_product", name) for name in NAMES]
+
+    results = [future.result(30) for future in futures]
+    assert [result for result in results if not result.startswith("Purchase successful!")] == []
+    assert buyer.budget == 1000 - 10 * len(NAMES)
+    buyers = {buyer_id for (buyer_id,) in process.db().execute("SELECT buyer_id FROM orders")}
+    assert buyers == {int(buyer.id)}
+
+def test_images_download_in_parallel_over_the_pool(buyer, tmp_path):
+    buyer, process = buyer
+    product_ids = [product_id for (product_id,) in process.db().execute("SELECT id FROM products ORDER BY id")]
+
+    paths = buyer.download_images(product_ids, str(tmp_path / "images"))
+
+    assert len(paths) == len(product_ids)
+    for path in paths:
+        with open(path, 'rb') as f:
+            assert f.read() == IMAGE
+    # The main connection is still in step after the pool did the work
+    assert buyer.ping()
@@ -0,0 +1,65 @@
+import os
+import threading
+
+import pytest
+
+import client
+from conftest import insert_user, insert_product, PASSWORD
+
+IMAGE = os.urandom(20000)
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    for name, amount in (("lamp", 2), ("lamp shade", 1), ("ladder", 0), ("vase", 1)):
+        product_id = insert_product(db, seller_id, name, amount=amount, description=f"a {name}")
+        image_dir = os.path.join(os.path.dirname(db.execute("PRAGMA database_list").fetchone()[2]), "product_images")
+        os.makedirs(image_dir, exist_ok=True)
+        with open(os.path.join(image_dir, f"{product_id}.jpg"), 'wb') as f:
+            f.write(IMAGE)
+        db.execute("UPDATE products SET image = ? WHERE id = ?", (f"{product_id}.jpg", product_id))
+    db.commit()
+
+@pytest.fixture(params=[True, False], ids=["http-images", "inline-images"])
+def buyer(request, start_server, tmp_path, monkeypatch):
+    """A logged-in Client, fetching images over HTTP or inline on its connection"""
+    monkeypatch.chdir(tmp_path)
+    process = start_server(seed, SERVE_IMAGES_OVER_HTTP=request.param)
+    buyer = client.Client(process.port, None)
+    buyer.start_connection()
+    assert buyer.login("buyer", PASSWORD).startswith("Login successful.")
+    yield buyer
+    buyer.logout()
+
+def test_suggest_lists_in_stock_names_by_prefix(buyer):
+    assert buyer.suggest("la") == ["lamp", "lamp shade"]
+    assert buyer.suggest("LAMP S") == ["lamp shade"]
+    assert buyer.suggest("la", limit=1) == ["lamp"]
+    assert buyer.suggest("zzz") == []
+
+def test_search_returns_items_with_their_images(buyer):
+    result = buyer.search_product("lamp")
+
+    assert "Name: lamp\n" in result and "Name: lamp shade\n" in result
+    assert "vase" not in result and "ladder" not in result
+    assert result.count("Image: Available") == 2
+    saved = [name for name in os.listdir("received_images") if name.endswith(".jpg")]
+    assert len(saved) == 2
+    for name in saved:
+        with open(os.path.join("received_images", name), 'rb') as f:
+            assert f.read() == IMAGE
+    # The connection is left clean for the next command
+    assert buyer.ping()
+    assert buyer.search_product("nothing like this") == "No items available."
+
+@pytest.mark.parametrize("method, args", [("suggest", ("la",)), ("search_product", ("lamp",))])
+def test_queries_wait_for_the_connection_lock(buyer, method, args):
+    """Holding io_lock (as the heartbeat does while it pings) keeps the query off the connection"""
+    results = []
+    with buyer.io_lock:
+        thread = threading.Thread(target=lambda: results.append(getattr(buyer, method)(*args)))
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive() and results == []
+    thread.join(10)
+    assert results and "lamp" in str(results[0])
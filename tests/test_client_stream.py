@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import client
+from conftest import insert_user, insert_product, PASSWORD, REPLY_TIMEOUT
+
+NAMES = [f"item{i}" for i in range(7)]
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    for name in NAMES:
+        insert_product(db, seller_id, name)
+
+@pytest.fixture
+def buyer(start_server):
+    # Two items a frame, so every stream has several frames left after the first row
+    process = start_server(seed, STREAM_BATCH_SIZE=2)
+    buyer = client.Client(process.port, None)
+    buyer.start_connection()
+    assert buyer.login("buyer", PASSWORD).startswith("Login successful.")
+    yield buyer
+    buyer.logout()
+
+def display(buyer):
+    return buyer.stream_query({"command": "display", "self_id": buyer.id})
+
+def in_another_thread(function):
+    """Run function on another thread, the way the heartbeat pings, and return its result"""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function()))
+    thread.start()
+    thread.join(REPLY_TIMEOUT)
+    assert not thread.is_alive(), "the command waited on a stream that was not being read"
+    return results[0]
+
+def test_other_threads_can_send_commands_while_a_stream_is_being_read(buyer):
+    rows = display(buyer)
+    names = [next(rows)["name"]]
+
+    assert in_another_thread(buyer.ping)
+    assert in_another_thread(lambda: buyer.suggest("item"))[0] == NAMES[0]
+
+    # The rest of the stream was read ahead for the first reader, nothing lost
+    names.extend(item["name"] for item in rows)
+    assert names == NAMES
+
+def test_a_stream_stopped_early_leaves_the_connection_clean(buyer):
+    rows = display(buyer)
+    assert next(rows)["name"] == NAMES[0]
+    rows.close()
+
+    assert in_another_thread(buyer.ping)
+    assert [item["name"] for item in display(buyer)] == NAMES
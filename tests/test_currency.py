@@ -0,0 +1,57 @@
+import json
+import os
+
+import pytest
+
+import columnar_catalog
+from conftest import insert_user, insert_product
+
+def seed(db):
+    directory = os.path.dirname(db.execute("PRAGMA database_list").fetchone()[2])
+    with open(os.path.join(directory, "currency_rates.json"), 'w') as f:
+        json.dump({"base": "USD", "rates": {"EUR": 0.5}}, f)
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    insert_product(db, seller_id, "lamp", price=10.0, description="a desk lamp")
+    insert_product(db, seller_id, "vase", price=25.0, description="a glass vase")
+
+@pytest.fixture(params=[True, False], ids=["columnar", "sqlite"])
+def buyer(request, start_server):
+    process = start_server(seed, USE_COLUMNAR_CATALOG=request.param)
+    conn = process.connect()
+    conn.login("buyer")
+    return conn
+
+def prices(items):
+    return {item["name"]: (item["price"], item.get("currency")) for item in items}
+
+def test_display_and_search_are_priced_in_the_requested_currency(buyer):
+    listing = buyer.request({"command": "display", "self_id": buyer.user_id, "currency": "eur"})
+    assert prices(listing) == {"lamp": (5.0, "EUR"), "vase": (12.5, "EUR")}
+    found = buyer.request({"command": "search", "item": "lamp", "self_id": buyer.user_id, "with_images": False,
+                           "currency": "EUR"})
+    assert prices(found) == {"lamp": (5.0, "EUR")}
+    # Without a currency prices stay in the base currency
+    listing = buyer.request({"command": "display", "self_id": buyer.user_id})
+    assert prices(listing) == {"lamp": (10.0, None), "vase": (25.0, None)}
+
+@pytest.mark.parametrize("budget, expected", [(5, {"lamp": (5.0, "EUR")}), (4.99, {}),
+                                              (12.5, {"lamp": (5.0, "EUR"), "vase": (12.5, "EUR")})])
+def test_budget_is_read_in_the_requested_currency(buyer, budget, expected):
+    reply = buyer.request({"command": "filter_by_budget", "budget": budget, "self_id": buyer.user_id,
+                           "with_images": False, "currency": "EUR"})
+    assert prices(reply["items"]) == expected
+
+def test_unknown_currency_is_refused(buyer):
+    reply = buyer.request({"command": "display", "self_id": buyer.user_id, "currency": "XYZ"})
+    assert reply == {"error": "Unknown currency: XYZ"}
+
+@pytest.mark.skipif(not columnar_catalog.available(), reason="NumPy is not installed")
+def test_cached_prices_follow_rate_changes_and_new_listings():
+    catalog = columnar_catalog.ColumnarCatalog(capacity=2)
+    catalog.add(1, 7, "lamp", 10.0, "", 1)
+    assert catalog.prices_in([1, 99], ("EUR", 0.5)) == [5.0, None]
+    catalog.add(2, 7, "vase", 3.333, "", 1)
+    catalog.add(3, 7, "rug", 40.0, "", 1)
+    assert catalog.prices_in([3, 2, 1], ("EUR", 0.5)) == [20.0, 1.67, 5.0]
+    assert catalog.prices_in([1], ("EUR", 2.0)) == [20.0]
@@ -0,0 +1,75 @@
+import json
+import os
+import time
+
+import pytest
+
+import diagnostics
+from conftest import insert_user
+
+@pytest.fixture
+def slow_log(tmp_path, monkeypatch):
+    """Log every statement, to a file under tmp_path"""
+    path = tmp_path / "slow.log"
+    monkeypatch.setattr(diagnostics, "SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(diagnostics, "SLOW_QUERY_LOG", str(path))
+    def entries():
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+    return entries
+
+def test_slow_queries_are_logged_with_parameter_types_only(tmp_path, slow_log):
+    db = diagnostics.connect(str(tmp_path / "test.db"))
+    db.execute("CREATE TABLE users (name TEXT, budget REAL)")
+    diagnostics.set_command("sign_up")
+    db.executemany("INSERT INTO users VALUES (?, ?)", [("alice", 5.0), ("bob", 7.0)])
+    db.commit()
+
+    entries = slow_log()
+    insert, commit = entries[-2:]
+    assert (insert["command"], insert["params"]) == ("sign_up", {"rows": 2, "row": ["str", "float"]})
+    # sqlite3 opened a transaction before the INSERT on its own
+    assert insert["ran"][0] == "BEGIN"
+    assert commit["sql"] == "COMMIT"
+    assert "alice" not in json.dumps(entries)
+
+def test_statements_under_the_threshold_are_not_logged(tmp_path, slow_log, monkeypatch):
+    monkeypatch.setattr(diagnostics, "SLOW_QUERY_MS", 60_000)
+    db = diagnostics.connect(str(tmp_path / "test.db"))
+    db.execute("SELECT 1")
+    assert not os.path.exists(diagnostics.SLOW_QUERY_LOG)
+
+def wait_for(path, text):
+    """Wait for the server to finish writing text to path"""
+    deadline = time.monotonic() + 10
+    while True:
+        if os.path.exists(path):
+            with open(path) as f:
+                if text in f.read():
+                    return
+        assert time.monotonic() < deadline, f"{path} never said {text!r}"
+        time.sleep(0.05)
+
+def test_admin_can_profile_and_snapshot_the_heap(start_server):
+    process = start_server(lambda db: (insert_user(db, "admin"), insert_user(db, "buyer")))
+    buyer = process.connect()
+    buyer.login("buyer")
+    assert buyer.request({"command": "profile", "seconds": 1}) == {"status": "error", "message": "Not allowed"}
+
+    admin = process.connect()
+    admin.login("admin")
+    assert admin.request({"command": "profile", "seconds": 0})["status"] == "error"
+    reply = admin.request({"command": "profile", "seconds": 0.5})
+    assert reply["status"] == "ok"
+    assert admin.request({"command": "profile", "seconds": 0.5}) == {"status": "error", "message": "Already profiling"}
+    buyer.request({"command": "display", "self_id": buyer.user_id})
+    wait_for(os.path.join(process.directory, reply["summary"]), "commands profiled")
+    assert os.path.exists(os.path.join(process.directory, reply["path"]))
+
+    assert admin.request({"command": "heap"})["status"] == "error"
+    assert admin.request({"command": "heap", "action": "start"}) == {"status": "ok", "tracing": True}
+    reply = admin.request({"command": "heap"})
+    assert reply["status"] == "ok"
+    with open(os.path.join(process.directory, reply["summary"])) as f:
+        assert f.read().startswith("traced:")
+    assert admin.request({"command": "heap", "action": "stop"}) == {"status": "ok", "tracing": False}
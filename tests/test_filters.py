@@ -0,0 +1,36 @@
+import pytest
+
+from conftest import insert_user, insert_product
+
+PRICES = {"lamp": 30.0, "vase": 10.0, "rug": 20.0}
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    for name, price in PRICES.items():
+        insert_product(db, seller_id, name, price=price)
+
+@pytest.fixture(params=[True, False], ids=["columnar", "sqlite"])
+def buyer(request, start_server):
+    process = start_server(seed, USE_COLUMNAR_CATALOG=request.param)
+    conn = process.connect()
+    conn.login("buyer")
+    return conn
+
+def names(conn, command, **fields):
+    query = {"command": command, "self_id": conn.user_id, "with_images": False, **fields}
+    return [item["name"] for item in conn.request(query)["items"]]
+
+@pytest.mark.parametrize("command, fields", [("filter_by_budget", {"budget": 100}),
+                                             ("filter_by_owner", {"owner_username": "seller"})])
+@pytest.mark.parametrize("sort", [None, "price"])
+def test_limits_behave_like_sql(buyer, command, fields, sort):
+    assert names(buyer, command, sort=sort, limit=0, **fields) == []
+    assert len(names(buyer, command, sort=sort, limit=2, **fields)) == 2
+    # A limit that is not a row count is ignored, the way an unknown sort is
+    assert sorted(names(buyer, command, sort=sort, limit="2", **fields)) == sorted(PRICES)
+    assert sorted(names(buyer, command, sort=sort, limit=-1, **fields)) == sorted(PRICES)
+
+def test_sorted_top_k(buyer):
+    assert names(buyer, "filter_by_budget", budget=100, sort="price", limit=2) == ["vase", "rug"]
+    assert names(buyer, "filter_by_budget", budget=100, sort="price_desc") == ["lamp", "rug", "vase"]
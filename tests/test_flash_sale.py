@@ -0,0 +1,58 @@
+import collections
+
+from conftest import insert_user, insert_product
+from test_purchases import SETTINGS, buy, buy_at_once
+
+BUYERS = [f"buyer{i}" for i in range(60)]
+STOCK = 40
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "admin")
+    for username in BUYERS:
+        insert_user(db, username)
+    insert_product(db, seller_id, "lamp", amount=STOCK)
+
+def start_sale(process, product_name):
+    admin = process.connect()
+    admin.login("admin")
+    reply = admin.request({"command": "flash_sale", "action": "start", "product_name": product_name})
+    assert reply["status"] == "ok"
+    return reply
+
+def stored_sales(process):
+    return process.db().execute(
+        "SELECT amount, status, (SELECT COUNT(*) FROM orders) FROM products WHERE name = 'lamp'").fetchone()
+
+def test_flash_sale_sells_the_stock_once_and_answers_the_rest_sold_out(start_server):
+    # A long commit window keeps every buyer waiting on the sale's first batch at once
+    process = start_server(seed, GROUP_COMMIT_WINDOW=0.5, **SETTINGS)
+    seller = process.connect()
+    seller.login("seller")
+    assert start_sale(process, "lamp")["remaining"] == STOCK
+
+    conns, statuses = buy_at_once(process, "lamp", BUYERS, retry_busy=False)
+
+    # More buyers than the write cap allows at once, yet none was shed as busy
+    assert collections.Counter(statuses) == {"success": STOCK, "Product_sold": len(BUYERS) - STOCK}
+    assert stored_sales(process) == (0, "sold", STOCK)
+    # The seller, who is online, hears of every unit sold
+    notifications = [seller.reply() for _ in range(STOCK)]
+    assert all(note["status"] == "notification" and "lamp" in note["message"] for note in notifications)
+    assert buy(conns[0], "lamp") == "Product_sold"
+
+def test_sqlite_stays_authoritative_over_the_sale_count(start_server):
+    process = start_server(seed, **SETTINGS)
+    start_sale(process, "lamp")
+    seller = process.connect()
+    seller.login("seller")
+    assert buy(seller, "lamp") == "Product_is_yours"
+    # Units the sale still counts were sold outside it
+    db = process.db()
+    db.execute("UPDATE products SET amount = 30 WHERE name = 'lamp'")
+    db.commit()
+
+    _, statuses = buy_at_once(process, "lamp", BUYERS[:STOCK])
+
+    assert collections.Counter(statuses) == {"success": 30, "Product_sold": STOCK - 30}
+    assert stored_sales(process) == (0, "sold", 30)
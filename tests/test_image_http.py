@@ -0,0 +1,88 @@
+import http.client
+import os
+import tempfile
+
+import pytest
+
+import image_storage
+from conftest import insert_user, insert_product
+
+IMAGE = os.urandom(100 * 1024 + 7)
+
+def seeder(storage):
+    def seed(db):
+        seller_id = insert_user(db, "seller")
+        product_id = insert_product(db, seller_id, "lamp")
+        image_dir = os.path.join(os.path.dirname(db.execute("PRAGMA database_list").fetchone()[2]), "product_images")
+        os.makedirs(image_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=image_dir, suffix=".part")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(IMAGE)
+        store = image_storage.SQLiteImageStore() if storage == "sqlite" else image_storage.FileImageStore(image_dir)
+        image = store.store(db, temp_path, product_id)
+        db.execute("UPDATE products SET image = ? WHERE id = ?", (image, product_id))
+        db.commit()
+    return seed
+
+@pytest.fixture(params=["fs", "sqlite"])
+def images(request, start_server):
+    """(GET function, product ID) against a server storing images on disk or in SQLite"""
+    if request.param == "sqlite" and not image_storage.blob_io_available():
+        pytest.skip("this sqlite3 module has no Connection.blobopen")
+    process = start_server(seeder(request.param), IMAGE_STORAGE=request.param)
+    conn = process.connect()
+    conn.login("seller")
+    token = conn.request({"command": "issue_token"})["token"]
+    endpoint = conn.request({"command": "image_endpoint"})
+    product_id = process.db().execute("SELECT id FROM products").fetchone()[0]
+    http_conn = http.client.HTTPConnection("localhost", endpoint["port"], timeout=10)
+
+    def get(headers=None, method="GET", path=None, authorized=True):
+        headers = dict(headers or {})
+        if authorized:
+            headers["Authorization"] = f"Bearer {token}"
+        http_conn.request(method, path or f"{endpoint['path']}{product_id}", headers=headers)
+        response = http_conn.getresponse()
+        return response, response.read()
+
+    yield get
+    http_conn.close()
+
+def test_whole_image_and_revalidation(images):
+    response, body = images()
+    assert (response.status, body) == (200, IMAGE)
+    assert response.getheader("Accept-Ranges") == "bytes"
+    etag = response.getheader("ETag")
+
+    # The same keep-alive connection answers a revalidation without the body
+    response, body = images({"If-None-Match": etag})
+    assert (response.status, body, response.getheader("ETag")) == (304, b"", etag)
+    response, body = images({"If-None-Match": '"something-else"'})
+    assert (response.status, body) == (200, IMAGE)
+
+    response, body = images(method="HEAD")
+    assert (response.status, body, int(response.getheader("Content-Length"))) == (200, b"", len(IMAGE))
+
+@pytest.mark.parametrize("header, start, end", [("bytes=10-19", 10, 19), ("bytes=-5", len(IMAGE) - 5, len(IMAGE) - 1),
+                                                ("bytes=100000-", 100000, len(IMAGE) - 1),
+                                                ("bytes=0-999999999", 0, len(IMAGE) - 1)])
+def test_ranges(images, header, start, end):
+    response, body = images({"Range": header})
+    assert response.status == 206
+    assert response.getheader("Content-Range") == f"bytes {start}-{end}/{len(IMAGE)}"
+    assert body == IMAGE[start:end + 1]
+
+def test_range_edge_cases(images):
+    response, _ = images({"Range": f"bytes={len(IMAGE)}-"})
+    assert (response.status, response.getheader("Content-Range")) == (416, f"bytes */{len(IMAGE)}")
+    # A partial copy of some other version of the image gets the whole image back
+    response, body = images({"Range": "bytes=10-19", "If-Range": '"stale"'})
+    assert (response.status, body) == (200, IMAGE)
+    etag = response.getheader("ETag")
+    response, body = images({"Range": "bytes=10-19", "If-Range": etag})
+    assert (response.status, body) == (206, IMAGE[10:20])
+
+def test_requests_need_a_session_token_and_a_known_image(images):
+    assert images(authorized=False)[0].status == 401
+    assert images(path="/images/999")[0].status == 404
+    assert images(path="/elsewhere")[0].status == 404
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+
+import pytest
+
+import image_storage
+from conftest import insert_user
+from test_sell import sell
+
+IMAGE = os.urandom(3 * image_storage.CHUNK_SIZE + 11)
+
+@pytest.fixture(params=["fs", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite" and not image_storage.blob_io_available():
+        pytest.skip("this sqlite3 module has no Connection.blobopen")
+    db = sqlite3.connect(str(tmp_path / "images.db"), isolation_level=None)
+    db.execute(image_storage.IMAGES_TABLE)
+    store = image_storage.SQLiteImageStore() if request.param == "sqlite" else image_storage.FileImageStore(str(tmp_path))
+    yield store, db
+    db.close()
+
+def upload(tmp_path, data=IMAGE):
+    path = tmp_path / "upload.part"
+    path.write_bytes(data)
+    return str(path)
+
+def read(store, db, product_id):
+    size, stream = store.open(db, product_id)
+    with stream:
+        return size, b"".join(iter(lambda: stream.read(image_storage.CHUNK_SIZE), b''))
+
+def test_stored_image_reads_back_in_chunks(store, tmp_path):
+    store, db = store
+    temp_path = upload(tmp_path)
+    db.execute("BEGIN IMMEDIATE")
+    assert store.store(db, temp_path, 7) == "7.jpg"
+    store.sync()
+    db.execute("COMMIT")
+
+    assert not os.path.exists(temp_path)
+    assert read(store, db, 7) == (len(IMAGE), IMAGE)
+    assert store.open(db, 8) is None
+
+def test_rolled_back_image_is_gone_and_its_upload_kept(store, tmp_path):
+    store, db = store
+    temp_path = upload(tmp_path)
+    db.execute("BEGIN IMMEDIATE")
+    image = store.store(db, temp_path, 7)
+    db.execute("ROLLBACK")
+    store.discard(image, temp_path)
+
+    assert store.open(db, 7) is None
+    # The file store moves the upload back so a retry can use it; the SQLite one already deleted its copy
+    if isinstance(store, image_storage.FileImageStore):
+        with open(temp_path, 'rb') as f:
+            assert f.read() == IMAGE
+
+def download(conn, product_id):
+    """The client side of get_image on the command connection"""
+    conn.send({"command": "get_image", "product_id": product_id})
+    size = int(conn.receive(64))
+    conn.sock.sendall(b"READY")
+    data = b""
+    while len(data) < size:
+        data += conn.read_exactly(min(8192, size - len(data)))
+        conn.sock.sendall(f"PROGRESS:{len(data) / size * 100:.2f}".encode('utf-8'))
+    conn.sock.sendall(b"SUCCESS: Image received")
+    return data
+
+def test_server_keeps_images_in_the_database_with_sqlite_storage(start_server):
+    if not image_storage.blob_io_available():
+        pytest.skip("this sqlite3 module has no Connection.blobopen")
+    process = start_server(lambda db: insert_user(db, "seller"), IMAGE_STORAGE="sqlite", SERVE_IMAGES_OVER_HTTP=False)
+    conn = process.connect()
+    conn.login("seller")
+
+    assert sell(conn, "lamp", IMAGE, None) == "Product registered successfully with image."
+
+    product_id = process.db().execute("SELECT id FROM products").fetchone()[0]
+    assert process.db().execute("SELECT length(data) FROM images WHERE product_id = ?", (product_id,)).fetchone() == (len(IMAGE),)
+    assert not [name for name in os.listdir(process.image_dir) if name.endswith(".jpg")]
+    assert download(conn, product_id) == IMAGE
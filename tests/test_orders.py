@@ -0,0 +1,52 @@
+from conftest import insert_user, insert_product
+
+BUYERS = ["buyer1", "buyer2", "buyer3"]
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    buyer_ids = [insert_user(db, username) for username in BUYERS]
+    insert_product(db, seller_id, "lamp", price=10.0, amount=3)
+    # Sold before the ledger existed: only the product row remembers its buyer
+    old_id = insert_product(db, seller_id, "clock", price=7.0, amount=0)
+    db.execute("UPDATE products SET buyer_id = ?, status = 'sold' WHERE id = ?", (buyer_ids[0], old_id))
+    db.commit()
+
+def test_purchases_are_recorded_in_the_ledger_and_seller_totals(start_server):
+    process = start_server(seed)
+    seller = process.connect()
+    seller.login("seller")
+    # The order from before the ledger was carried over when the server started
+    assert seller.request({"command": "seller_stats", "self_id": seller.user_id}) == {
+        "status": "ok", "orders": 1, "revenue": 7.0}
+
+    for username in BUYERS:
+        buyer = process.connect()
+        buyer.login(username)
+        assert buyer.request({"command": "Purchase", "product_name": "lamp", "self_id": buyer.user_id})["status"] == "success"
+        assert seller.reply()["status"] == "notification"
+
+    assert seller.request({"command": "seller_stats", "self_id": seller.user_id}) == {
+        "status": "ok", "orders": 4, "revenue": 37.0}
+
+    # Newest first, a page at a time
+    first = seller.request({"command": "view_buyers", "self_id": seller.user_id, "limit": 2})
+    assert [(order["name"], order["buyer"]) for order in first["products"]] == [("lamp", "buyer3"), ("lamp", "buyer2")]
+    second = seller.request({"command": "view_buyers", "self_id": seller.user_id, "limit": 2,
+                             "before": first["next_before"]})
+    assert [(order["name"], order["buyer"]) for order in second["products"]] == [("lamp", "buyer1"), ("clock", "buyer1")]
+    last = seller.request({"command": "view_buyers", "self_id": seller.user_id, "limit": 2,
+                           "before": second["next_before"]})
+    assert last == {"products": [], "next_before": None}
+
+def test_only_buyers_may_rate(start_server):
+    process = start_server(seed)
+    buyer, other = process.connect(), process.connect()
+    buyer.login("buyer1")
+    other.login("buyer2")
+    lamp_id = process.db().execute("SELECT id FROM products WHERE name = 'lamp'").fetchone()[0]
+    assert buyer.request({"command": "Purchase", "product_name": "lamp", "self_id": buyer.user_id})["status"] == "success"
+
+    refused = other.request({"command": "rate", "rating": 1, "product_id": lamp_id, "self_id": other.user_id})
+    assert refused == {"message": "You can only rate products you have purchased."}
+    buyer.request({"command": "rate", "rating": 5, "product_id": lamp_id, "self_id": buyer.user_id})
+    assert buyer.request({"command": "display_rating", "product_id": lamp_id}) == {"name": "lamp", "rating": 5.0}
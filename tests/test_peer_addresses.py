@@ -0,0 +1,65 @@
+import queue
+import time
+
+import pytest
+
+import client
+from conftest import insert_user, PASSWORD, REPLY_TIMEOUT
+
+def seed(db):
+    insert_user(db, "seller")
+    insert_user(db, "buyer")
+
+def log_in(process, username, inbox=None):
+    user = client.Client(process.port, None)
+    if inbox is not None:
+        # The hub is handed this callback when login starts it
+        user.on_peer_message = lambda sender, text: inbox.put((sender, text))
+    user.start_connection()
+    assert user.login(username, PASSWORD).startswith("Login successful.")
+    return user
+
+def wait_until(condition):
+    deadline = time.monotonic() + REPLY_TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+@pytest.fixture
+def users(start_server, monkeypatch):
+    process = start_server(seed)
+    inbox = queue.Queue()
+    seller = log_in(process, "seller", inbox)
+    buyer = log_in(process, "buyer")
+    lookups = []
+    get_ip_and_port = buyer.get_ip_and_port
+    monkeypatch.setattr(buyer, "get_ip_and_port", lambda username: lookups.append(username) or get_ip_and_port(username))
+    yield process, seller, buyer, inbox, lookups
+    buyer.logout()
+
+def test_addresses_are_looked_up_once_and_reused(users):
+    _, seller, buyer, inbox, lookups = users
+    assert buyer.resolve_peer("seller") == ("localhost", seller.p2p_server_port)
+    assert buyer.resolve_peer("seller") == ("localhost", seller.p2p_server_port)
+    assert lookups == ["seller"]
+
+    assert buyer.send_p2p("seller", "is the lamp still for sale?")
+    assert inbox.get(timeout=REPLY_TIMEOUT) == ("buyer", "is the lamp still for sale?")
+    assert lookups == ["seller"]
+
+def test_presence_changes_drop_cached_addresses(users):
+    process, seller, buyer, inbox, lookups = users
+    buyer.resolve_peer("seller")
+    seller.logout()
+    # The offline push removes the entry, so nobody is sent to the old address
+    wait_until(lambda: "seller" not in buyer.peer_addresses)
+
+    inbox = queue.Queue()
+    seller = log_in(process, "seller", inbox)
+    try:
+        assert buyer.resolve_peer("seller") == ("localhost", seller.p2p_server_port)
+        assert lookups == ["seller", "seller"]
+        assert buyer.send_p2p("seller", "back again?")
+        assert inbox.get(timeout=REPLY_TIMEOUT) == ("buyer", "back again?")
+    finally:
+        seller.logout()
@@ -0,0 +1,62 @@
+import collections
+import queue
+
+import pytest
+
+import client
+from conftest import free_port, REPLY_TIMEOUT
+
+@pytest.fixture
+def hubs():
+    """make(username, max_peers) starts a PeerHub; each hub's inbox and resolve calls are kept by username"""
+    ports = {}
+    inboxes = collections.defaultdict(queue.Queue)
+    lookups = collections.Counter()
+    started = []
+
+    def make(username, max_peers=client.MAX_PEER_CONNECTIONS):
+        def resolve(peer):
+            lookups[username, peer] += 1
+            return "localhost", ports[peer]
+        ports[username] = free_port()
+        hub = client.PeerHub("localhost", ports[username], username, resolve,
+                             lambda sender, text: inboxes[username].put((sender, text)), max_peers)
+        assert hub.start()
+        started.append(hub)
+        return hub
+
+    make.inboxes = inboxes
+    make.lookups = lookups
+    yield make
+    for hub in started:
+        hub.stop()
+
+def received(hubs, username, count=1):
+    return [hubs.inboxes[username].get(timeout=REPLY_TIMEOUT) for _ in range(count)]
+
+def test_one_connection_carries_messages_both_ways(hubs):
+    alice, bob = hubs("alice"), hubs("bob")
+
+    assert alice.send("bob", "hi")
+    assert received(hubs, "bob") == [("alice", "hi")]
+    # Bob answers on the connection Alice opened, without looking her up
+    assert bob.send("alice", "hello")
+    assert received(hubs, "alice") == [("bob", "hello")]
+    assert alice.send("bob", "again")
+    assert received(hubs, "bob") == [("alice", "again")]
+    assert hubs.lookups == {("alice", "bob"): 1}
+
+def test_least_recently_used_peer_is_evicted_after_its_messages_are_sent(hubs):
+    alice = hubs("alice", max_peers=1)
+    hubs("bob")
+    hubs("carol")
+
+    for i in range(3):
+        assert alice.send("bob", f"bob {i}")
+    assert alice.send("carol", "carol 0")
+    assert received(hubs, "bob", 3) == [("alice", f"bob {i}") for i in range(3)]
+    assert received(hubs, "carol") == [("alice", "carol 0")]
+    # Bob's connection was closed to make room for Carol's, so writing to him connects again
+    assert alice.send("bob", "bob 3")
+    assert received(hubs, "bob") == [("alice", "bob 3")]
+    assert hubs.lookups[("alice", "bob")] == 2
@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from conftest import insert_user, insert_product
+
+BUYERS = [f"buyer{i}" for i in range(40)]
+# Enough login tokens for every buyer to log in back to back
+SETTINGS = {"ANONYMOUS_RATE_LIMITS": {"auth": [100.0, 100], "default": [100.0, 200]}}
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    for username in BUYERS:
+        insert_user(db, username)
+    insert_product(db, seller_id, "lamp", amount=len(BUYERS))
+
+def buy(conn, product_name, retry_busy=True):
+    """Purchase one unit, retrying while the server sheds the request as busy unless retry_busy is False"""
+    while True:
+        reply = conn.request({"command": "Purchase", "product_name": product_name, "self_id": conn.user_id})
+        if reply["status"] != "busy" or not retry_busy:
+            return reply["status"]
+
+def buy_at_once(process, product_name, usernames=BUYERS, retry_busy=True):
+    """Log every buyer in, then have them all buy one unit at the same moment; returns their statuses"""
+    conns = [process.connect() for _ in usernames]
+    for conn, username in zip(conns, usernames):
+        conn.login(username)
+    start = threading.Barrier(len(conns))
+    statuses = []
+
+    def run(conn):
+        start.wait()
+        statuses.append(buy(conn, product_name, retry_busy))
+
+    threads = [threading.Thread(target=run, args=(conn,)) for conn in conns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return conns, statuses
+
+@pytest.mark.parametrize("flash_sale_concurrency", [None, 8], ids=["record-purchase", "flash-sale"])
+def test_catalog_matches_the_database_after_concurrent_purchases(start_server, flash_sale_concurrency):
+    process = start_server(seed, FLASH_SALE_CONCURRENCY=flash_sale_concurrency, **SETTINGS)
+
+    conns, statuses = buy_at_once(process, "lamp")
+
+    assert statuses == ["success"] * len(BUYERS)
+    amount, status, orders = process.db().execute(
+        "SELECT amount, status, (SELECT COUNT(*) FROM orders) FROM products WHERE name = 'lamp'").fetchone()
+    assert (amount, status, orders) == (0, "sold", len(BUYERS))
+    # The in-memory catalog must agree: the sold-out lamp is no longer offered
+    reply = conns[0].request({"command": "filter_by_budget", "budget": 100, "self_id": conns[0].user_id,
+                              "with_images": False})
+    assert reply["items"] == []
+    assert conns[0].request({"command": "suggest", "prefix": "la"})["suggestions"] == []
@@ -0,0 +1,50 @@
+import threading
+
+from conftest import insert_user, PASSWORD
+
+USERS = [f"user{i}" for i in range(10)]
+
+def seed(db):
+    for username in USERS:
+        insert_user(db, username)
+
+def test_clients_logging_in_at_once_are_not_throttled_together(start_server):
+    process = start_server(seed)
+    conns = [process.connect() for _ in USERS]
+    for conn in conns:
+        conn.sock.settimeout(2)
+    errors = []
+
+    def log_in(conn, username):
+        try:
+            conn.login(username)
+        except (AssertionError, OSError) as e:
+            errors.append(f"{username}: {e!r}")
+
+    threads = [threading.Thread(target=log_in, args=(conn, username)) for conn, username in zip(conns, USERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+def test_attaching_connections_is_charged_to_the_token_owner(start_server):
+    process = start_server(seed)
+    owner = process.connect()
+    owner.login("user0")
+    token = owner.request({"command": "issue_token"})["token"]
+    # Four attaches plus the token use up user0's auth burst; nobody else's
+    for _ in range(4):
+        assert process.connect().request({"command": "resume_session", "token": token})["status"] == "ok"
+    assert process.connect().request({"command": "resume_session", "token": token})["status"] == "busy"
+    process.connect().login("user1")
+
+def test_one_connection_is_still_limited_before_login(start_server):
+    process = start_server(seed)
+    conn = process.connect()
+    replies = []
+    for _ in range(6):
+        conn.send({"command": "login", "username": "nobody", "password": PASSWORD})
+        replies.append(conn.receive().decode('utf-8'))
+    assert replies[:5] == ["Invalid username or password."] * 5
+    assert '"status": "busy"' in replies[5]
@@ -0,0 +1,42 @@
+import http.client
+
+from conftest import insert_user, insert_product, REPLY_TIMEOUT
+
+def seed(db):
+    seller_id = insert_user(db, "seller")
+    insert_user(db, "buyer")
+    insert_product(db, seller_id, "lamp", amount=5)
+
+def test_new_process_takes_over_the_listener_connections_and_sessions(start_server):
+    process = start_server(seed, RESTART_SOCKET="botique.restart.sock")
+    buyer = process.connect()
+    buyer.login("buyer")
+    token = buyer.request({"command": "issue_token"})["token"]
+    image_port = buyer.request({"command": "image_endpoint"})["port"]
+    watcher = process.connect()
+    watcher.login("seller")
+    assert watcher.request({"command": "subscribe_catalog"})["status"] == "subscribed"
+
+    old = process.take_over()
+
+    # The old process hands everything over and exits once its connections have moved
+    assert old.wait(REPLY_TIMEOUT) == 0
+    assert "Handed over to the new server process" in process.log()
+    assert process.process.poll() is None
+
+    # The idle connection was passed over still logged in, without reconnecting
+    assert buyer.request({"command": "ping"})["status"] == "pong"
+    assert buyer.request({"command": "Purchase", "product_name": "lamp", "self_id": buyer.user_id})["status"] == "success"
+    # The catalog subscriber moved too, and hears of the purchase made on the new process
+    change = watcher.reply()
+    while change.get("type") != "catalog":
+        change = watcher.reply()
+    assert (change["event"], change["amount"]) == ("amount", 4)
+
+    # New connections reach the new process on the same port, and the old session token still works there
+    newcomer = process.connect()
+    assert newcomer.request({"command": "resume_session", "token": token})["status"] == "ok"
+    http_conn = http.client.HTTPConnection("localhost", image_port, timeout=REPLY_TIMEOUT)
+    http_conn.request("GET", "/images/999", headers={"Authorization": f"Bearer {token}"})
+    assert http_conn.getresponse().status == 404
+    http_conn.close()
@@ -0,0 +1,89 @@
+import hashlib
+import os
+
+from conftest import insert_user
+
+IMAGE = os.urandom(3 * 8192 + 100)
+
+def seed(db):
+    insert_user(db, "seller")
+
+def sell(conn, name, image, image_sha256):
+    """List a product the original way: the image size follows the sell command and the bytes follow READY"""
+    conn.send({"command": "sell", "product_name": name, "price": 12.5, "description": "a test product", "amount": 3,
+               "self_id": conn.user_id, "image_path": "photo.jpg", "image_sha256": image_sha256})
+    conn.sock.sendall(str(len(image)).encode('utf-8'))
+    conn.read_until("READY")
+    conn.sock.sendall(image)
+    conn.read_until("Product ")
+    return "Product " + conn.read_until(".")
+
+def leftover_temp_files(process):
+    return [name for name in os.listdir(process.image_dir) if name.endswith(".part")]
+
+def test_streamed_image_is_stored_with_its_product(start_server):
+    process = start_server(seed)
+    conn = process.connect()
+    conn.login("seller")
+
+    reply = sell(conn, "lamp", IMAGE, hashlib.sha256(IMAGE).hexdigest())
+
+    assert reply == "Product registered successfully with image."
+    db = process.db()
+    product_id, image, amount = db.execute("SELECT id, image, amount FROM products WHERE name = 'lamp'").fetchone()
+    assert (image, amount) == (f"{product_id}.jpg", 3)
+    with open(os.path.join(process.image_dir, image), 'rb') as f:
+        assert f.read() == IMAGE
+    assert leftover_temp_files(process) == []
+
+def test_checksum_mismatch_registers_nothing(start_server):
+    process = start_server(seed)
+    conn = process.connect()
+    conn.login("seller")
+
+    reply = sell(conn, "lamp", IMAGE, hashlib.sha256(b"something else").hexdigest())
+
+    assert reply == "Product not registered: image checksum mismatch."
+    assert process.db().execute("SELECT COUNT(*) FROM products").fetchone()[0] == 0
+    assert leftover_temp_files(process) == []
+
+def sell_batch(conn, items, images):
+    conn.send({"command": "sell_batch", "self_id": conn.user_id, "items": items})
+    assert conn.reply() == {"status": "ready"}
+    # The images follow the manifest back to back, with no handshake between them
+    conn.sock.sendall(b"".join(images))
+    return conn.reply()
+
+def test_batch_registers_every_good_item_and_reports_each_one(start_server):
+    process = start_server(seed)
+    conn = process.connect()
+    conn.login("seller")
+    images = [os.urandom(1000), os.urandom(20000), os.urandom(5)]
+    items = [{"product_name": name, "price": 3.0, "description": name, "amount": 1, "size": len(image),
+              "sha256": hashlib.sha256(image).hexdigest()} for name, image in zip(["lamp", "vase", "rug"], images)]
+    items[1]["sha256"] = hashlib.sha256(b"something else").hexdigest()
+
+    reply = sell_batch(conn, items, images)
+
+    assert (reply["status"], reply["registered"]) == ("done", 2)
+    assert [(result["index"], result["status"]) for result in reply["results"]] == [(0, "ok"), (1, "error"), (2, "ok")]
+    assert reply["results"][1]["message"] == "Image checksum mismatch"
+    db = process.db()
+    for result, image in ((reply["results"][0], images[0]), (reply["results"][2], images[2])):
+        name = db.execute("SELECT image FROM products WHERE id = ?", (result["product_id"],)).fetchone()[0]
+        with open(os.path.join(process.image_dir, name), 'rb') as f:
+            assert f.read() == image
+    assert [name for (name,) in db.execute("SELECT name FROM products ORDER BY id")] == ["lamp", "rug"]
+    assert leftover_temp_files(process) == []
+
+def test_batch_manifest_is_checked_before_any_image_is_read(start_server):
+    process = start_server(seed)
+    conn = process.connect()
+    conn.login("seller")
+    reply = conn.request({"command": "sell_batch", "self_id": conn.user_id,
+                          "items": [{"product_name": "lamp", "price": 3.0, "description": "", "amount": 1}]})
+    assert reply == {"status": "error", "message": "Product entry missing 'size'"}
+    reply = conn.request({"command": "sell_batch", "self_id": conn.user_id, "items": []})
+    assert reply == {"status": "error", "message": "Batch must contain at least one product"}
+    # The connection is still in step with the server
+    assert conn.request({"command": "ping"})["status"] == "pong"
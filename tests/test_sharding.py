@@ -0,0 +1,97 @@
+import os
+import sqlite3
+
+import pytest
+
+from conftest import insert_user
+
+SHARDS = 3
+SELLERS = ["seller1", "seller2", "seller3"]
+# (seller, name, price) listed in this order; "lamp" exists on two shards
+LISTINGS = [("seller1", "lamp", 30.0), ("seller2", "vase", 10.0), ("seller3", "rug", 20.0),
+            ("seller1", "chair", 5.0), ("seller2", "lamp", 15.0), ("seller3", "mirror", 25.0)]
+IMAGE = b"image bytes"
+
+def seed(db):
+    # Users only: products in the main file would pin the layout to one shard
+    for username in SELLERS + ["buyer"]:
+        insert_user(db, username)
+
+def sell(conn, name, price):
+    conn.send({"command": "sell_batch", "self_id": conn.user_id, "items": [
+        {"product_name": name, "price": price, "description": f"a {name}", "amount": 2, "size": len(IMAGE)}]})
+    assert conn.reply()["status"] == "ready"
+    conn.sock.sendall(IMAGE)
+    reply = conn.reply()
+    assert reply["registered"] == 1, reply
+    return reply["results"][0]["product_id"]
+
+def shard_file(process, shard):
+    if shard == 0:
+        return process.db_path
+    return os.path.join(process.directory, f"botique.shard{shard}.db")
+
+@pytest.fixture
+def sharded(start_server):
+    process = start_server(seed, SHARD_COUNT=SHARDS, USE_COLUMNAR_CATALOG=False)
+    sellers = {}
+    for username in SELLERS:
+        sellers[username] = process.connect()
+        sellers[username].login(username)
+    ids = {}
+    for username, name, price in LISTINGS:
+        ids[(username, name)] = sell(sellers[username], name, price)
+    buyer = process.connect()
+    buyer.login("buyer")
+    return process, sellers, ids, buyer
+
+def test_product_ids_route_to_their_owners_shard(sharded):
+    process, sellers, ids, _ = sharded
+    owners = {username: conn.user_id for username, conn in sellers.items()}
+    assert len(set(ids.values())) == len(LISTINGS)
+    for (username, _), product_id in ids.items():
+        assert product_id % SHARDS == owners[username] % SHARDS
+    # Each file holds exactly the products of the owners that map to it
+    for shard in range(SHARDS):
+        db = sqlite3.connect(shard_file(process, shard))
+        try:
+            stored = {(owner_id, product_id) for owner_id, product_id in db.execute("SELECT owner_id, id FROM products")}
+        finally:
+            db.close()
+        assert stored == {(owners[username], product_id) for (username, _), product_id in ids.items()
+                          if owners[username] % SHARDS == shard}
+
+def test_reads_gather_every_shard(sharded):
+    _, sellers, ids, buyer = sharded
+    listing = buyer.request({"command": "display", "self_id": buyer.user_id})
+    assert sorted(item["id"] for item in listing) == sorted(ids.values())
+
+    # Sorted and limited per shard, then merged and cut again
+    cheapest = buyer.request({"command": "filter_by_budget", "budget": 100, "self_id": buyer.user_id,
+                              "with_images": False, "sort": "price", "limit": 3})
+    assert [item["name"] for item in cheapest["items"]] == ["chair", "vase", "lamp"]
+
+    owned = buyer.request({"command": "filter_by_owner", "owner_username": "seller3", "self_id": buyer.user_id,
+                           "with_images": False})
+    assert sorted(item["name"] for item in owned["items"]) == ["mirror", "rug"]
+
+def test_purchases_and_ratings_land_on_the_products_shard(sharded):
+    process, sellers, ids, buyer = sharded
+    # The oldest "lamp" is seller1's, listed first
+    assert buyer.request({"command": "Purchase", "product_name": "lamp", "self_id": buyer.user_id})["status"] == "success"
+    lamp_id = ids[("seller1", "lamp")]
+    seller = sellers["seller1"]
+    shard = seller.user_id % SHARDS
+    db = sqlite3.connect(shard_file(process, shard))
+    try:
+        assert db.execute("SELECT product_id, buyer_id FROM orders").fetchall() == [(lamp_id, buyer.user_id)]
+        assert db.execute("SELECT amount FROM products WHERE id = ?", (lamp_id,)).fetchone() == (1,)
+    finally:
+        db.close()
+    # The seller hears of the sale first, then asks for their totals
+    assert seller.reply()["status"] == "notification"
+    assert seller.request({"command": "seller_stats", "self_id": seller.user_id}) == {
+        "status": "ok", "orders": 1, "revenue": 30.0}
+
+    buyer.request({"command": "rate", "rating": 4, "product_id": lamp_id, "self_id": buyer.user_id})
+    assert buyer.request({"command": "display_rating", "product_id": lamp_id}) == {"name": "lamp", "rating": 4.0}
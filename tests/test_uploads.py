@@ -0,0 +1,116 @@
+import hashlib
+import os
+import time
+
+import client
+from conftest import insert_user, PASSWORD, REPLY_TIMEOUT
+
+IMAGE = os.urandom(600 * 1024)
+
+def seed(db):
+    insert_user(db, "seller")
+    insert_user(db, "watcher")
+
+def begin(conn, image=IMAGE):
+    reply = conn.request({"command": "begin_upload", "size": len(image), "sha256": hashlib.sha256(image).hexdigest(),
+                          "self_id": conn.user_id})
+    assert reply["status"] == "ok"
+    return reply["upload_id"], reply["chunk_size"]
+
+def persisted(conn, upload_id, expected):
+    """Poll query_upload until the server reports expected bytes on disk"""
+    deadline = time.monotonic() + REPLY_TIMEOUT
+    while True:
+        reply = conn.request({"command": "query_upload", "upload_id": upload_id})
+        if reply["offset"] == expected or time.monotonic() > deadline:
+            return reply
+        time.sleep(0.05)
+
+def send_chunk(conn, upload_id, offset, data):
+    assert conn.request({"command": "upload_chunk", "upload_id": upload_id, "offset": offset, "length": len(data)})["status"] == "ready"
+    conn.sock.sendall(data)
+    return conn.reply()
+
+def send_rest(conn, upload_id, offset, chunk_size):
+    while offset < len(IMAGE):
+        data = IMAGE[offset:offset + chunk_size]
+        assert send_chunk(conn, upload_id, offset, data) == {"status": "ok", "offset": offset + len(data)}
+        offset += len(data)
+
+def test_interrupted_chunk_resumes_from_persisted_offset(start_server):
+    process = start_server(seed)
+    first = process.connect()
+    first.login("seller")
+    upload_id, chunk_size = begin(first)
+    assert send_chunk(first, upload_id, 0, IMAGE[:chunk_size]) == {"status": "ok", "offset": chunk_size}
+    # Half of the second chunk arrives before the connection drops
+    cut = chunk_size + chunk_size // 2
+    assert first.request({"command": "upload_chunk", "upload_id": upload_id, "offset": chunk_size,
+                          "length": chunk_size})["status"] == "ready"
+    first.sock.sendall(IMAGE[chunk_size:cut])
+    first.close()
+
+    second = process.connect()
+    second.login("seller")
+    status = persisted(second, upload_id, cut)
+    assert (status["offset"], status["size"], status["complete"]) == (cut, len(IMAGE), False)
+    assert second.request({"command": "finish_upload", "upload_id": upload_id})["message"] == "Upload incomplete"
+    send_rest(second, upload_id, cut, chunk_size)
+    assert second.request({"command": "finish_upload", "upload_id": upload_id})["status"] == "ok"
+
+    second.send({"command": "sell", "product_name": "lamp", "price": 5, "description": "resumed", "amount": 1,
+                 "self_id": second.user_id, "image_path": "photo.jpg", "upload_id": upload_id})
+    assert second.read_until(".") == "Product registered successfully with image."
+    image = process.db().execute("SELECT image FROM products WHERE name = 'lamp'").fetchone()[0]
+    with open(os.path.join(process.image_dir, image), 'rb') as f:
+        assert f.read() == IMAGE
+
+def test_chunk_past_persisted_offset_is_refused(start_server):
+    process = start_server(seed)
+    conn = process.connect()
+    conn.login("seller")
+    upload_id, chunk_size = begin(conn)
+    reply = conn.request({"command": "upload_chunk", "upload_id": upload_id, "offset": 10, "length": 10})
+    assert reply == {"status": "error", "message": "Invalid offset", "offset": 0}
+
+def test_client_resumes_upload_on_an_authenticated_connection(start_server, tmp_path, monkeypatch):
+    process = start_server(seed)
+    image_path = tmp_path / "photo.jpg"
+    image_path.write_bytes(IMAGE)
+    seller = client.Client(process.port, None)
+    seller.start_connection()
+    assert seller.login("seller", PASSWORD).startswith("Login successful.")
+    old_socket = seller.client_socket
+
+    upload_from_offset = client.Client.upload_from_offset
+    def drop_first_attempt(self, *args):
+        if self.client_socket is old_socket:
+            self.client_socket.close()
+        return upload_from_offset(self, *args)
+    monkeypatch.setattr(client.Client, "upload_from_offset", drop_first_attempt)
+
+    reply = seller.sell_item("lamp", 5, "resumed", str(image_path), 1)
+
+    assert reply == "Product registered successfully with image."
+    assert seller.client_socket is not old_socket
+    # The new connection carries the login: it can issue tokens and is the one the user is online on
+    assert seller.request({"command": "issue_token"})["status"] == "ok"
+    watcher = process.connect()
+    watcher.login("watcher")
+    time.sleep(0.2)
+    assert watcher.request({"command": "check_online", "owner_username": "seller"}) == {"message": "seller is online"}
+
+def test_slow_but_moving_chunk_outlives_the_reaper_deadline(start_server):
+    # The reaper runs often and would close anything silent for two seconds
+    process = start_server(seed, IDLE_TIMEOUT=1, OPERATION_TIMEOUT=1, REAPER_INTERVAL=0.2)
+    conn = process.connect()
+    conn.login("seller")
+    upload_id, chunk_size = begin(conn)
+    assert conn.request({"command": "upload_chunk", "upload_id": upload_id, "offset": 0,
+                         "length": chunk_size})["status"] == "ready"
+    pieces = 12
+    step = chunk_size // pieces
+    for start in range(0, chunk_size, step):
+        conn.sock.sendall(IMAGE[start:min(start + step, chunk_size)])
+        time.sleep(0.3)
+    assert conn.reply() == {"status": "ok", "offset": chunk_size}
@@ -0,0 +1,114 @@
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import threading
+
+import pytest
+
+import image_storage
+import server
+from conftest import insert_user
+
+def queued(operation, *args, on_commit=None, on_rollback=None):
+    """A write as run_write queues it for a writer thread, and the future its caller waits on"""
+    future = concurrent.futures.Future()
+    return (operation, args, True, on_commit, on_rollback, "test", future), future
+
+def upload(directory, name, data):
+    path = os.path.join(directory, f"{name}.part")
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def insert_name(cursor, name):
+    cursor.execute("INSERT INTO products (owner_id, name, amount) VALUES (NULL, ?, 1)", (name,))
+    return cursor.lastrowid
+
+def product_names(db):
+    return [name for (name,) in db.execute("SELECT name FROM products ORDER BY id")]
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "marketplace.db")
+    server.create_Tables(db_path)
+    monkeypatch.setattr(server, "image_store", image_storage.FileImageStore(str(tmp_path)))
+    db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    yield db
+    db.close()
+
+def test_rolled_back_write_hands_its_image_back_before_the_next_write_reuses_the_id(db, tmp_path):
+    owner_id = insert_user(db, "seller")
+    events = []
+
+    def insert_then_fail(cursor, *args):
+        server.insert_product(cursor, *args)
+        raise sqlite3.IntegrityError("rejected")
+
+    failed_path = upload(tmp_path, "failed", b"failed image")
+    failed_stored = []
+    kept_path = upload(tmp_path, "kept", b"kept image")
+    kept_stored = []
+    failed, failed_future = queued(insert_then_fail, owner_id, "lamp", 5, "", 1, failed_path, failed_stored,
+                                   on_rollback=lambda: (events.append("rollback"), server.discard_images(failed_stored)))
+    kept, kept_future = queued(server.insert_product, owner_id, "vase", 5, "", 1, kept_path, kept_stored,
+                               on_commit=lambda product_id: events.append(("commit", product_id, kept_future.done())))
+
+    server.commit_group(db, [failed, kept])
+
+    product_id = kept_future.result()
+    # The failed write freed its ID, so the next one got it and its image has the same name
+    assert failed_future.exception() is not None
+    assert events == ["rollback", ("commit", product_id, False)]
+    with open(tmp_path / f"{product_id}.jpg", 'rb') as f:
+        assert f.read() == b"kept image"
+    with open(failed_path, 'rb') as f:
+        assert f.read() == b"failed image"
+    assert db.execute("SELECT id, name FROM products").fetchall() == [(product_id, "vase")]
+
+def test_any_error_before_the_commit_fails_the_whole_group(db, monkeypatch):
+    rolled_back = []
+    first, first_future = queued(insert_name, "lamp", on_rollback=lambda: rolled_back.append("lamp"))
+    second, second_future = queued(insert_name, "vase", on_rollback=lambda: rolled_back.append("vase"))
+    def broken_sync():
+        raise RuntimeError("sync failed")
+    monkeypatch.setattr(server.image_store, "sync", broken_sync)
+
+    server.commit_group(db, [first, second])
+
+    assert isinstance(first_future.exception(), RuntimeError) and isinstance(second_future.exception(), RuntimeError)
+    assert rolled_back == ["lamp", "vase"]
+    assert not db.in_transaction and product_names(db) == []
+
+def test_writer_thread_survives_a_failing_group(db, monkeypatch):
+    writes = queue.Queue()
+    profile_call = server.diagnostics.profile_call
+    calls = []
+    def fail_first_group(function, *args):
+        calls.append(function)
+        if len(calls) == 1:
+            raise RuntimeError("profiler broke")
+        return profile_call(function, *args)
+    monkeypatch.setattr(server.diagnostics, "profile_call", fail_first_group)
+    threading.Thread(target=server.write_loop, args=(db, writes), daemon=True).start()
+
+    lost, lost_future = queued(insert_name, "lamp")
+    writes.put(lost)
+    assert isinstance(lost_future.exception(10), RuntimeError)
+    kept, kept_future = queued(insert_name, "vase")
+    writes.put(kept)
+    assert kept_future.result(10) > 0
+    assert product_names(db) == ["vase"]
+
+def test_run_write_gives_up_on_a_writer_that_does_not_answer(db, monkeypatch):
+    writes = queue.Queue()
+    monkeypatch.setattr(server, "writer_dbs", [db])
+    monkeypatch.setattr(server, "write_queues", [writes])
+    monkeypatch.setattr(server, "WRITE_TIMEOUT", 0.1)
+
+    with pytest.raises(sqlite3.OperationalError):
+        server.run_write(db, insert_name, "lamp")
+
+    # The write was never started, so a writer that wakes up later skips it
+    server.commit_group(db, [writes.get_nowait()])
+    assert product_names(db) == []